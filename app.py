@@ -1,72 +1,950 @@
-from flask import Flask, render_template, request, jsonify, stream_with_context, Response
-from langchain.evaluation import load_evaluator
-from langchain_openai import ChatOpenAI, OpenAI
+from flask import Flask, render_template, request, jsonify, stream_with_context, Response, send_file
 
-from langchain_aws import BedrockLLM, BedrockChat
-from langchain_ibm import WatsonxLLM
-
-from langchain.schema import HumanMessage
+from ratelimit import arate_limited, provider_family, rate_limited, throttled_mid_stream
+import metrics
+import providers
+from clientpool import LRURegistry
+from responsecache import ResponseCache, check_policy, make_key
+from jobs import COMPLETED, FINISHED, VERDICT, JobManager, JobStore
+from stopping import parse_early_stopping
+from dedupe import SharedCalls
+from prescore import PreScorer, check_rules
+from resultstore import ResultStore
 import dotenv
+import asyncio
 import re
 import logging
 import os
 import csv
+import io
 import time
 import json
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 dotenv.load_dotenv()
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.DEBUG)
 
+app.config['JUDGE_PROVIDER'] = os.environ.get('JUDGE_PROVIDER', 'bedrock')
+
+# Models beyond the built-in ones can be registered from a JSON file (see providers.py).
+if os.environ.get('MODEL_REGISTRY'):
+    providers.load_config(os.environ['MODEL_REGISTRY'])
+
+# Upper bound for the number of iterations a single request may run in parallel.
+app.config['MAX_CONCURRENCY'] = int(os.environ.get('MAX_CONCURRENCY', 4))
+
+# Model clients and evaluators are reused across requests instead of being rebuilt every time.
+llm_clients = LRURegistry('llm_clients', int(os.environ.get('CLIENT_POOL_SIZE', 32)))
+evaluators = LRURegistry('evaluators', int(os.environ.get('EVALUATOR_POOL_SIZE', 64)))
+
+# Generations and judge results can be served from a local cache: read-through, write-only or bypass.
+app.config['RESPONSE_CACHE_POLICY'] = check_policy(os.environ.get('RESPONSE_CACHE_POLICY', 'bypass'))
+response_cache = ResponseCache(
+    os.environ.get('RESPONSE_CACHE_PATH', 'response_cache.sqlite3'),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 7 * 24 * 3600)),
+    max_entries=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 100000))
+)
+
+# Every finished run and its iterations are recorded in a local SQLite file; an empty path disables it.
+app.config['RESULTS_STORE_PATH'] = os.environ.get('RESULTS_STORE_PATH', 'results.sqlite3')
+result_store = ResultStore(app.config['RESULTS_STORE_PATH']) if app.config['RESULTS_STORE_PATH'] else None
+
+# Batch jobs are stored (and checkpointed) in a local SQLite file and run by background workers.
+app.config['JOB_STORE_PATH'] = os.environ.get('JOB_STORE_PATH', 'jobs.sqlite3')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+job_manager = None
+job_manager_lock = threading.Lock()
+
+# Local scoring rules tried before the judge model; 'off', 'default' or a JSON list (see prescore.py).
+app.config['PRESCORE_RULES'] = os.environ.get('PRESCORE_RULES', 'off')
+
+# Largest number of models a single /compare request may run.
+app.config['MAX_COMPARE_MODELS'] = int(os.environ.get('MAX_COMPARE_MODELS', 8))
+
+# Number of finished calls a batch remembers to share with identical calls in later rows.
+app.config['BATCH_DEDUPE_SIZE'] = int(os.environ.get('BATCH_DEDUPE_SIZE', 10000))
+
+# Interval of the keep-alive comments that let /evaluate_stream notice a client went away.
+app.config['STREAM_HEARTBEAT'] = float(os.environ.get('STREAM_HEARTBEAT', 5))
+
+
+def build_llm(model_name, temperature, max_new_tokens):
+    # The provider SDK is imported the first time one of its models is built.
+    return providers.build_model(model_name, temperature, max_new_tokens)
+
+
+def timed_build(model, build):
+    with metrics.timed('client', model) as timer:
+        client = build()
+        timer.provider = provider_family(client)
+    return client
+
 
 def get_llm(model_name, temperature, max_new_tokens):
-    parameters = {
-        "decoding_method": "sample",
-        "max_new_tokens": max_new_tokens,
-        "min_new_tokens": 1,
-        "temperature": temperature,
-        "top_k": 50,
-        "top_p": 1,
+    return llm_clients.get((model_name, temperature, max_new_tokens),
+                           lambda: timed_build(model_name, lambda: build_llm(model_name, temperature, max_new_tokens)))
+
+
+def get_llm_evaluator(model):
+    # The judge is Llama 3 70b, unless that is the model under test. The stub model, or
+    # JUDGE_PROVIDER=stub, selects the offline stub judge instead.
+    if model == 'stub' or app.config['JUDGE_PROVIDER'] == 'stub':
+        return llm_clients.get(('judge', 'stub-judge'),
+                               lambda: timed_build('stub-judge', lambda: providers.build('stub', 'stub-judge', role='judge')))
+    judge_model_id = "meta.llama3-70b-instruct-v1:0" if model != "llama_3_70b" else "anthropic.claude-v2"
+    return llm_clients.get(('judge', judge_model_id),
+                           lambda: timed_build(judge_model_id, lambda: providers.build('bedrock_chat', judge_model_id)))
+
+
+def get_shared_judge(models):
+    # One judge for several models under test: Claude v2 when Llama 3 70b is among them, so no model
+    # judges its own answers, and the stub judge only when every model is the stub.
+    if 'llama_3_70b' in models:
+        return get_llm_evaluator('llama_3_70b')
+    return get_llm_evaluator(next((model for model in models if model != 'stub'), 'stub'))
+
+
+def build_evaluator(llm_evaluator, criteria):
+    from langchain.evaluation import load_evaluator  # imported on first use, like the provider SDKs
+
+    accuracy_criteria = {
+        "accuracy": criteria
     }
+    return load_evaluator(
+        "labeled_score_string",
+        # https://api.python.langchain.com/en/latest/evaluation/langchain.evaluation.schema.EvaluatorType.html "The labeled scored string evaluator, which gives a score between 1 and 10 to a prediction based on a ground truth reference label."
+        llm=llm_evaluator,
+        criteria=accuracy_criteria
+    )
+
+
+def get_evaluator(llm_evaluator, criteria):
+    judge_model_id = getattr(llm_evaluator, 'model_id', None)
+    if judge_model_id is None:
+        return build_evaluator(llm_evaluator, criteria)
+    return evaluators.get((judge_model_id, criteria),
+                          lambda: timed_build(judge_model_id, lambda: build_evaluator(llm_evaluator, criteria)))
+
+
+def is_chat_model(llm):
+    # Any real client has already loaded langchain_core, so this import costs nothing by then.
+    from langchain_core.language_models.chat_models import BaseChatModel
+    return isinstance(llm, BaseChatModel)
+
+
+def chat_messages(prompt):
+    from langchain_core.messages import HumanMessage
+    return [HumanMessage(content=prompt)]
+
+
+def invoke_llm(llm, prompt):
+    if is_chat_model(llm):
+        messages = chat_messages(prompt)
+        logging.debug(f"Sending messages to model: {messages}")
+        response = rate_limited(llm, llm, messages)
+        return response[0].content if isinstance(response, list) else response.content
+    elif provider_family(llm) == 'watsonx':
+        logging.debug(f"Sending prompt to model: {prompt}")
+        return rate_limited(llm, llm.invoke, prompt)
+    else:
+        logging.debug(f"Sending prompt to model: {prompt}")
+        return rate_limited(llm, llm, prompt)
+
+
+def chunk_text(chunk):
+    return chunk.content if hasattr(chunk, 'content') else chunk
 
-    if model_name == 'gpt_3.5':
-        return ChatOpenAI(model_name="gpt-3.5-turbo-0125", temperature=temperature, max_tokens=max_new_tokens)
-    elif model_name == 'gpt_4':
-        return ChatOpenAI(model_name="gpt-4-turbo", temperature=temperature, max_tokens=max_new_tokens)
-    elif model_name == 'gpt_4o':
-        return ChatOpenAI(model_name="gpt-4o", temperature=temperature, max_tokens=max_new_tokens)
-    elif model_name == 'llama_2_13b':
-        return BedrockLLM(model_id="meta.llama2-13b-chat-v1")
-    elif model_name == 'llama_3_8b':
-        return BedrockLLM(model_id="meta.llama3-8b-instruct-v1:0")
-    elif model_name == 'llama_3_70b':
-        return BedrockChat(model_id="meta.llama3-70b-instruct-v1:0")
-    elif model_name == 'codellama_34b_instruct':
-        return WatsonxLLM(model_id="codellama/codellama-34b-instruct-hf", project_id=os.environ["WATSONX_PROJECT_ID"], params=parameters)
-    elif model_name == 'claude_3_sonnet':
-        return BedrockChat(model_id="anthropic.claude-3-sonnet-20240229-v1:0")
-    elif model_name == 'claude_3_haiku':
-        return BedrockChat(model_id="anthropic.claude-3-haiku-20240307-v1:0")
-    elif model_name == 'claude_v2':
-        return BedrockChat(model_id="anthropic.claude-v2")
-    elif model_name == 'claude_v2.1_200k':
-        return BedrockChat(model_id="anthropic.claude-v2:1")
-    elif model_name == 'amazon_titan_text_g1':
-        return BedrockLLM(model_id="amazon.titan-text-express-v1")
-    elif model_name == 'mixtral_8x7b_instruct':
-        return BedrockLLM(model_id="mistral.mixtral-8x7b-instruct-v0:1")
-    elif model_name == 'mistral_7b_instruct':
-        return BedrockLLM(model_id="mistral.mistral-7b-instruct-v0:2")
-    elif model_name == 'granite_13b_chat':
-        return WatsonxLLM(model_id="ibm/granite-13b-chat-v2", project_id=os.environ["WATSONX_PROJECT_ID"],
-                          params=parameters)
-    elif model_name == 'granite_13b_instruct':
-        return WatsonxLLM(model_id="ibm/granite-13b-instruct-v2", project_id=os.environ["WATSONX_PROJECT_ID"], params=parameters)
-    elif model_name == 'granite_20b_multilingual':
-        return WatsonxLLM(model_id="ibm/granite-20b-multilingual", project_id=os.environ["WATSONX_PROJECT_ID"], params=parameters)
+
+def stream_llm(llm, prompt, on_token):
+    # Streams the prediction through on_token as it is generated and returns it with the time
+    # it took the model to produce the first token.
+    if is_chat_model(llm):
+        model_input = chat_messages(prompt)
     else:
-        return OpenAI(temperature=temperature, max_tokens=max_new_tokens)  # default model
+        model_input = prompt
+    logging.debug(f"Streaming from model: {model_input}")
+
+    def open_stream():
+        # Only starting the stream and waiting for its first token is retried when the provider
+        # throttles: once tokens have been sent, a retry would send them again.
+        start = time.perf_counter()
+        chunks = iter(llm.stream(model_input))
+        for chunk in chunks:
+            if chunk_text(chunk):
+                return chunks, chunk_text(chunk), time.perf_counter() - start
+        return chunks, None, None
+
+    chunks, first, ttft = rate_limited(llm, open_stream)
+    parts = []
+    if first:
+        parts.append(first)
+        on_token(first)
+    try:
+        for chunk in chunks:
+            text = chunk_text(chunk)
+            if text:
+                parts.append(text)
+                on_token(text)
+    except Exception as e:
+        error = throttled_mid_stream(llm, e)
+        if error is e:
+            raise
+        raise error from e
+    return ''.join(parts), ttft
+
+
+async def ainvoke_llm(llm, prompt):
+    # Same as invoke_llm through the client's async API, so the call doesn't hold a thread while it
+    # waits on the provider. Clients without one are called in a worker thread.
+    if not hasattr(llm, 'ainvoke'):
+        return await asyncio.to_thread(invoke_llm, llm, prompt)
+    if is_chat_model(llm):
+        messages = chat_messages(prompt)
+        logging.debug(f"Sending messages to model: {messages}")
+        response = await arate_limited(llm, llm.ainvoke, messages)
+        return response.content
+    logging.debug(f"Sending prompt to model: {prompt}")
+    return await arate_limited(llm, llm.ainvoke, prompt)
+
+
+async def astream_llm(llm, prompt, on_token):
+    # Same as stream_llm through the client's async API. on_token is always called on the event loop.
+    if not hasattr(llm, 'astream'):
+        loop = asyncio.get_running_loop()
+        return await asyncio.to_thread(stream_llm, llm, prompt,
+                                       lambda text: loop.call_soon_threadsafe(on_token, text))
+    model_input = chat_messages(prompt) if is_chat_model(llm) else prompt
+    logging.debug(f"Streaming from model: {model_input}")
+
+    async def open_stream():
+        # As in stream_llm, only starting the stream and waiting for its first token is retried.
+        start = time.perf_counter()
+        chunks = aiter(llm.astream(model_input))
+        async for chunk in chunks:
+            if chunk_text(chunk):
+                return chunks, chunk_text(chunk), time.perf_counter() - start
+        return chunks, None, None
+
+    chunks, first, ttft = await arate_limited(llm, open_stream)
+    parts = []
+    if first:
+        parts.append(first)
+        on_token(first)
+    try:
+        async for chunk in chunks:
+            text = chunk_text(chunk)
+            if text:
+                parts.append(text)
+                on_token(text)
+    except Exception as e:
+        error = throttled_mid_stream(llm, e)
+        if error is e:
+            raise
+        raise error from e
+    return ''.join(parts), ttft
+
+
+def parse_score(reasoning):
+    score_match = re.search(r'\[\[(\d+)]]', reasoning)
+    return int(score_match.group(1)) if score_match else None
+
+
+def get_cache_policy(value=None):
+    if value in (None, ''):
+        return app.config['RESPONSE_CACHE_POLICY']
+    return check_policy(value)
+
+
+def get_prescore_rules(value=None):
+    if value in (None, ''):
+        value = app.config['PRESCORE_RULES']
+    return check_rules(value)
+
+
+class EvaluationRun:
+    # One evaluation (a form submission or a CSV row): the model under test, its judge and the
+    # inputs every iteration shares.
+    def __init__(self, model, temperature, max_new_tokens, prompt, criteria, iterations, expected_result,
+                 cache_policy=None, early_stopping=None, shared_calls=None, prescore=None, llm_evaluator=None):
+        self.model = model
+        self.temperature = temperature
+        self.max_new_tokens = max_new_tokens
+        self.prompt = prompt
+        self.criteria = criteria
+        self.iterations = iterations
+        self.expected_result = expected_result
+        self.cache_policy = get_cache_policy(cache_policy)
+        # Predictions the local rules can score don't go to the judge model.
+        prescore_rules = get_prescore_rules(prescore)
+        self.prescorer = PreScorer(prescore_rules, expected_result) if prescore_rules else None
+        # With early stopping, iterations is an upper bound: no more are started once the scores converge.
+        self.early_stopping = early_stopping
+        # In a batch, identical generations and judgments are made once and shared between rows.
+        self.shared_calls = shared_calls
+
+        self.llm_evaluator = llm_evaluator or get_llm_evaluator(model)
+        self.evaluator = get_evaluator(self.llm_evaluator, criteria)
+        self.llm = get_llm(model, temperature, max_new_tokens)
+        self.provider = provider_family(self.llm)
+        self.judge_model = getattr(self.llm_evaluator, 'model_id', None)
+        self.judge_provider = provider_family(self.llm_evaluator)
+        # Stage timings of the iterations between their generation and their judgment.
+        self.timings = {}
+        self.shared = {}
+
+    def share(self, stage, key, compute):
+        # Rows share a generation only with the same iteration of an identical row, so the iterations of
+        # a row stay separate calls, as in /evaluate. Judgments of the same (prediction, criteria,
+        # reference) are shared whatever their iteration.
+        if self.shared_calls is None:
+            return compute(), False
+        return self.shared_calls.fetch(stage, key, compute)
+
+    def generation_key(self, iteration):
+        # Sampled generations are cached per iteration, so a cached rerun keeps its spread of
+        # predictions; at temperature 0 every iteration shares one entry.
+        return make_key('generation', self.model, self.temperature, self.max_new_tokens, self.prompt,
+                        iteration if self.temperature else None)
+
+    def judgment_key(self, prediction):
+        return make_key('judgment', self.judge_model, self.criteria, self.expected_result, self.prompt, prediction)
+
+    def generate(self, iteration):
+        key = self.generation_key(iteration)
+
+        def compute():
+            # Only the provider call goes into the stage metrics: a cache hit or a wait on a shared
+            # call isn't provider latency. The iteration's timings report the whole wait.
+            with metrics.timed('generation', self.model, self.provider):
+                return invoke_llm(self.llm, self.prompt)
+
+        start = time.perf_counter()
+        (prediction, cached), shared = self.share(
+            'generation', (key, iteration), lambda: response_cache.fetch(self.cache_policy, key, compute))
+        self.timings[iteration] = {'generation': time.perf_counter() - start}
+        self.shared[iteration] = shared
+        logging.debug(f"Received prediction: {prediction}")
+        return prediction, cached
+
+    def generate_streaming(self, iteration, on_token):
+        # Same as generate, but streams the tokens. A cached prediction is sent as a single token.
+        key = self.generation_key(iteration)
+        ttft = None
+
+        def compute():
+            nonlocal ttft
+            with metrics.timed('generation', self.model, self.provider):
+                prediction, ttft = stream_llm(self.llm, self.prompt, on_token)
+            return prediction
+
+        start = time.perf_counter()
+        prediction, cached = response_cache.fetch(self.cache_policy, key, compute)
+        self.timings[iteration] = {'generation': time.perf_counter() - start}
+        if cached:
+            on_token(prediction)
+        logging.debug(f"Received prediction: {prediction}")
+        return prediction, cached, ttft
+
+    def begin_judgment(self, prediction, iteration):
+        # Takes the timings of the iteration's generation and tries the local rules. The returned
+        # decision is None when the judge model has to score the prediction.
+        timings = self.timings.pop(iteration, {})
+        prediction_shared = self.shared.pop(iteration, False)
+        decision = None
+        if self.prescorer is not None:
+            with metrics.timed('prescore', self.model, 'local') as timer:
+                decision = self.prescorer.decide(prediction)
+            timings['prescore'] = timer.elapsed
+        return timings, prediction_shared, decision
+
+    def judgment(self, iteration, prediction, timings, cached, shared, decision=None, eval_result=None):
+        # The iteration's result from the local decision or the judge's evaluation. cached and shared
+        # are (prediction, judgment) pairs of flags.
+        if decision is not None:
+            score, reason, path = decision.score, decision.reason, decision.path
+        else:
+            with metrics.timed('score_parse', self.judge_model, self.judge_provider) as timer:
+                score = parse_score(eval_result['reasoning'])
+            timings['score_parse'] = timer.elapsed
+            reason, path = eval_result['reasoning'], 'judge'
+        metrics.SCORING_PATHS.inc(path=path)
+
+        result = {
+            'iteration': iteration,
+            'prediction': prediction,
+            'score': score,
+            'reason': reason,
+            'scoring_path': path,
+            'cached': {'prediction': cached[0], 'judgment': cached[1]},
+            'timings': timings
+        }
+        if self.shared_calls is not None:
+            result['shared'] = {'prediction': shared[0], 'judgment': shared[1]}
+        return result
+
+    def judge(self, prediction, iteration, prediction_cached=False):
+        timings, prediction_shared, decision = self.begin_judgment(prediction, iteration)
+        if decision is not None:
+            return self.judgment(iteration, prediction, timings, (prediction_cached, False),
+                                 (prediction_shared, False), decision)
+
+        key = self.judgment_key(prediction)
+
+        def compute():
+            # The judge model is rate limited as well, by the provider family of the evaluator's llm.
+            with metrics.timed('judge', self.judge_model, self.judge_provider):
+                return rate_limited(getattr(self.evaluator, 'llm', None), self.evaluator.evaluate_strings,
+                                    prediction=prediction, input=self.prompt, reference=self.expected_result)
+
+        start = time.perf_counter()
+        (eval_result, cached), judgment_shared = self.share(
+            'judgment', key, lambda: response_cache.fetch(self.cache_policy, key, compute))
+        timings['judge'] = time.perf_counter() - start
+        return self.judgment(iteration, prediction, timings, (prediction_cached, cached),
+                             (prediction_shared, judgment_shared), eval_result=eval_result)
+
+    def run_iteration(self, iteration, on_token=None):
+        # With on_token, the prediction is streamed as it is generated and the result reports the
+        # time to first token.
+        if on_token is None:
+            prediction, cached = self.generate(iteration)
+            return self.judge(prediction, iteration, cached)
+
+        prediction, cached, ttft = self.generate_streaming(iteration, lambda text: on_token(iteration, text))
+        result = self.judge(prediction, iteration, cached)
+        result['ttft'] = ttft
+        return result
+
+    def final_verdict(self, iterations=None):
+        with metrics.timed('final_verdict', self.judge_model, self.judge_provider):
+            return get_final_verdict(self.llm_evaluator, self.model, iterations or self.iterations)
+
+    # The same stages as coroutines, for the asyncio engine in asgi.py. Model and judge calls go
+    # through the clients' async APIs; shared_calls is then an AsyncSharedCalls.
+
+    async def ashare(self, stage, key, compute):
+        if self.shared_calls is None:
+            return await compute(), False
+        return await self.shared_calls.fetch(stage, key, compute)
+
+    async def agenerate(self, iteration):
+        key = self.generation_key(iteration)
+
+        async def compute():
+            with metrics.timed('generation', self.model, self.provider):
+                return await ainvoke_llm(self.llm, self.prompt)
+
+        start = time.perf_counter()
+        (prediction, cached), shared = await self.ashare(
+            'generation', (key, iteration), lambda: response_cache.afetch(self.cache_policy, key, compute))
+        self.timings[iteration] = {'generation': time.perf_counter() - start}
+        self.shared[iteration] = shared
+        logging.debug(f"Received prediction: {prediction}")
+        return prediction, cached
+
+    async def agenerate_streaming(self, iteration, on_token):
+        key = self.generation_key(iteration)
+        ttft = None
+
+        async def compute():
+            nonlocal ttft
+            with metrics.timed('generation', self.model, self.provider):
+                prediction, ttft = await astream_llm(self.llm, self.prompt, on_token)
+            return prediction
+
+        start = time.perf_counter()
+        prediction, cached = await response_cache.afetch(self.cache_policy, key, compute)
+        self.timings[iteration] = {'generation': time.perf_counter() - start}
+        if cached:
+            on_token(prediction)
+        logging.debug(f"Received prediction: {prediction}")
+        return prediction, cached, ttft
+
+    async def aevaluate(self, prediction):
+        llm = getattr(self.evaluator, 'llm', None)
+        arguments = {'prediction': prediction, 'input': self.prompt, 'reference': self.expected_result}
+        # The labeled_score_string evaluator awaits its chain in aevaluate_strings. Evaluators without
+        # an async API are called in a worker thread.
+        if not hasattr(self.evaluator, 'aevaluate_strings'):
+            return await asyncio.to_thread(rate_limited, llm, self.evaluator.evaluate_strings, **arguments)
+        return await arate_limited(llm, self.evaluator.aevaluate_strings, **arguments)
+
+    async def ajudge(self, prediction, iteration, prediction_cached=False):
+        timings, prediction_shared, decision = self.begin_judgment(prediction, iteration)
+        if decision is not None:
+            return self.judgment(iteration, prediction, timings, (prediction_cached, False),
+                                 (prediction_shared, False), decision)
+
+        key = self.judgment_key(prediction)
+
+        async def compute():
+            with metrics.timed('judge', self.judge_model, self.judge_provider):
+                return await self.aevaluate(prediction)
+
+        start = time.perf_counter()
+        (eval_result, cached), judgment_shared = await self.ashare(
+            'judgment', key, lambda: response_cache.afetch(self.cache_policy, key, compute))
+        timings['judge'] = time.perf_counter() - start
+        return self.judgment(iteration, prediction, timings, (prediction_cached, cached),
+                             (prediction_shared, judgment_shared), eval_result=eval_result)
+
+    async def arun_iteration(self, iteration, on_token=None):
+        if on_token is None:
+            prediction, cached = await self.agenerate(iteration)
+            return await self.ajudge(prediction, iteration, cached)
+
+        prediction, cached, ttft = await self.agenerate_streaming(iteration, lambda text: on_token(iteration, text))
+        result = await self.ajudge(prediction, iteration, cached)
+        result['ttft'] = ttft
+        return result
+
+    async def afinal_verdict(self, iterations=None):
+        with metrics.timed('final_verdict', self.judge_model, self.judge_provider):
+            return await aget_final_verdict(self.llm_evaluator, self.model, iterations or self.iterations)
+
+    def summary(self, eval_results):
+        # How many iterations actually ran and, with early stopping, the interval they stopped at.
+        summary = {'iterations_run': len(eval_results)}
+        if self.early_stopping is not None:
+            summary['stopped_early'] = self.early_stopping.converged and len(eval_results) < self.iterations
+            summary['confidence_interval'] = self.early_stopping.interval()
+        return summary
+
+
+def failed_iteration(iteration, error):
+    return {
+        'iteration': iteration,
+        'prediction': None,
+        'score': None,
+        'reason': str(error)
+    }
+
+
+def get_max_concurrency(value=None):
+    # The calls one request runs at once. A request may lower MAX_CONCURRENCY, but never raise it;
+    # the cap is per request, the provider rate limiters bound the process as a whole.
+    limit = app.config['MAX_CONCURRENCY']
+    if value in (None, ''):
+        return limit
+    value = int(value)
+    if value < 1:
+        raise ValueError('max_concurrency must be at least 1')
+    return min(value, limit)
+
+
+def record_cancellation(futures):
+    # Cancels the futures that haven't started and counts them, and the running ones left to finish
+    # on their own, so we can see how much capacity disconnects give back.
+    cancelled = sum(1 for future in futures if future.cancel())
+    abandoned = sum(1 for future in futures if not future.done())
+    metrics.CANCELLATIONS.inc(cancelled, kind='cancelled_calls')
+    metrics.CANCELLATIONS.inc(abandoned, kind='abandoned_calls')
+    return cancelled, abandoned
+
+
+def stop_early(futures):
+    # Cancels the iterations that haven't started once the scores have converged. Running ones are
+    # left to finish, since their calls are already paid for.
+    stopped = sum(1 for future in futures if future.cancel())
+    metrics.EARLY_STOPS.inc(stopped)
+    return stopped
+
+
+def run_iterations(run, max_concurrency, heartbeat=None, stream_tokens=False):
+    # Runs the iterations on a bounded thread pool and yields each result as soon as it finishes,
+    # so results come out in completion order. A ValueError is recorded as a failed iteration.
+    # With early stopping on the run, the iterations that haven't started are cancelled as soon as
+    # the scores converge.
+    # With stream_tokens, {'type': 'delta'} events carrying the generated text are yielded as well,
+    # always before the result of their iteration.
+    # With a heartbeat, None is yielded whenever that many seconds pass without an event, which
+    # gives a streaming caller the chance to notice the client went away.
+    # Closing the generator early cancels the iterations that haven't started and returns
+    # without waiting for the running ones.
+    events = queue.Queue()
+
+    def on_token(iteration, text):
+        events.put(('delta', iteration, text))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, run.iterations)))
+    futures = {
+        executor.submit(run.run_iteration, i + 1, on_token if stream_tokens else None): i + 1
+        for i in range(run.iterations)
+    }
+    for future in futures:
+        future.add_done_callback(lambda f: events.put(('result', futures[f], f)))
+    remaining = len(futures)
+    try:
+        while remaining:
+            try:
+                kind, iteration, payload = events.get(timeout=heartbeat)
+            except queue.Empty:
+                yield None
+                continue
+            if kind == 'delta':
+                yield {'type': 'delta', 'iteration': iteration, 'delta': payload}
+                continue
+            if payload.cancelled():
+                continue
+            remaining -= 1
+            try:
+                result = payload.result()
+            except ValueError as e:
+                logging.error(f"Error during evaluation: {e}")
+                result = failed_iteration(iteration, e)
+            if run.early_stopping is not None and run.early_stopping.add(result['score']):
+                stopped = stop_early(futures)
+                remaining -= stopped
+                logging.info(f"Scores of {run.model} converged after {len(run.early_stopping.scores)} "
+                             f"iterations, {stopped} iterations skipped")
+            yield result
+    finally:
+        pending = [future for future in futures if not future.done()]
+        if pending:
+            cancelled, abandoned = record_cancellation(pending)
+            logging.info(f"Evaluation of {run.model} stopped early: {cancelled} iterations cancelled, "
+                         f"{abandoned} left to finish")
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def average_score(eval_results):
+    scores = [result["score"] for result in eval_results if result["score"] is not None]
+    return sum(scores) / len(scores) if scores else None
+
+
+def final_verdict_prompt(model, iterations):
+    return f"Final verdict for the evaluation of {model} based on the given criteria and {iterations} iterations:"
+
+
+def get_final_verdict(llm_evaluator, model, iterations):
+    prompt = final_verdict_prompt(model, iterations)
+    logging.debug(f"Sending final verdict prompt to model: {prompt}")
+    return invoke_llm(llm_evaluator, prompt)
+
+
+async def aget_final_verdict(llm_evaluator, model, iterations):
+    prompt = final_verdict_prompt(model, iterations)
+    logging.debug(f"Sending final verdict prompt to model: {prompt}")
+    return await ainvoke_llm(llm_evaluator, prompt)
+
+
+def mean_timing(result, stage):
+    values = [r['timings'][stage] for r in result.get('eval_results', []) if stage in r.get('timings', {})]
+    return sum(values) / len(values) if values else None
+
+
+def rank_models(results):
+    # Orders the results of a comparison by average score, best first, and by generation latency
+    # among equal scores. Models that failed or got no score come last.
+    ranking = []
+    for result in results:
+        entry = {
+            'model': result['model'],
+            'avg_score': result.get('avg_score'),
+            'iterations_run': result.get('iterations_run', 0),
+            'mean_generation_seconds': mean_timing(result, 'generation'),
+            'mean_judge_seconds': mean_timing(result, 'judge'),
+            'elapsed': result.get('elapsed')
+        }
+        if 'error' in result:
+            entry['error'] = result['error']
+        ranking.append(entry)
+    ranking.sort(key=lambda entry: (entry['avg_score'] is None, -(entry['avg_score'] or 0),
+                                    entry['mean_generation_seconds'] is None, entry['mean_generation_seconds'] or 0))
+    for rank, entry in enumerate(ranking, 1):
+        entry['rank'] = rank
+    return ranking
+
+
+def get_models(values):
+    # Models may be sent as repeated fields or comma separated; duplicates are dropped.
+    models = list(dict.fromkeys(model.strip() for value in values for model in value.split(',') if model.strip()))
+    if not models:
+        raise ValueError('models must name at least one model')
+    if len(models) > app.config['MAX_COMPARE_MODELS']:
+        raise ValueError(f"At most {app.config['MAX_COMPARE_MODELS']} models can be compared at once")
+    return models
+
+
+def record_run(source, run, result, elapsed=None):
+    # Saves a finished run to the results store and adds its run_id to the result. A storage error is
+    # logged rather than failing an evaluation that has already been paid for.
+    if result_store is None:
+        return
+    try:
+        result['run_id'] = result_store.record(source, {
+            'model': run.model,
+            'judge_model': run.judge_model,
+            'temperature': run.temperature,
+            'max_new_tokens': run.max_new_tokens,
+            'prompt': run.prompt,
+            'criteria': run.criteria,
+            'expected_result': run.expected_result,
+            'iterations': run.iterations,
+            'avg_score': result['avg_score'],
+            'final_verdict': result['final_verdict'],
+            'elapsed': elapsed
+        }, result['eval_results'])
+    except sqlite3.Error as e:
+        logging.error(f"Could not record the results of {run.model}: {e}")
+
+
+class BatchRow:
+    # Scheduling state for one CSV row in run_batch.
+    def __init__(self, index, exp, cache_policy=None, shared_calls=None, prescore=None, llm_evaluator=None):
+        self.index = index
+        self.exp = exp
+        self.cache_policy = cache_policy
+        self.shared_calls = shared_calls
+        self.prescore = prescore
+        self.llm_evaluator = llm_evaluator
+        self.started = time.perf_counter()
+        # Set when the final verdict comes from a checkpoint: the row was recorded by an earlier attempt.
+        self.restored = False
+        self.run = None
+        self.result = None
+        self.error = None
+        self.futures = []
+
+    def prepare(self):
+        early_stopping = parse_early_stopping(self.exp.get('tolerance'), self.exp.get('min_iterations'))
+        self.run = EvaluationRun(
+            model=self.exp['model'],
+            temperature=float(self.exp['temperature']),
+            max_new_tokens=int(self.exp['max_new_tokens']),
+            prompt=self.exp['prompt'],
+            criteria=self.exp['criteria'],
+            iterations=int(self.exp['iterations']),
+            expected_result=self.exp['expected_result'],
+            cache_policy=self.cache_policy,
+            early_stopping=early_stopping,
+            shared_calls=self.shared_calls,
+            prescore=self.exp.get('prescore') or self.prescore,
+            llm_evaluator=self.llm_evaluator
+        )
+        self.eval_results = [None] * self.run.iterations
+        self.pending = self.run.iterations
+
+    def fail(self, error):
+        self.error = error
+        for future in self.futures:
+            future.cancel()
+        self.result = {
+            'model': self.exp['model'],
+            'error': str(error)
+        }
+
+    def record(self, iteration, result):
+        # Returns True when this result makes the scores converge.
+        self.eval_results[iteration - 1] = result
+        self.pending -= 1
+        return self.run.early_stopping is not None and self.run.early_stopping.add(result['score'])
+
+    def completed_results(self):
+        # Iterations skipped by early stopping leave no result.
+        return [result for result in self.eval_results if result is not None]
+
+    def finish(self, final_verdict):
+        eval_results = self.completed_results()
+        self.result = {
+            'model': self.run.model,
+            'eval_results': eval_results,
+            'avg_score': average_score(eval_results),
+            'final_verdict': final_verdict,
+            'temperature': self.run.temperature,
+            **self.run.summary(eval_results),
+            'calls_saved': sum(sum(result.get('shared', {}).values()) for result in eval_results),
+            'elapsed': time.perf_counter() - self.started
+        }
+
+
+def run_batch(experiments, max_concurrency, cache_policy=None, max_pending_rows=None, checkpoints=None,
+              should_stop=None, prescore=None, llm_evaluator=None, in_order=True, source='upload_csv'):
+    # Schedules every (row, iteration) of a sheet on one pool of max_concurrency threads. Generation
+    # and judging are separate stages sharing it, so judge calls overlap with the next generations
+    # while the batch never runs more than max_concurrency calls at once, final verdicts included.
+    # Judge calls and final verdicts waiting for a thread go before generations, so rows finish (and
+    # converge) as early as they can instead of queueing behind the generations of later rows.
+    # Yields (index, result) pairs in row order as soon as each row, and all rows before it, is done.
+    # A ValueError fails only its row, like the sequential loop did; anything else aborts the batch.
+    # Rows are pulled from experiments lazily and at most max_pending_rows are held at once, so
+    # memory stays bounded however long the sheet is.
+    # With checkpoints, judged iterations and final verdicts are saved as they finish and saved ones
+    # are reused instead of calling the models again. should_stop is polled to abandon the batch early.
+    # Identical generations (same model, parameters and prompt) and identical judgments (same
+    # prediction, criteria and reference) are made once per batch and shared between the rows.
+    # prescore sets the local scoring rules of rows that have no prescore column of their own, and
+    # llm_evaluator a judge shared by every row. With in_order=False rows are yielded as they finish.
+    # Finished rows are recorded in the results store under source.
+    if max_pending_rows is None:
+        max_pending_rows = max(8, 2 * max_concurrency)
+    experiments = enumerate(experiments)
+    exhausted = False
+    rows = {}
+    next_row = 0
+    events = queue.Queue()
+    pool = ThreadPoolExecutor(max_workers=max_concurrency)
+    # Calls waiting for one of the pool's threads, by stage.
+    waiting = {'judge': deque(), 'generate': deque()}
+    shared_calls = SharedCalls(app.config['BATCH_DEDUPE_SIZE'])
+    outstanding = 0
+    running = 0
+
+    def submit(stage, row, iteration, fn, *args):
+        # Queues the call; its future can be cancelled until dispatch hands it to the pool.
+        nonlocal outstanding
+        future = Future()
+        row.futures.append(future)
+        outstanding += 1
+        future.add_done_callback(lambda f: events.put((stage, row, iteration, f)))
+        waiting['generate' if stage == 'generate' else 'judge'].append((future, fn, args))
+
+    def call(future, fn, args):
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def dispatch():
+        nonlocal running
+        while running < max_concurrency and (waiting['judge'] or waiting['generate']):
+            future, fn, args = (waiting['judge'] or waiting['generate']).popleft()
+            if future.set_running_or_notify_cancel():
+                running += 1
+                pool.submit(call, future, fn, args)
+
+    def admit():
+        nonlocal exhausted
+        while not exhausted and len(rows) < max_pending_rows:
+            try:
+                index, exp = next(experiments)
+            except StopIteration:
+                exhausted = True
+                return
+            row = rows[index] = BatchRow(index, exp, cache_policy, shared_calls, prescore, llm_evaluator)
+            try:
+                row.prepare()
+            except ValueError as e:
+                row.fail(e)
+                continue
+            for i in range(row.run.iterations):
+                if row.run.early_stopping is not None and row.run.early_stopping.converged:
+                    metrics.EARLY_STOPS.inc()
+                    row.pending -= 1
+                    continue
+                saved = checkpoints.get(index, i + 1) if checkpoints else None
+                if saved is None:
+                    submit('generate', row, i + 1, row.run.generate, i + 1)
+                elif row.record(i + 1, saved):
+                    row.pending -= stop_early(row.futures)
+            if row.pending <= 0:
+                submit_final_verdict(row)
+
+    def next_finished():
+        if in_order:
+            return next_row if next_row in rows and rows[next_row].result is not None else None
+        return next((index for index, row in rows.items() if row.result is not None), None)
+
+    def submit_final_verdict(row):
+        saved = checkpoints.get(row.index, VERDICT) if checkpoints else None
+        if saved is not None:
+            row.finish(saved)
+            row.restored = True
+        else:
+            submit('verdict', row, None, row.run.final_verdict, len(row.completed_results()))
+
+    try:
+        while True:
+            if should_stop and should_stop():
+                logging.info(f"Batch stopped with {outstanding} calls outstanding")
+                return
+            admit()
+            dispatch()
+            finished = next_finished()
+            if finished is not None:
+                row = rows.pop(finished)
+                if row.error is None and not row.restored:
+                    record_run(source, row.run, row.result, row.result['elapsed'])
+                yield finished, row.result
+                next_row += 1
+                continue
+            if not outstanding:
+                break
+
+            try:
+                stage, row, iteration, future = events.get(timeout=0.5 if should_stop else None)
+            except queue.Empty:
+                continue
+            outstanding -= 1
+            if future.cancelled():
+                continue
+            running -= 1
+            if row.error is not None:
+                continue
+            try:
+                value = future.result()
+            except ValueError as e:
+                logging.error(f"Error during evaluation of row {row.index + 1}: {e}")
+                row.fail(e)
+                continue
+
+            if stage == 'generate':
+                prediction, cached = value
+                submit('judge', row, iteration, row.run.judge, prediction, iteration, cached)
+            elif stage == 'judge':
+                if checkpoints:
+                    checkpoints.put(row.index, iteration, value)
+                if row.record(iteration, value):
+                    row.pending -= stop_early(row.futures)
+                if not row.pending:
+                    submit_final_verdict(row)
+            else:
+                if checkpoints:
+                    checkpoints.put(row.index, VERDICT, value)
+                row.finish(value)
+    finally:
+        # Only reached with calls outstanding when the batch is abandoned: a cancelled job or a client
+        # that disconnected from a streamed upload.
+        if outstanding:
+            cancelled, abandoned = record_cancellation(
+                [future for row in rows.values() for future in row.futures])
+            logging.info(f"Batch stopped early: {cancelled} calls cancelled, {abandoned} left to finish")
+        pool.shutdown(wait=False, cancel_futures=True)
+        saved = shared_calls.stats()
+        for stage, count in saved.items():
+            metrics.DEDUPLICATED.inc(count, stage=stage)
+        if saved:
+            logging.info(f"Batch shared identical calls: {saved.get('generation', 0)} generations and "
+                         f"{saved.get('judgment', 0)} judgments saved")
+
+
+def run_job(job, experiments, checkpoints, should_stop):
+    options = job['options']
+    return run_batch(experiments, get_max_concurrency(options.get('max_concurrency')),
+                     options.get('cache'), checkpoints=checkpoints, should_stop=should_stop,
+                     prescore=options.get('prescore'), source='job')
+
+
+def get_job_manager():
+    # Jobs left behind by a worker that died are resumed as soon as the manager is created.
+    global job_manager
+    with job_manager_lock:
+        if job_manager is None:
+            job_manager = JobManager(JobStore(app.config['JOB_STORE_PATH']), run_job, app.config['JOB_WORKERS'])
+            job_manager.resume_interrupted()
+        return job_manager
+
+
+# Created with the app, so a restarted server picks up interrupted jobs without waiting for a job request.
+get_job_manager()
 
 
 @app.route('/')
@@ -74,6 +952,30 @@ def index():
     return render_template('index.html')
 
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'llm_clients': llm_clients.stats(),
+        'evaluators': evaluators.stats(),
+        'response_cache': response_cache.stats(),
+        'cancellations': {kind: metrics.CANCELLATIONS.get(kind=kind)
+                          for kind in ('disconnects', 'cancelled_calls', 'abandoned_calls')},
+        'deduplicated': {stage: metrics.DEDUPLICATED.get(stage=stage) for stage in ('generation', 'judgment')}
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    for registry in (llm_clients, evaluators):
+        registry_stats = registry.stats()
+        metrics.REGISTRY_ENTRIES.set(registry_stats['size'], registry=registry.name)
+        for result in ('hits', 'misses', 'evictions'):
+            metrics.REGISTRY_LOOKUPS.set(registry_stats[result], registry=registry.name, result=result)
+    for result, value in response_cache.stats().items():
+        metrics.RESPONSE_CACHE.set(value, result=result)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
 @app.route('/evaluate', methods=['POST'])
 def evaluate():
     required_fields = ['model', 'temperature', 'max_new_tokens', 'prompt', 'criteria', 'iterations', 'expected_result']
@@ -90,91 +992,34 @@ def evaluate():
         criteria = request.form['criteria']
         iterations = int(request.form['iterations'])
         expected_result = request.form['expected_result']
-
-
+        max_concurrency = get_max_concurrency(request.form.get('max_concurrency'))
+        cache_policy = get_cache_policy(request.form.get('cache'))
+        early_stopping = parse_early_stopping(request.form.get('tolerance'), request.form.get('min_iterations'))
+        prescore = get_prescore_rules(request.form.get('prescore'))
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
-    accuracy_criteria = {
-        "accuracy": criteria
-    }
-
-    llm_evaluator = BedrockChat(model_id="meta.llama3-70b-instruct-v1:0") if model != "llama_3_70b" else BedrockChat(
-        model_id="anthropic.claude-v2")
-
-    evaluator = load_evaluator(
-        "labeled_score_string",
-        # https://api.python.langchain.com/en/latest/evaluation/langchain.evaluation.schema.EvaluatorType.html "The labeled scored string evaluator, which gives a score between 1 and 10 to a prediction based on a ground truth reference label."
-        llm=llm_evaluator,
-        criteria=accuracy_criteria
-    )
-
-    llm = get_llm(model, temperature, max_new_tokens)
-    eval_results = []
+    started = time.perf_counter()
+    run = EvaluationRun(model, temperature, max_new_tokens, prompt, criteria, iterations, expected_result,
+                        cache_policy, early_stopping, prescore=prescore)
+    eval_results = sorted(run_iterations(run, max_concurrency), key=lambda result: result['iteration'])
+    avg_score = average_score(eval_results)
 
-    for i in range(iterations):
-        try:
-            if isinstance(llm, (ChatOpenAI, BedrockChat)):
-                messages = [HumanMessage(content=prompt)]
-                logging.debug(f"Sending messages to model: {messages}")
-                response = llm(messages)
-                prediction = response[0].content if isinstance(response, list) else response.content
-            elif isinstance(llm, BedrockLLM):
-                logging.debug(f"Sending prompt to model: {prompt}")
-                prediction = llm(prompt)
-            else:
-                logging.debug(f"Sending prompt to model: {prompt}")
-                prediction = llm(prompt)
-
-            logging.debug(f"Received prediction: {prediction}")
-
-            eval_result = evaluator.evaluate_strings(prediction=prediction, input=prompt,
-                                                     reference=expected_result
-                                                     )
-            score_match = re.search(r'\[\[(\d+)]]', eval_result['reasoning'])
-            score = int(score_match.group(1)) if score_match else None
-            eval_results.append({
-                'iteration': i + 1,
-                'prediction': prediction,
-                'score': score,
-                'reason': eval_result['reasoning']
-            })
-        except ValueError as e:
-            logging.error(f"Error during evaluation: {e}")
-            eval_results.append({
-                'iteration': i + 1,
-                'prediction': None,
-                'score': None,
-                'reason': str(e)
-            })
-
-    scores = [result["score"] for result in eval_results if result["score"] is not None]
-    avg_score = sum(scores) / len(scores) if scores else None
-
-    final_verdict_prompt = f"Final verdict for the evaluation of {model} based on the given criteria and {iterations} iterations:"
     try:
-        if isinstance(llm_evaluator, (ChatOpenAI, BedrockChat)):
-            final_verdict_messages = [HumanMessage(content=final_verdict_prompt)]
-            logging.debug(f"Sending final verdict prompt to model: {final_verdict_messages}")
-            final_verdict_response = llm_evaluator(final_verdict_messages)
-            final_verdict = final_verdict_response.content if not isinstance(final_verdict_response, list) else \
-                final_verdict_response[0].content
-        elif isinstance(llm_evaluator, BedrockLLM):
-            logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-            final_verdict = llm_evaluator(final_verdict_prompt)
-        else:
-            logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-            final_verdict = llm_evaluator(final_verdict_prompt)
+        final_verdict = run.final_verdict(len(eval_results))
     except ValueError as e:
         logging.error(f"Error during final verdict generation: {e}")
         final_verdict = str(e)
 
-    return jsonify({
+    result = {
         'eval_results': eval_results,
         'avg_score': avg_score,
         'final_verdict': final_verdict,
-        'temperature': temperature
-    })
+        'temperature': temperature,
+        **run.summary(eval_results)
+    }
+    record_run('evaluate', run, result, time.perf_counter() - started)
+    return jsonify(result)
 
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
@@ -195,94 +1040,245 @@ def upload_csv():
         except Exception as e:
             return jsonify({'error': str(e)}), 400
 
-        results = []
-        for exp in experiments:
-            try:
-                model = exp['model']
-                temperature = float(exp['temperature'])
-                max_new_tokens = int(exp['max_new_tokens'])
-                prompt = exp['prompt']
-                criteria = exp['criteria']
-                iterations = int(exp['iterations'])
-                expected_result = exp['expected_result']
-
-                accuracy_criteria = {
-                    "accuracy": criteria
-                }
-                llm_evaluator = BedrockChat(
-                    model_id="meta.llama3-70b-instruct-v1:0") if model != "llama_3_70b" else BedrockChat(
-                    model_id="anthropic.claude-v2")
-
-                evaluator = load_evaluator(
-                    "labeled_score_string",
-                    # https://api.python.langchain.com/en/latest/evaluation/langchain.evaluation.schema.EvaluatorType.html "The labeled scored string evaluator, which gives a score between 1 and 10 to a prediction based on a ground truth reference label."
-                    llm=llm_evaluator,
-                    criteria=accuracy_criteria
-                )
-
-                llm = get_llm(model, temperature, max_new_tokens)
-                eval_results = []
-
-                for i in range(iterations):
-                    if isinstance(llm, (ChatOpenAI, BedrockChat, WatsonxLLM)):
-                        messages = [HumanMessage(content=prompt)]
-                        logging.debug(f"Sending messages to model: {messages}")
-                        response = llm(messages)
-                        prediction = response[0].content if isinstance(response, list) else response.content
-                    elif isinstance(llm, BedrockLLM):
-                        logging.debug(f"Sending prompt to model: {prompt}")
-                        prediction = llm(prompt)
-                    else:
-                        logging.debug(f"Sending prompt to model: {prompt}")
-                        prediction = llm(prompt)
-
-                    logging.debug(f"Received prediction: {prediction}")
-
-                    eval_result = evaluator.evaluate_strings(prediction=prediction, input=prompt,
-                                                             reference=expected_result)
-                    score_match = re.search(r'\[\[(\d+)]]', eval_result['reasoning'])
-                    score = int(score_match.group(1)) if score_match else None
-                    eval_results.append({
-                        'iteration': i + 1,
-                        'prediction': prediction,
-                        'score': score,
-                        'reason': eval_result['reasoning']
-                    })
-
-                scores = [result["score"] for result in eval_results if result["score"] is not None]
-                avg_score = sum(scores) / len(scores) if scores else None
-
-                final_verdict_prompt = f"Final verdict for the evaluation of {model} based on the given criteria and {iterations} iterations:"
-                if isinstance(llm_evaluator, (ChatOpenAI, BedrockChat)):
-                    final_verdict_messages = [HumanMessage(content=final_verdict_prompt)]
-                    logging.debug(f"Sending final verdict prompt to model: {final_verdict_messages}")
-                    final_verdict_response = llm_evaluator(final_verdict_messages)
-                    final_verdict = final_verdict_response.content if not isinstance(final_verdict_response, list) else \
-                        final_verdict_response[0].content
-                elif isinstance(llm_evaluator, (BedrockLLM, WatsonxLLM)):
-                    logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-                    final_verdict = llm_evaluator(final_verdict_prompt)
-                else:
-                    logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-                    final_verdict = llm_evaluator(final_verdict_prompt)
-
-                results.append({
-                    'model': model,
-                    'eval_results': eval_results,
-                    'avg_score': avg_score,
-                    'final_verdict': final_verdict,
-                    'temperature': temperature
-                })
-            except ValueError as e:
-                results.append({
-                    'model': exp['model'],
-                    'error': str(e)
-                })
+        try:
+            max_concurrency = get_max_concurrency(request.form.get('max_concurrency'))
+            cache_policy = get_cache_policy(request.form.get('cache'))
+            prescore = get_prescore_rules(request.form.get('prescore'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
+        results = [result for _, result in run_batch(experiments, max_concurrency, cache_policy, prescore=prescore)]
         return jsonify(results)
     else:
         return jsonify({'error': 'Invalid file format. Please upload a CSV file.'}), 400
 
+@app.route('/upload_csv_stream', methods=['POST'])
+def upload_csv_stream():
+    # Same evaluation as /upload_csv, but the sheet is parsed as it is read and every row's result
+    # is sent as a line of NDJSON as soon as it (and every row before it) is done.
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part in the request'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not file.filename.endswith('.csv'):
+        return jsonify({'error': 'Invalid file format. Please upload a CSV file.'}), 400
+
+    try:
+        max_concurrency = get_max_concurrency(request.form.get('max_concurrency'))
+        cache_policy = get_cache_policy(request.form.get('cache'))
+        prescore = get_prescore_rules(request.form.get('prescore'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Flask closes uploaded files when the view returns, before the response is streamed, so the
+    # upload is copied in chunks to a temporary file that the generator owns.
+    upload = tempfile.TemporaryFile()
+    shutil.copyfileobj(file.stream, upload)
+    upload.seek(0)
+
+    def generate():
+        try:
+            reader = csv.DictReader(io.TextIOWrapper(upload, encoding='utf-8', newline=''))
+            for index, result in run_batch(reader, max_concurrency, cache_policy, prescore=prescore):
+                yield (json.dumps({'row': index + 1, **result}) + '\n').encode()
+        except (UnicodeDecodeError, csv.Error) as e:
+            yield (json.dumps({'error': str(e)}) + '\n').encode()
+        finally:
+            upload.close()
+
+    return Response(generate(), content_type='application/x-ndjson')
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part in the request'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    if not file.filename.endswith('.csv'):
+        return jsonify({'error': 'Invalid file format. Please upload a CSV file.'}), 400
+
+    try:
+        options = {
+            'max_concurrency': get_max_concurrency(request.form.get('max_concurrency')),
+            'cache': get_cache_policy(request.form.get('cache')),
+            # Stored as sent, since checked rules hold compiled patterns.
+            'prescore': request.form.get('prescore') or None
+        }
+        get_prescore_rules(options['prescore'])
+        reader = csv.DictReader(io.TextIOWrapper(file.stream, encoding='utf-8', newline=''))
+        job_id = get_job_manager().submit(reader, options)
+    except (ValueError, csv.Error) as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(get_job_manager().store.get(job_id)), 202
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job_manager().store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    manager = get_job_manager()
+    if manager.store.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        last = None
+        sent = time.monotonic()
+        while True:
+            job = manager.store.get(job_id)
+            progress = (job['status'], job['completed_rows'], job['completed_iterations'])
+            if progress != last:
+                last = progress
+                sent = time.monotonic()
+                yield f"data: {json.dumps(job)}\n\n".encode()
+            elif time.monotonic() - sent >= app.config['STREAM_HEARTBEAT']:
+                # As in /evaluate_stream: writing to a closed connection ends the generator, so a client
+                # that went away while the job makes no progress doesn't keep this thread polling.
+                sent = time.monotonic()
+                yield b": keep-alive\n\n"
+            if job['status'] in FINISHED:
+                return
+            time.sleep(1)
+
+    return Response(generate(), content_type='text/event-stream')
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    manager = get_job_manager()
+    if manager.store.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not manager.cancel(job_id):
+        return jsonify({'error': 'Job is not running'}), 409
+    return jsonify(manager.store.get(job_id))
+
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    manager = get_job_manager()
+    job = manager.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != COMPLETED and manager.store.held_elsewhere(job_id):
+        return jsonify({'error': 'Job is still held by another worker process'}), 409
+    if job['status'] == COMPLETED or not manager.resume(job_id):
+        return jsonify({'error': f"Job is {job['status']}"}), 409
+    return jsonify(manager.store.get(job_id)), 202
+
+
+@app.route('/jobs/<job_id>/results')
+def job_results(job_id):
+    manager = get_job_manager()
+    job = manager.store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'results': list(manager.store.results(job_id))
+    })
+
+def results_query_args():
+    # Filters shared by the results endpoints; since and until are Unix timestamps.
+    args = request.args
+    return {
+        'model': args.get('model') or None,
+        'since': float(args['since']) if args.get('since') else None,
+        'until': float(args['until']) if args.get('until') else None,
+    }
+
+
+def results_limit(default=100, maximum=1000):
+    limit = int(request.args.get('limit', default))
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+    return min(limit, maximum)
+
+
+@app.route('/results/models')
+def results_models():
+    # Running aggregates per model, read from the aggregate table rather than the history.
+    if result_store is None:
+        return jsonify({'error': 'The results store is disabled'}), 404
+    return jsonify(result_store.model_stats(request.args.get('model') or None))
+
+
+@app.route('/results/prompts')
+def results_prompts():
+    # Running aggregates per (prompt, model): pass prompt_hash to compare the models run on a prompt.
+    if result_store is None:
+        return jsonify({'error': 'The results store is disabled'}), 404
+    try:
+        stats = result_store.prompt_stats(request.args.get('prompt_hash') or None, request.args.get('model') or None,
+                                          results_limit())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(stats)
+
+
+@app.route('/results/runs')
+def results_runs():
+    # Recorded runs, newest first. Pass the smallest id of a page as before to get the next one.
+    if result_store is None:
+        return jsonify({'error': 'The results store is disabled'}), 404
+    try:
+        runs = result_store.runs(prompt_hash=request.args.get('prompt_hash') or None,
+                                 source=request.args.get('source') or None,
+                                 before=int(request.args['before']) if request.args.get('before') else None,
+                                 limit=results_limit(), **results_query_args())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(runs)
+
+
+@app.route('/results/runs/<int:run_id>')
+def results_run(run_id):
+    if result_store is None:
+        return jsonify({'error': 'The results store is disabled'}), 404
+    run = result_store.run(run_id)
+    if run is None:
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run)
+
+
+@app.route('/results/export')
+def results_export():
+    # Every recorded iteration with its run's columns, as a Parquet file. text=0 leaves out the
+    # predictions and the judge's reasoning.
+    if result_store is None:
+        return jsonify({'error': 'The results store is disabled'}), 404
+    try:
+        filters = results_query_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    include_text = request.args.get('text', '1').lower() not in ('0', 'false', 'no')
+
+    export = tempfile.TemporaryFile()
+    try:
+        rows = result_store.export_parquet(export, include_text=include_text, **filters)
+    except ImportError:
+        export.close()
+        return jsonify({'error': 'Exporting results needs the pyarrow package'}), 501
+    except BaseException:
+        export.close()
+        raise
+    logging.info(f"Exported {rows} result rows")
+    export.seek(0)
+    return send_file(export, mimetype='application/vnd.apache.parquet', as_attachment=True,
+                     download_name='results.parquet')
+
 @app.route('/evaluate_stream', methods=['POST'])
 def evaluate_stream():
     @stream_with_context
@@ -291,6 +1287,7 @@ def evaluate_stream():
         for field in required_fields:
             if field not in request.form:
                 yield f"data: {json.dumps({'error': f'Missing required field: {field}'})}\n\n".encode()
+                return
 
         try:
             model = request.form['model']
@@ -300,95 +1297,103 @@ def evaluate_stream():
             criteria = request.form['criteria']
             iterations = int(request.form['iterations'])
             expected_result = request.form['expected_result']
+            max_concurrency = get_max_concurrency(request.form.get('max_concurrency'))
+            cache_policy = get_cache_policy(request.form.get('cache'))
+            stream_tokens = request.form.get('stream_tokens', '').lower() in ('1', 'true', 'on', 'yes')
+            early_stopping = parse_early_stopping(request.form.get('tolerance'), request.form.get('min_iterations'))
+            prescore = get_prescore_rules(request.form.get('prescore'))
         except ValueError as e:
             yield f"data: {json.dumps({'error': str(e)})}\n\n".encode()
+            return
 
-        accuracy_criteria = {"accuracy": criteria}
-
-        llm_evaluator = BedrockChat(
-            model_id="meta.llama3-70b-instruct-v1:0") if model != "llama_3_70b" else BedrockChat(
-            model_id="anthropic.claude-v2")
-
-        evaluator = load_evaluator(
-            "labeled_score_string",
-            llm=llm_evaluator,
-            criteria=accuracy_criteria
-        )
-
-        llm = get_llm(model, temperature, max_new_tokens)
+        started = time.perf_counter()
+        run = EvaluationRun(model, temperature, max_new_tokens, prompt, criteria, iterations, expected_result,
+                            cache_policy, early_stopping, prescore=prescore)
         eval_results = []
 
-        for i in range(iterations):
-            try:
-                if isinstance(llm, (ChatOpenAI, BedrockChat)):
-                    messages = [HumanMessage(content=prompt)]
-                    logging.debug(f"Sending messages to model: {messages}")
-                    response = llm(messages)
-                    prediction = response[0].content if isinstance(response, list) else response.content
-                elif isinstance(llm, BedrockLLM):
-                    logging.debug(f"Sending prompt to model: {prompt}")
-                    prediction = llm(prompt)
-                elif isinstance(llm, WatsonxLLM):
-                    logging.debug(f"Sending prompt to model: {prompt}")
-                    prediction = llm.invoke(prompt)
-                else:
-                    logging.debug(f"Sending prompt to model: {prompt}")
-                    prediction = llm(prompt)
-
-                logging.debug(f"Received prediction: {prediction}")
-
-                eval_result = evaluator.evaluate_strings(prediction=prediction, input=prompt,
-                                                         reference=expected_result)
-                score_match = re.search(r'\[\[(\d+)]]', eval_result['reasoning'])
-                score = int(score_match.group(1)) if score_match else None
-                result = {
-                    'iteration': i + 1,
-                    'prediction': prediction,
-                    'score': score,
-                    'reason': eval_result['reasoning']
-                }
-                eval_results.append(result)
-            except ValueError as e:
-                logging.error(f"Error during evaluation: {e}")
-                result = {
-                    'iteration': i + 1,
-                    'prediction': None,
-                    'score': None,
-                    'reason': str(e)
-                }
-                eval_results.append(result)
-
-            yield f"data: {json.dumps(result)}\n\n".encode()
+        # Each iteration is sent as soon as it finishes, so events may arrive out of order. While
+        # waiting, a keep-alive comment is sent every few seconds: writing to a closed connection is
+        # how a disconnect is detected, which closes this generator and cancels the pending iterations.
+        iterations = run_iterations(run, max_concurrency, heartbeat=app.config['STREAM_HEARTBEAT'],
+                                    stream_tokens=stream_tokens)
+        try:
+            for result in iterations:
+                if result is None:
+                    yield b": keep-alive\n\n"
+                    continue
+                if result.get('type') != 'delta':
+                    eval_results.append(result)
+                yield f"data: {json.dumps(result)}\n\n".encode()
+        except GeneratorExit:
+            metrics.CANCELLATIONS.inc(kind='disconnects')
+            logging.info(f"Client disconnected from the evaluation of {model}, skipping the final verdict")
+            raise
+        finally:
+            iterations.close()
 
-        scores = [result["score"] for result in eval_results if result["score"] is not None]
-        avg_score = sum(scores) / len(scores) if scores else None
+        eval_results.sort(key=lambda result: result['iteration'])
+        avg_score = average_score(eval_results)
 
-        final_verdict_prompt = f"Final verdict for the evaluation of {model} based on the given criteria and {iterations} iterations:"
         try:
-            if isinstance(llm_evaluator, (ChatOpenAI, BedrockChat)):
-                final_verdict_messages = [HumanMessage(content=final_verdict_prompt)]
-                logging.debug(f"Sending final verdict prompt to model: {final_verdict_messages}")
-                final_verdict_response = llm_evaluator(final_verdict_messages)
-                final_verdict = final_verdict_response.content if not isinstance(final_verdict_response, list) else \
-                    final_verdict_response[0].content
-            elif isinstance(llm_evaluator, BedrockLLM):
-                logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-                final_verdict = llm_evaluator(final_verdict_prompt)
-            elif isinstance(llm_evaluator, WatsonxLLM):
-                logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-                final_verdict = llm_evaluator.invoke(final_verdict_prompt)
-            else:
-                logging.debug(f"Sending final verdict prompt to model: {final_verdict_prompt}")
-                final_verdict = llm_evaluator(final_verdict_prompt)
+            final_verdict = run.final_verdict(len(eval_results))
         except ValueError as e:
             logging.error(f"Error during final verdict generation: {e}")
             final_verdict = str(e)
 
-        yield f"data: {json.dumps({'eval_results': eval_results, 'avg_score': avg_score, 'final_verdict': final_verdict, 'temperature': temperature})}\n\n".encode()
+        result = {'eval_results': eval_results, 'avg_score': avg_score, 'final_verdict': final_verdict,
+                  'temperature': temperature, **run.summary(eval_results)}
+        record_run('evaluate_stream', run, result, time.perf_counter() - started)
+        yield f"data: {json.dumps(result)}\n\n".encode()
 
     return Response(generate(), content_type='text/event-stream')
 
 
+@app.route('/compare', methods=['POST'])
+def compare():
+    # Runs the same prompt, criteria and expected result on several models at once, with one judge
+    # shared by all of them. Each model's result is sent as soon as it is done, in completion order,
+    # followed by a ranking of the models with their latencies.
+    required_fields = ['models', 'temperature', 'max_new_tokens', 'prompt', 'criteria', 'iterations', 'expected_result']
+    for field in required_fields:
+        if field not in request.form:
+            return jsonify({'error': f'Missing required field: {field}'}), 400
+
+    try:
+        models = get_models(request.form.getlist('models'))
+        float(request.form['temperature'])
+        int(request.form['max_new_tokens'])
+        int(request.form['iterations'])
+        parse_early_stopping(request.form.get('tolerance'), request.form.get('min_iterations'))
+        max_concurrency = get_max_concurrency(request.form.get('max_concurrency'))
+        cache_policy = get_cache_policy(request.form.get('cache'))
+        prescore = get_prescore_rules(request.form.get('prescore'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    shared_fields = ['temperature', 'max_new_tokens', 'prompt', 'criteria', 'iterations', 'expected_result',
+                     'tolerance', 'min_iterations']
+    experiments = [{'model': model, **{field: request.form.get(field) for field in shared_fields}}
+                   for model in models]
+    llm_evaluator = get_shared_judge(models)
+
+    def generate():
+        results = []
+        batch = run_batch(experiments, max_concurrency, cache_policy, max_pending_rows=len(experiments),
+                          prescore=prescore, llm_evaluator=llm_evaluator, in_order=False, source='compare')
+        try:
+            for _, result in batch:
+                results.append(result)
+                yield f"data: {json.dumps(result)}\n\n".encode()
+        except GeneratorExit:
+            metrics.CANCELLATIONS.inc(kind='disconnects')
+            logging.info(f"Client disconnected from the comparison of {', '.join(models)}")
+            raise
+        finally:
+            batch.close()
+        yield f"data: {json.dumps({'ranking': rank_models(results)})}\n\n".encode()
+
+    return Response(generate(), content_type='text/event-stream')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,339 @@
+"""ASGI entry point with an asyncio evaluation engine.
+
+/evaluate, /evaluate_stream and /upload_csv take and return the same data as the Flask views, but
+run every iteration as a task on one event loop and call the models through their clients' async
+APIs. A request then holds no thread while it waits on a provider, so a single process can serve
+hundreds of evaluations at once. Every other route is served by the Flask app, mounted below.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import csv
+import json
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as flask_app
+import metrics
+from app import (BatchRow, EvaluationRun, average_score, failed_iteration, get_cache_policy, get_max_concurrency,
+                 get_prescore_rules, record_run)
+from dedupe import AsyncSharedCalls
+from stopping import parse_early_stopping
+
+REQUIRED_FIELDS = ['model', 'temperature', 'max_new_tokens', 'prompt', 'criteria', 'iterations', 'expected_result']
+
+
+class BatchSlots:
+    """The max_concurrency calls a batch may run at once, shared by its stages.
+
+    A freed slot goes to a waiting judge call or final verdict before a generation, as run_batch
+    dispatches them, so rows finish (and converge) without queueing behind later generations.
+    """
+
+    def __init__(self, size):
+        self.free = size
+        self.waiting = {'judge': deque(), 'generate': deque()}
+
+    @asynccontextmanager
+    async def take(self, stage):
+        if self.free > 0 and not (self.waiting['judge'] or self.waiting['generate']):
+            self.free -= 1
+        else:
+            slot = asyncio.get_running_loop().create_future()
+            self.waiting[stage].append(slot)
+            try:
+                await slot
+            except asyncio.CancelledError:
+                # Cancelled just after the slot was handed over: pass it on.
+                if slot.done() and not slot.cancelled():
+                    self.release()
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        for waiting in (self.waiting['judge'], self.waiting['generate']):
+            while waiting:
+                slot = waiting.popleft()
+                if not slot.done():
+                    slot.set_result(None)
+                    return
+        self.free += 1
+
+
+def cancel_waiting(tasks, started):
+    # Cancels the iterations that haven't started, as stop_early does with futures.
+    return sum(1 for iteration, task in tasks.items() if iteration not in started and task.cancel())
+
+
+async def arun_iterations(run, max_concurrency, heartbeat=None, stream_tokens=False):
+    # The asyncio counterpart of run_iterations, with the same events: results in completion order,
+    # {'type': 'delta'} events with stream_tokens, and None every heartbeat seconds without one.
+    # At most max_concurrency iterations run at once. Closing the generator cancels every iteration
+    # still running, since a cancelled task stops waiting on its provider call.
+    events = asyncio.Queue()
+    slots = asyncio.Semaphore(max_concurrency)
+    started = set()
+
+    def on_token(iteration, text):
+        events.put_nowait(('delta', iteration, text))
+
+    async def iterate(iteration):
+        async with slots:
+            started.add(iteration)
+            try:
+                result = await run.arun_iteration(iteration, on_token if stream_tokens else None)
+            except ValueError as e:
+                logging.error(f"Error during evaluation: {e}")
+                result = failed_iteration(iteration, e)
+            except Exception as e:
+                events.put_nowait(('error', iteration, e))
+                return
+        events.put_nowait(('result', iteration, result))
+
+    tasks = {i + 1: asyncio.create_task(iterate(i + 1)) for i in range(run.iterations)}
+    remaining = len(tasks)
+    try:
+        while remaining:
+            try:
+                kind, iteration, payload = await asyncio.wait_for(events.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if kind == 'delta':
+                yield {'type': 'delta', 'iteration': iteration, 'delta': payload}
+                continue
+            if kind == 'error':
+                raise payload
+            remaining -= 1
+            if run.early_stopping is not None and run.early_stopping.add(payload['score']):
+                stopped = cancel_waiting(tasks, started)
+                metrics.EARLY_STOPS.inc(stopped)
+                remaining -= stopped
+                logging.info(f"Scores of {run.model} converged after {len(run.early_stopping.scores)} "
+                             f"iterations, {stopped} iterations skipped")
+            yield payload
+    finally:
+        cancelled = sum(1 for task in tasks.values() if task.cancel())
+        if cancelled:
+            metrics.CANCELLATIONS.inc(cancelled, kind='cancelled_calls')
+            logging.info(f"Evaluation of {run.model} stopped early: {cancelled} iterations cancelled")
+
+
+async def arun_batch(experiments, max_concurrency, cache_policy=None, max_pending_rows=None, prescore=None,
+                     source='upload_csv'):
+    # The asyncio counterpart of run_batch: generations, judgments and final verdicts share one limit of
+    # max_concurrency calls across every row, judge calls first, identical calls are made once per batch,
+    # and (index, result) pairs are yielded in row order. At most max_pending_rows rows are started ahead of the one yielded next.
+    if max_pending_rows is None:
+        max_pending_rows = max(8, 2 * max_concurrency)
+    slots = BatchSlots(max_concurrency)
+    shared_calls = AsyncSharedCalls(flask_app.app.config['BATCH_DEDUPE_SIZE'])
+
+    async def evaluate_row(index, exp):
+        row = BatchRow(index, exp, cache_policy, shared_calls, prescore)
+        started = set()
+
+        async def iterate(iteration):
+            async with slots.take('generate'):
+                started.add(iteration)
+                prediction, cached = await row.run.agenerate(iteration)
+            async with slots.take('judge'):
+                return iteration, await row.run.ajudge(prediction, iteration, cached)
+
+        tasks = {}
+        try:
+            # Building the clients may import a provider SDK, which is done off the event loop.
+            await asyncio.to_thread(row.prepare)
+            tasks = {i + 1: asyncio.create_task(iterate(i + 1)) for i in range(row.run.iterations)}
+            pending = set(tasks.values())
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():  # skipped by early stopping
+                        continue
+                    if row.record(*task.result()):
+                        metrics.EARLY_STOPS.inc(cancel_waiting(tasks, started))
+            async with slots.take('judge'):
+                final_verdict = await row.run.afinal_verdict(len(row.completed_results()))
+        except ValueError as e:
+            logging.error(f"Error during evaluation of row {index + 1}: {e}")
+            row.fail(e)
+            return row.result
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        row.finish(final_verdict)
+        await asyncio.to_thread(record_run, source, row.run, row.result, row.result['elapsed'])
+        return row.result
+
+    window = deque()
+    try:
+        for index, exp in enumerate(experiments):
+            window.append((index, asyncio.create_task(evaluate_row(index, exp))))
+            if len(window) >= max_pending_rows:
+                index, task = window.popleft()
+                yield index, await task
+        while window:
+            index, task = window.popleft()
+            yield index, await task
+    finally:
+        cancelled = sum(1 for _, task in window if task.cancel())
+        if cancelled:
+            logging.info(f"Batch stopped early: {cancelled} rows cancelled")
+        saved = shared_calls.stats()
+        for stage, count in saved.items():
+            metrics.DEDUPLICATED.inc(count, stage=stage)
+        if saved:
+            logging.info(f"Batch shared identical calls: {saved.get('generation', 0)} generations and "
+                         f"{saved.get('judgment', 0)} judgments saved")
+
+
+def missing_field(form):
+    return next((field for field in REQUIRED_FIELDS if field not in form), None)
+
+
+def run_options(form, max_new_tokens_type):
+    # The evaluation fields of a form, parsed as the Flask views parse them. Raises ValueError.
+    return {
+        'model': form['model'],
+        'temperature': float(form['temperature']),
+        'max_new_tokens': max_new_tokens_type(form['max_new_tokens']),
+        'prompt': form['prompt'],
+        'criteria': form['criteria'],
+        'iterations': int(form['iterations']),
+        'expected_result': form['expected_result'],
+        'cache_policy': get_cache_policy(form.get('cache')),
+        'early_stopping': parse_early_stopping(form.get('tolerance'), form.get('min_iterations')),
+        'prescore': get_prescore_rules(form.get('prescore')),
+    }
+
+
+async def finish_run(source, run, eval_results, started):
+    eval_results.sort(key=lambda result: result['iteration'])
+    try:
+        final_verdict = await run.afinal_verdict(len(eval_results))
+    except ValueError as e:
+        logging.error(f"Error during final verdict generation: {e}")
+        final_verdict = str(e)
+
+    result = {
+        'eval_results': eval_results,
+        'avg_score': average_score(eval_results),
+        'final_verdict': final_verdict,
+        'temperature': run.temperature,
+        **run.summary(eval_results)
+    }
+    await asyncio.to_thread(record_run, source, run, result, time.perf_counter() - started)
+    return result
+
+
+async def evaluate(request):
+    async with request.form() as form:
+        field = missing_field(form)
+        if field is not None:
+            return JSONResponse({'error': f'Missing required field: {field}'}, 400)
+        try:
+            options = run_options(form, float)
+            max_concurrency = get_max_concurrency(form.get('max_concurrency'))
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, 400)
+
+    started = time.perf_counter()
+    run = await asyncio.to_thread(lambda: EvaluationRun(**options))
+    eval_results = [result async for result in arun_iterations(run, max_concurrency)]
+    return JSONResponse(await finish_run('evaluate', run, eval_results, started))
+
+
+def event(data):
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+async def evaluate_stream(request):
+    async with request.form() as form:
+        field = missing_field(form)
+        error = f'Missing required field: {field}' if field is not None else None
+        if error is None:
+            try:
+                options = run_options(form, int)
+                max_concurrency = get_max_concurrency(form.get('max_concurrency'))
+                stream_tokens = form.get('stream_tokens', '').lower() in ('1', 'true', 'on', 'yes')
+            except ValueError as e:
+                error = str(e)
+
+    async def generate():
+        if error is not None:
+            yield event({'error': error})
+            return
+
+        started = time.perf_counter()
+        run = await asyncio.to_thread(lambda: EvaluationRun(**options))
+        eval_results = []
+        # A client that goes away cancels this generator (or fails the next write, keep-alives
+        # included), which cancels every iteration still running.
+        iterations = arun_iterations(run, max_concurrency, heartbeat=flask_app.app.config['STREAM_HEARTBEAT'],
+                                     stream_tokens=stream_tokens)
+        try:
+            async for result in iterations:
+                if result is None:
+                    yield b": keep-alive\n\n"
+                    continue
+                if result.get('type') != 'delta':
+                    eval_results.append(result)
+                yield event(result)
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.CANCELLATIONS.inc(kind='disconnects')
+            logging.info(f"Client disconnected from the evaluation of {run.model}, skipping the final verdict")
+            raise
+        finally:
+            await iterations.aclose()
+
+        yield event(await finish_run('evaluate_stream', run, eval_results, started))
+
+    # Set as a header rather than a media type, so Starlette doesn't add a charset the Flask view doesn't send.
+    return StreamingResponse(generate(), headers={'content-type': 'text/event-stream'})
+
+
+async def upload_csv(request):
+    async with request.form() as form:
+        file = form.get('file')
+        if not isinstance(file, UploadFile):
+            return JSONResponse({'error': 'No file part in the request'}, 400)
+        if not file.filename:
+            return JSONResponse({'error': 'No selected file'}, 400)
+        if not file.filename.endswith('.csv'):
+            return JSONResponse({'error': 'Invalid file format. Please upload a CSV file.'}, 400)
+
+        try:
+            experiments = list(csv.DictReader((await file.read()).decode('utf-8').splitlines()))
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, 400)
+
+        try:
+            max_concurrency = get_max_concurrency(form.get('max_concurrency'))
+            cache_policy = get_cache_policy(form.get('cache'))
+            prescore = get_prescore_rules(form.get('prescore'))
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, 400)
+
+    results = [result async for _, result in arun_batch(experiments, max_concurrency, cache_policy,
+                                                         prescore=prescore)]
+    return JSONResponse(results)
+
+
+app = Starlette(routes=[
+    Route('/evaluate', evaluate, methods=['POST']),
+    Route('/evaluate_stream', evaluate_stream, methods=['POST']),
+    Route('/upload_csv', upload_csv, methods=['POST']),
+    Mount('/', app=WSGIMiddleware(flask_app.app)),
+])
@@ -0,0 +1,108 @@
+"""Concurrency benchmark: many evaluations at once on the thread engine and on the asyncio engine.
+
+Every evaluation runs its iterations and final verdict against the stub provider, in a fresh
+interpreter per mode and level. The thread engine runs each evaluation in a thread of its own, as the
+Flask server does per request, with run_iterations' pool under it; the asyncio engine runs them all
+as tasks on one event loop, as asgi.py does. Reports the wall time, the peak number of threads and
+the peak RSS.
+
+    python benchmarks/bench_async.py
+    python benchmarks/bench_async.py --concurrency 100 400 --latency 1 --save async.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import asyncio, json, resource, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import app, asgi
+
+def new_run():
+    return app.EvaluationRun('stub', 0.5, 100, 'Prompt', 'Criteria', {iterations}, 'Answer')
+
+def threaded():
+    def evaluate():
+        run = new_run()
+        results = list(app.run_iterations(run, {max_concurrency}))
+        run.final_verdict(len(results))
+    with ThreadPoolExecutor({concurrency}) as pool:
+        for future in [pool.submit(evaluate) for _ in range({concurrency})]:
+            future.result()
+
+async def evaluate():
+    run = new_run()
+    results = [result async for result in asgi.arun_iterations(run, {max_concurrency})]
+    await run.afinal_verdict(len(results))
+
+async def evaluate_all():
+    await asyncio.gather(*(evaluate() for _ in range({concurrency})))
+
+peak_threads = threading.active_count()
+done = threading.Event()
+def sample():
+    global peak_threads
+    while not done.wait(0.01):
+        peak_threads = max(peak_threads, threading.active_count())
+threading.Thread(target=sample, daemon=True).start()
+
+new_run()  # builds the stub clients and evaluator outside the measurement
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+start = time.perf_counter()
+threaded() if '{mode}' == 'threads' else asyncio.run(evaluate_all())
+elapsed = time.perf_counter() - start
+done.set()
+print(json.dumps({{'seconds': elapsed, 'peak_threads': peak_threads - 1,
+                  'rss_growth_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss}}))
+'''
+
+
+def measure(mode, concurrency, args):
+    code = CHILD.format(mode=mode, concurrency=concurrency, iterations=args.iterations,
+                        max_concurrency=args.max_concurrency)
+    env = {
+        **os.environ,
+        'STUB_LATENCY': f'fixed:{args.latency}',
+        'STUB_JUDGE_LATENCY': f'fixed:{args.latency}',
+        # The stub's rate limit would otherwise be what is measured.
+        'RATE_LIMIT_STUB': '1000000',
+        'RATE_LIMIT_STUB_MAX': '1000000',
+        'MAX_CONCURRENCY': str(args.max_concurrency),
+        'RESULTS_STORE_PATH': '',
+        'PYTHONDONTWRITEBYTECODE': '1',
+    }
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True,
+                            env=env)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[50, 200, 400],
+                        help='evaluations running at once')
+    parser.add_argument('--iterations', type=int, default=4, help='iterations per evaluation')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='iterations run at once per evaluation')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds every model and judge call takes')
+    parser.add_argument('--save', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'mode':<10}{'evaluations':>12}{'seconds':>10}{'threads':>10}{'rss MB':>10}")
+    for concurrency in args.concurrency:
+        for mode in ('threads', 'asyncio'):
+            result = results[f'{mode}_{concurrency}'] = measure(mode, concurrency, args)
+            print(f"{mode:<10}{concurrency:>12}{result['seconds']:>10.2f}{result['peak_threads']:>10}"
+                  f"{result['rss_growth_mb']:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
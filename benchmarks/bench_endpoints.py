@@ -0,0 +1,160 @@
+"""Load benchmark for the evaluation endpoints, run offline against the stub provider.
+
+Drives /evaluate, /evaluate_stream and /upload_csv in-process at several iteration counts, row
+counts and client concurrency levels, and reports requests/s, p50/p95/p99 latency and peak RSS.
+
+    python benchmarks/bench_endpoints.py                                  # print the results
+    python benchmarks/bench_endpoints.py --save benchmarks/baseline.json  # record a baseline
+    python benchmarks/bench_endpoints.py --baseline benchmarks/baseline.json --max-regression 0.25
+
+The stub latency can be changed with the STUB_LATENCY and STUB_JUDGE_LATENCY variables.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('STUB_LATENCY', 'lognormal:0.02:0.3')
+os.environ.setdefault('STUB_JUDGE_LATENCY', 'lognormal:0.01:0.3')
+os.environ.setdefault('STUB_JUDGE_SCORE', '7')
+os.environ.setdefault('RESPONSE_CACHE_POLICY', 'bypass')
+os.environ.setdefault('RESULTS_STORE_PATH', '')
+
+import logging  # noqa: E402
+
+from app import app  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+SCENARIOS = [
+    # (name, endpoint, iterations, rows, client concurrency)
+    ('evaluate_i1_c1', '/evaluate', 1, None, 1),
+    ('evaluate_i5_c1', '/evaluate', 5, None, 1),
+    ('evaluate_i20_c1', '/evaluate', 20, None, 1),
+    ('evaluate_i5_c8', '/evaluate', 5, None, 8),
+    ('evaluate_stream_i5_c1', '/evaluate_stream', 5, None, 1),
+    ('evaluate_stream_i20_c4', '/evaluate_stream', 20, None, 4),
+    ('upload_csv_r10_i3_c1', '/upload_csv', 3, 10, 1),
+    ('upload_csv_r50_i3_c2', '/upload_csv', 3, 50, 2),
+]
+
+
+def form(iterations):
+    return {
+        'model': 'stub',
+        'temperature': '0.5',
+        'max_new_tokens': '100',
+        'prompt': 'Explain the process of photosynthesis in plants.',
+        'criteria': 'Score 1: Wrong. Score 10: Complete and accurate.',
+        'iterations': str(iterations),
+        'expected_result': 'Plants turn sunlight, water and carbon dioxide into glucose and oxygen.',
+    }
+
+
+def csv_upload(rows, iterations):
+    header = 'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+    lines = [f'stub,0.5,100,Prompt number {i},Score 10: Perfect.,{iterations},Answer {i}' for i in range(rows)]
+    return io.BytesIO((header + '\n'.join(lines)).encode())
+
+
+def send(client, endpoint, iterations, rows):
+    start = time.perf_counter()
+    if endpoint == '/upload_csv':
+        response = client.post(endpoint, data={'file': (csv_upload(rows, iterations), 'bench.csv')})
+    else:
+        response = client.post(endpoint, data=form(iterations))
+    response.get_data()
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'{endpoint} returned {response.status_code}')
+    return elapsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(endpoint, iterations, rows, concurrency, requests):
+    def worker(_):
+        with app.test_client() as client:
+            return send(client, endpoint, iterations, rows)
+
+    # One untimed request first, so lazy imports, model set-up and pool start-up stay out of the timings.
+    worker(None)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(worker, range(requests)))
+    wall = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'requests_per_second': requests / wall,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'mean': statistics.mean(latencies),
+        # ru_maxrss is in kilobytes on Linux; the peak of the whole process so far.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    print(f"\n{'scenario':<26}{'req/s':>10}{'base':>10}{'p95':>10}{'base':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        print(f"{name:<26}{result['requests_per_second']:>10.2f}{base['requests_per_second']:>10.2f}"
+              f"{result['p95']:>10.3f}{base['p95']:>10.3f}")
+        if result['requests_per_second'] < base['requests_per_second'] * (1 - max_regression):
+            regressions.append(f"{name}: requests/s fell from {base['requests_per_second']:.2f} "
+                               f"to {result['requests_per_second']:.2f}")
+        if result['p95'] > base['p95'] * (1 + max_regression):
+            regressions.append(f"{name}: p95 rose from {base['p95']:.3f}s to {result['p95']:.3f}s")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=16, help='requests per scenario')
+    parser.add_argument('--only', help='run only the scenarios whose name contains this text')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare the results with this file')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='fail when requests/s or p95 is worse than the baseline by this fraction')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'scenario':<26}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'rss MB':>10}")
+    for name, endpoint, iterations, rows, concurrency in SCENARIOS:
+        if args.only and args.only not in name:
+            continue
+        result = results[name] = run_scenario(endpoint, iterations, rows, concurrency, args.requests)
+        print(f"{name:<26}{result['requests_per_second']:>10.2f}{result['p50']:>10.3f}"
+              f"{result['p95']:>10.3f}{result['p99']:>10.3f}{result['peak_rss_mb']:>10.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
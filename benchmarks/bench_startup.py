@@ -0,0 +1,76 @@
+"""Cold start benchmark: time and memory to import the app in a fresh interpreter.
+
+Compares the lazy provider registry with importing every provider SDK and the evaluator up front,
+as the app did before, and with a worker that only ever uses Bedrock.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 10 --save startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, resource, sys, time
+start = time.perf_counter()
+{setup}
+import app
+elapsed = time.perf_counter() - start
+sdks = sorted({{name.split('.')[0] for name in sys.modules
+                if name.split('.')[0] in ('langchain', 'langchain_openai', 'langchain_aws', 'langchain_ibm')}})
+print(json.dumps({{'seconds': elapsed, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'modules': len(sys.modules), 'sdks': sdks}}))
+'''
+
+MODES = {
+    # nothing but the app itself
+    'lazy': '',
+    # a worker whose first request builds a Bedrock model
+    'lazy_bedrock_only': 'import providers; import langchain_aws; from langchain.evaluation import load_evaluator',
+    # the app importing every SDK at load, as it did before the registry
+    'eager': 'import providers; providers.preload(); from langchain.evaluation import load_evaluator',
+}
+
+
+def measure(setup):
+    output = subprocess.run([sys.executable, '-c', CHILD.format(setup=setup)], cwd=ROOT, check=True,
+                            capture_output=True, text=True, env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per mode')
+    parser.add_argument('--save', help='write the results to this file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'mode':<20}{'seconds':>10}{'rss MB':>10}{'modules':>10}  sdks")
+    for mode, setup in MODES.items():
+        runs = [measure(setup) for _ in range(args.runs)]
+        result = results[mode] = {
+            'seconds': statistics.median(run['seconds'] for run in runs),
+            'peak_rss_mb': statistics.median(run['peak_rss_mb'] for run in runs),
+            'modules': runs[-1]['modules'],
+            'sdks': runs[-1]['sdks'],
+        }
+        print(f"{mode:<20}{result['seconds']:>10.3f}{result['peak_rss_mb']:>10.1f}{result['modules']:>10}"
+              f"  {', '.join(result['sdks']) or '-'}")
+
+    lazy, eager = results['lazy'], results['eager']
+    print(f"\nlazy start is {eager['seconds'] / lazy['seconds']:.1f}x faster and uses "
+          f"{eager['peak_rss_mb'] - lazy['peak_rss_mb']:.0f} MB less memory than eager")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
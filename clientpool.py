@@ -0,0 +1,53 @@
+"""Process-wide registries that keep model clients and evaluators alive between requests."""
+import threading
+from collections import OrderedDict
+
+
+class LRURegistry:
+    """Size-capped LRU map that builds missing entries on demand and counts hits and misses."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        # Build outside the lock so a slow client setup doesn't block lookups of other keys.
+        value = factory()
+
+        with self.lock:
+            if key in self.entries:
+                # Another thread built the same entry in the meantime; keep the first one.
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,8 +1,23 @@
+import os
+import tempfile
+
+# The app resumes interrupted jobs as soon as it is imported, so the tests get a job store of their own.
+os.environ['JOB_STORE_PATH'] = os.path.join(tempfile.mkdtemp(), 'jobs.sqlite3')
+
 import pytest
 from app import app  # Reemplaza 'your_flask_app' con el nombre del módulo donde está definido tu Flask app
+import app as app_module
+from resultstore import ResultStore
 
 @pytest.fixture
 def client():
     with app.test_client() as client:
         with app.app_context():
             yield client
+
+@pytest.fixture(autouse=True)
+def result_store(tmp_path, monkeypatch):
+    # Runs recorded during a test go to a store of their own.
+    store = ResultStore(str(tmp_path / 'results.sqlite3'))
+    monkeypatch.setattr(app_module, 'result_store', store)
+    return store
@@ -0,0 +1,93 @@
+"""Sharing of identical model calls between the rows of a batch."""
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class SharedCalls:
+    """Runs each distinct call once and hands its result to every identical call in the batch.
+
+    A call made while an identical one is in flight waits for it instead of calling the model
+    again. The results of at most maxsize finished calls are remembered, oldest first out.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.calls = OrderedDict()
+        self.lock = threading.Lock()
+        self.saved = {}
+
+    def fetch(self, stage, key, compute):
+        # Returns (value, shared), where shared tells whether the value came from an identical call.
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = Future()
+                self._evict()
+            else:
+                self.calls.move_to_end(key)
+                self.saved[stage] = self.saved.get(stage, 0) + 1
+        if not owner:
+            return future.result(), True
+
+        try:
+            value = compute()
+        except BaseException as e:
+            # Calls waiting on this one fail with it, but later ones try again.
+            with self.lock:
+                if self.calls.get(key) is future:
+                    del self.calls[key]
+            future.set_exception(e)
+            raise
+        future.set_result(value)
+        return value, False
+
+    def _evict(self):
+        while len(self.calls) > self.maxsize:
+            key, future = next(iter(self.calls.items()))
+            if not future.done():
+                return
+            del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.saved)
+
+
+class AsyncSharedCalls(SharedCalls):
+    """SharedCalls for coroutines running on one event loop."""
+
+    async def fetch(self, stage, key, compute):
+        future = self.calls.get(key)
+        while future is not None:
+            self.calls.move_to_end(key)
+            try:
+                # Shielded, so a caller that is cancelled doesn't cancel the call the others wait for.
+                value = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The caller that owned the call was cancelled (its row failed, say): make it again.
+                future = self.calls.get(key)
+                continue
+            self.saved[stage] = self.saved.get(stage, 0) + 1
+            return value, True
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        self._evict()
+        try:
+            value = await compute()
+        except BaseException as e:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Nobody may be waiting; retrieving the exception keeps asyncio from logging it.
+                future.exception()
+            raise
+        future.set_result(value)
+        return value, False
@@ -0,0 +1,347 @@
+"""Durable background jobs for batch evaluations.
+
+A submitted sheet is stored in a local SQLite database together with every judged iteration and
+every finished row, so a job that is cancelled, fails or loses its worker can be resumed without
+paying again for the calls it already made.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlitestore import SQLiteStore
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (COMPLETED, FAILED, CANCELLED)
+
+# Row results are identified by row number; the final verdict of a row is checkpointed as iteration 0.
+VERDICT = 0
+
+
+def new_boot_token():
+    global BOOT_TOKEN
+    BOOT_TOKEN = uuid.uuid4().hex
+
+
+# Tells this process apart from a dead worker that had the same pid, which is routine in containers
+# where the app is pid 1. A forked worker gets a token of its own.
+new_boot_token()
+os.register_at_fork(after_in_child=new_boot_token)
+
+
+def pid_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_alive(pid, token):
+    # Whether the process that claimed a job is still running. A worker with our pid is either this
+    # process or one that died before it.
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return token == BOOT_TOKEN
+    return pid_alive(pid)
+
+
+class JobStore(SQLiteStore):
+    """SQLite store for jobs, their rows and per-iteration checkpoints."""
+
+    # Checkpoints are what a resumed job doesn't pay for again, so they are synced on every commit.
+    SYNCHRONOUS = 'FULL'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            options TEXT NOT NULL,
+            total_rows INTEGER NOT NULL,
+            total_iterations INTEGER NOT NULL,
+            error TEXT,
+            worker_pid INTEGER,
+            worker_token TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS job_rows (
+            job_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            experiment TEXT NOT NULL,
+            result TEXT,
+            PRIMARY KEY (job_id, row)
+        );
+        CREATE TABLE IF NOT EXISTS job_iterations (
+            job_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            iteration INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (job_id, row, iteration)
+        );
+    '''
+
+    def create(self, experiments, options):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        connection = self._connection()
+        total_rows = total_iterations = 0
+        connection.execute('BEGIN')
+        try:
+            for row, exp in enumerate(experiments):
+                connection.execute('INSERT INTO job_rows (job_id, row, experiment) VALUES (?, ?, ?)',
+                                   (job_id, row, json.dumps(exp)))
+                total_rows += 1
+                try:
+                    total_iterations += max(0, int(exp.get('iterations') or 0))
+                except ValueError:
+                    pass
+            connection.execute(
+                'INSERT INTO jobs (id, status, options, total_rows, total_iterations, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (job_id, QUEUED, json.dumps(options), total_rows, total_iterations, now, now)
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return job_id
+
+    def get(self, job_id):
+        connection = self._connection()
+        job = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        completed_rows = connection.execute(
+            'SELECT COUNT(*) FROM job_rows WHERE job_id = ? AND result IS NOT NULL', (job_id,)).fetchone()[0]
+        completed_iterations = connection.execute(
+            'SELECT COUNT(*) FROM job_iterations WHERE job_id = ? AND iteration != ?',
+            (job_id, VERDICT)).fetchone()[0]
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'options': json.loads(job['options']),
+            'total_rows': job['total_rows'],
+            'completed_rows': completed_rows,
+            'total_iterations': job['total_iterations'],
+            'completed_iterations': completed_iterations,
+            'error': job['error'],
+            'created': job['created'],
+            'updated': job['updated']
+        }
+
+    def claim(self, job_id, statuses):
+        # Marks the job as running in this process, unless a live process (this one included) holds it.
+        # A job left running by a worker that is gone can always be claimed.
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            job = connection.execute('SELECT status, worker_pid, worker_token FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+            claimable = job is not None and (job['status'] in statuses or job['status'] == RUNNING) and \
+                not worker_alive(job['worker_pid'], job['worker_token'])
+            if claimable:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, worker_pid = ?, worker_token = ?, error = NULL, updated = ? '
+                    'WHERE id = ?', (RUNNING, os.getpid(), BOOT_TOKEN, time.time(), job_id))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return claimable
+
+    def owner(self, job_id):
+        # The status of a job and the process it is claimed by, if any.
+        job = self._connection().execute('SELECT status, worker_pid FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return (job['status'], job['worker_pid']) if job else (None, None)
+
+    def held_elsewhere(self, job_id):
+        # True while another live process still holds the job, running it or on its way to stopping.
+        # A holder with our pid is this process or a dead one, never another live process.
+        _, worker_pid = self.owner(job_id)
+        return worker_pid is not None and worker_pid != os.getpid() and pid_alive(worker_pid)
+
+    def release(self, job_id):
+        # Called by the owning process once it stops running the job.
+        self._connection().execute('UPDATE jobs SET worker_pid = NULL, worker_token = NULL '
+                                   'WHERE id = ? AND worker_pid = ? AND worker_token = ?',
+                                   (job_id, os.getpid(), BOOT_TOKEN))
+
+    def set_status(self, job_id, status, error=None, only_from=None):
+        query = 'UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?'
+        params = [status, error, time.time(), job_id]
+        if only_from:
+            query += f" AND status IN ({', '.join('?' * len(only_from))})"
+            params += list(only_from)
+        return self._connection().execute(query, params).rowcount == 1
+
+    def resumable(self):
+        rows = self._connection().execute(
+            'SELECT id, status, worker_pid, worker_token FROM jobs WHERE status IN (?, ?)',
+            (QUEUED, RUNNING)).fetchall()
+        return [row['id'] for row in rows
+                if row['status'] == QUEUED or not worker_alive(row['worker_pid'], row['worker_token'])]
+
+    def experiments(self, job_id, page_size=500):
+        # Reads the rows of a job a page at a time, so a huge sheet is never loaded at once.
+        last_row = -1
+        while True:
+            page = self._connection().execute(
+                'SELECT row, experiment FROM job_rows WHERE job_id = ? AND row > ? ORDER BY row LIMIT ?',
+                (job_id, last_row, page_size)).fetchall()
+            if not page:
+                return
+            for row in page:
+                last_row = row['row']
+                yield json.loads(row['experiment'])
+
+    def save_row(self, job_id, row, result):
+        connection = self._connection()
+        connection.execute('UPDATE job_rows SET result = ? WHERE job_id = ? AND row = ?',
+                           (json.dumps(result), job_id, row))
+        connection.execute('UPDATE jobs SET updated = ? WHERE id = ?', (time.time(), job_id))
+
+    def results(self, job_id):
+        rows = self._connection().execute(
+            'SELECT result FROM job_rows WHERE job_id = ? AND result IS NOT NULL ORDER BY row', (job_id,))
+        for row in rows:
+            yield json.loads(row['result'])
+
+    def checkpoint(self, job_id, row, iteration):
+        found = self._connection().execute(
+            'SELECT result FROM job_iterations WHERE job_id = ? AND row = ? AND iteration = ?',
+            (job_id, row, iteration)).fetchone()
+        return json.loads(found['result']) if found else None
+
+    def save_checkpoint(self, job_id, row, iteration, result):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO job_iterations (job_id, row, iteration, result) VALUES (?, ?, ?, ?)',
+            (job_id, row, iteration, json.dumps(result)))
+
+
+class JobCheckpoints:
+    """The checkpoints of one job, in the shape run_batch expects."""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+    def get(self, row, iteration):
+        return self.store.checkpoint(self.job_id, row, iteration)
+
+    def put(self, row, iteration, result):
+        self.store.save_checkpoint(self.job_id, row, iteration, result)
+
+
+class JobManager:
+    """Runs jobs on a local pool of background workers.
+
+    runner(job, experiments, checkpoints, should_stop) must yield (row, result) pairs for the
+    finished rows of the job.
+    """
+
+    def __init__(self, store, runner, workers, poll_interval=1.0):
+        self.store = store
+        self.runner = runner
+        # How often a running job checks the store for a cancel made by another process.
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.stop_events = {}
+        self.lock = threading.Lock()
+
+    def submit(self, experiments, options):
+        job_id = self.store.create(experiments, options)
+        self.start(job_id, (QUEUED,))
+        return job_id
+
+    def start(self, job_id, statuses):
+        with self.lock:
+            if job_id in self.stop_events:
+                return False
+            self.stop_events[job_id] = threading.Event()
+        self.executor.submit(self._run, job_id, statuses)
+        return True
+
+    def resume(self, job_id):
+        # The job is claimed before this returns, so a resume that can't take the job reports False
+        # instead of leaving a worker to find out.
+        with self.lock:
+            if job_id in self.stop_events:
+                return False
+            self.stop_events[job_id] = threading.Event()
+        claimed = False
+        try:
+            claimed = self.store.claim(job_id, (QUEUED, FAILED, CANCELLED))
+        finally:
+            if not claimed:
+                with self.lock:
+                    self.stop_events.pop(job_id, None)
+        if claimed:
+            self.executor.submit(self._run, job_id, None)
+        return claimed
+
+    def resume_interrupted(self):
+        # Picks up jobs left queued or running by a worker process that is gone.
+        for job_id in self.store.resumable():
+            logging.info(f"Resuming interrupted job {job_id}")
+            self.start(job_id, (QUEUED,))
+
+    def cancel(self, job_id):
+        with self.lock:
+            stop_event = self.stop_events.get(job_id)
+        if stop_event is not None:
+            stop_event.set()
+        return self.store.set_status(job_id, CANCELLED, only_from=(QUEUED, RUNNING))
+
+    def should_stop(self, job_id):
+        # A cancel made in this process sets the job's stop event. One handled by another worker
+        # process only changes the stored status, which is polled every poll_interval seconds.
+        stop_event = self.stop_events[job_id]
+        polled = time.monotonic()
+
+        def stopped():
+            nonlocal polled
+            if not stop_event.is_set() and time.monotonic() - polled >= self.poll_interval:
+                polled = time.monotonic()
+                if self.store.owner(job_id) != (RUNNING, os.getpid()):
+                    stop_event.set()
+            return stop_event.is_set()
+
+        return stopped
+
+    def _run(self, job_id, statuses):
+        # With statuses None, the job was already claimed by resume.
+        claimed = statuses is None
+        try:
+            claimed = claimed or self.store.claim(job_id, statuses)
+            if not claimed:
+                return
+            job = self.store.get(job_id)
+            checkpoints = JobCheckpoints(self.store, job_id)
+            should_stop = self.should_stop(job_id)
+            for row, result in self.runner(job, self.store.experiments(job_id), checkpoints, should_stop):
+                self.store.save_row(job_id, row, result)
+            if should_stop():
+                logging.info(f"Job {job_id} was cancelled")
+            else:
+                self.store.set_status(job_id, COMPLETED, only_from=(RUNNING,))
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            self.store.set_status(job_id, FAILED, error=str(e), only_from=(RUNNING,))
+        finally:
+            if claimed:
+                self.store.release(job_id)
+            with self.lock:
+                self.stop_events.pop(job_id, None)
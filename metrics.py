@@ -0,0 +1,172 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are kept per process; with several gunicorn workers each one exposes its own values.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        # Metrics are registered in the process-wide REGISTRY that /metrics renders, unless another
+        # list is passed, as tests do.
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return lines
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def set(self, value, **labels):
+        # For a counter, copies in a running total kept elsewhere, such as a registry's hit count.
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', key + (('le', format_value(bound)),), count))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, counts[-1]))
+        return samples
+
+
+REGISTRY = []
+
+
+def render(registry=None):
+    lines = []
+    for metric in REGISTRY if registry is None else registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('llmeval_stage_seconds', 'Time spent in each evaluation stage.',
+                          ('stage', 'model', 'provider'))
+STAGE_ERRORS = Counter('llmeval_stage_errors_total', 'Errors raised in each evaluation stage.',
+                       ('stage', 'model', 'provider'))
+IN_FLIGHT = Gauge('llmeval_in_flight', 'Calls currently in progress in each evaluation stage.', ('stage',))
+THROTTLES = Counter('llmeval_throttled_total', 'Calls throttled by the provider.', ('provider',))
+CANCELLATIONS = Counter('llmeval_cancellations_total', 'Work given up because its client went away.',
+                        ('kind',))
+EARLY_STOPS = Counter('llmeval_early_stopped_iterations_total',
+                      'Iterations skipped because the scores had already converged.')
+DEDUPLICATED = Counter('llmeval_deduplicated_calls_total', 'Calls saved by sharing identical calls within a batch.',
+                       ('stage',))
+SCORING_PATHS = Counter('llmeval_scoring_path_total', 'Iterations scored by the judge or by each local scorer.',
+                        ('path',))
+
+REGISTRY_ENTRIES = Gauge('llmeval_registry_entries', 'Entries held by each client registry.', ('registry',))
+REGISTRY_LOOKUPS = Counter('llmeval_registry_lookups_total', 'Client registry lookups by result.',
+                           ('registry', 'result'))
+RESPONSE_CACHE = Counter('llmeval_response_cache_operations_total', 'Response cache operations by result.',
+                         ('result',))
+
+
+class Timer:
+    def __init__(self, provider):
+        self.provider = provider
+        self.elapsed = None
+
+
+@contextmanager
+def timed(stage, model, provider=None):
+    # Times a stage, counts it as in flight while it runs and counts the errors it raises. The
+    # provider can be filled in on the yielded timer when it is only known once the stage has run.
+    timer = Timer(provider)
+    IN_FLIGHT.inc(stage=stage)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield timer
+    except Exception:
+        failed = True
+        raise
+    finally:
+        timer.elapsed = time.perf_counter() - start
+        labels = {'stage': stage, 'model': model or 'unknown', 'provider': timer.provider or 'other'}
+        if failed:
+            STAGE_ERRORS.inc(**labels)
+        STAGE_SECONDS.observe(timer.elapsed, **labels)
+        IN_FLIGHT.dec(stage=stage)
@@ -0,0 +1,153 @@
+"""Cheap local scorers that can decide an iteration's score without calling the judge model.
+
+Rules are tried in order and the first one that matches decides. A rule names a scorer, the range
+of values it matches (``min`` and/or ``max``, both inclusive; ``min`` defaults to 1) and the score
+it gives: a number from 1 to 10, ``"scaled"`` to map the scorer's 0-1 value onto 1-10, or
+``"judge"`` to send the prediction straight to the judge. Predictions no rule matches go to the
+judge as well.
+
+    [{"scorer": "empty", "score": 1},
+     {"scorer": "normalized_match", "score": 10},
+     {"scorer": "token_f1", "max": 0.1, "score": 1}]
+
+Scorers: exact_match, normalized_match, empty, token_f1, char_ngram (``n``, default 3) and
+regex (``pattern``, matched anywhere in the prediction).
+"""
+import json
+import re
+import string
+from collections import Counter
+
+
+PRESETS = {
+    'off': [],
+    'default': [
+        {'scorer': 'empty', 'score': 1},
+        {'scorer': 'normalized_match', 'score': 10},
+    ],
+}
+
+PUNCTUATION = re.compile(f'[{re.escape(string.punctuation)}]')
+
+
+def normalize(text):
+    return ' '.join(PUNCTUATION.sub(' ', text.lower()).split())
+
+
+def char_ngrams(text, n):
+    text = normalize(text)
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def token_f1(tokens, reference_tokens):
+    common = sum((Counter(tokens) & reference_tokens).values())
+    if not common:
+        return 0.0
+    precision = common / len(tokens)
+    recall = common / sum(reference_tokens.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def dice(ngrams, reference_ngrams):
+    if not ngrams and not reference_ngrams:
+        return 1.0
+    return 2 * len(ngrams & reference_ngrams) / (len(ngrams) + len(reference_ngrams))
+
+
+class Reference:
+    # Features of the expected result, computed once and shared by every prediction scored against it.
+    def __init__(self, text):
+        self.text = text.strip()
+        self.normalized = normalize(text)
+        self.tokens = Counter(self.normalized.split())
+        self.ngrams = {}
+
+    def char_ngrams(self, n):
+        if n not in self.ngrams:
+            self.ngrams[n] = char_ngrams(self.text, n)
+        return self.ngrams[n]
+
+
+# Each scorer maps a prediction to a value between 0 and 1.
+SCORERS = {
+    'exact_match': lambda prediction, reference, rule: float(prediction.strip() == reference.text),
+    'normalized_match': lambda prediction, reference, rule: float(normalize(prediction) == reference.normalized),
+    'empty': lambda prediction, reference, rule: float(not normalize(prediction)),
+    'token_f1': lambda prediction, reference, rule: token_f1(normalize(prediction).split(), reference.tokens),
+    'char_ngram': lambda prediction, reference, rule: dice(char_ngrams(prediction, rule.get('n', 3)),
+                                                           reference.char_ngrams(rule.get('n', 3))),
+    'regex': lambda prediction, reference, rule: float(rule['compiled'].search(prediction) is not None),
+}
+
+
+def is_number(value, types=(int, float)):
+    # bool is an int to isinstance, but True isn't a score or a bound.
+    return isinstance(value, types) and not isinstance(value, bool)
+
+
+def check_rules(rules):
+    # Validates the rules and returns them ready for PreScorer, raising ValueError on a bad rule.
+    if isinstance(rules, str) and rules in PRESETS:
+        rules = PRESETS[rules]
+    elif isinstance(rules, str):
+        try:
+            rules = json.loads(rules)
+        except json.JSONDecodeError:
+            presets = ', '.join(f"'{name}'" for name in PRESETS)
+            raise ValueError(f"prescore must be one of {presets} or a JSON list of rules, got: {rules!r}")
+    if not isinstance(rules, list):
+        raise ValueError('prescore rules must be a list')
+    checked = []
+    for rule in rules:
+        if not isinstance(rule, dict) or rule.get('scorer') not in SCORERS:
+            raise ValueError(f"Unknown prescore scorer in rule: {rule}")
+        rule = dict(rule)
+        score = rule.get('score')
+        if score not in ('judge', 'scaled') and not (is_number(score, int) and 1 <= score <= 10):
+            raise ValueError(f"prescore rule score must be 1-10, 'scaled' or 'judge': {rule}")
+        for bound in ('min', 'max'):
+            if bound in rule and not (is_number(rule[bound]) and 0 <= rule[bound] <= 1):
+                raise ValueError(f"prescore rule {bound} must be a number from 0 to 1: {rule}")
+        if rule.get('min', 0) > rule.get('max', 1):
+            raise ValueError(f"prescore rule min must not be greater than max: {rule}")
+        if 'min' not in rule and 'max' not in rule:
+            rule['min'] = 1
+        if rule['scorer'] == 'char_ngram' and not (is_number(rule.get('n', 3), int) and rule.get('n', 3) > 0):
+            raise ValueError(f"prescore rule n must be a positive integer: {rule}")
+        if rule['scorer'] == 'regex':
+            if not isinstance(rule.get('pattern'), str):
+                raise ValueError(f"prescore regex rule needs a string pattern: {rule}")
+            try:
+                rule['compiled'] = re.compile(rule['pattern'])
+            except re.error as e:
+                raise ValueError(f"Invalid prescore regex in rule: {rule}: {e}")
+        checked.append(rule)
+    return checked
+
+
+class Decision:
+    def __init__(self, rule, value):
+        self.rule = rule
+        self.value = value
+        self.path = f"local:{rule['scorer']}"
+        score = rule['score']
+        self.score = round(1 + 9 * value) if score == 'scaled' else score
+        self.reason = f"Scored locally by {rule['scorer']} ({value:.2f}) without calling the judge."
+
+
+class PreScorer:
+    """Applies a list of checked rules to predictions of one expected result."""
+
+    def __init__(self, rules, expected_result):
+        self.rules = rules
+        self.reference = Reference(expected_result)
+
+    def decide(self, prediction):
+        # Returns the Decision of the first rule that matches, or None when the judge has to score it.
+        for rule in self.rules:
+            value = SCORERS[rule['scorer']](prediction, self.reference, rule)
+            if rule.get('min', 0) <= value <= rule.get('max', 1):
+                return None if rule['score'] == 'judge' else Decision(rule, value)
+        return None
@@ -0,0 +1,160 @@
+"""Registry of the models the app can evaluate and the providers that build their clients.
+
+Provider SDKs are imported the first time one of their models is built, so a worker only pays for
+the SDKs it actually uses. More models, and providers from other packages, can be registered from
+a JSON file named by the MODEL_REGISTRY variable:
+
+    {
+        "providers": {"my_provider": "my_package.llms:build_llm"},
+        "models": {
+            "llama_3_1_8b": {"provider": "bedrock", "model_id": "meta.llama3-1-8b-instruct-v1:0"},
+            "my_model": {"provider": "my_provider", "model_id": "my-model", "options": {"region": "eu"}}
+        }
+    }
+
+A provider is called as provider(model_id, temperature, max_new_tokens, **options) and returns a
+langchain LLM or chat model. Options are passed to it as they are, which for the built-in providers
+means as extra arguments of the client class.
+"""
+import importlib
+import json
+import os
+
+
+def openai_chat(model_id, temperature, max_new_tokens, **options):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model_name=model_id, temperature=temperature, max_tokens=max_new_tokens, **options)
+
+
+def openai(model_id, temperature, max_new_tokens, **options):
+    from langchain_openai import OpenAI
+    if model_id:
+        options['model_name'] = model_id
+    return OpenAI(temperature=temperature, max_tokens=max_new_tokens, **options)
+
+
+def bedrock(model_id, temperature, max_new_tokens, **options):
+    from langchain_aws import BedrockLLM
+    return BedrockLLM(model_id=model_id, **options)
+
+
+def bedrock_chat(model_id, temperature, max_new_tokens, **options):
+    from langchain_aws import BedrockChat
+    return BedrockChat(model_id=model_id, **options)
+
+
+def watsonx(model_id, temperature, max_new_tokens, **options):
+    from langchain_ibm import WatsonxLLM
+    parameters = {
+        "decoding_method": "sample",
+        "max_new_tokens": max_new_tokens,
+        "min_new_tokens": 1,
+        "temperature": temperature,
+        "top_k": 50,
+        "top_p": 1,
+    }
+    return WatsonxLLM(model_id=model_id, project_id=os.environ["WATSONX_PROJECT_ID"], params=parameters, **options)
+
+
+def stub(model_id, temperature, max_new_tokens, role='model', **options):
+    from stub_llm import build_stub_llm
+    return build_stub_llm(role)
+
+
+# Provider name -> factory, or a 'module:attribute' path imported on first use.
+PROVIDERS = {
+    'openai_chat': openai_chat,
+    'openai': openai,
+    'bedrock': bedrock,
+    'bedrock_chat': bedrock_chat,
+    'watsonx': watsonx,
+    'stub': stub,
+}
+
+# Modules each built-in provider imports, for preload.
+PROVIDER_MODULES = {
+    'openai_chat': 'langchain_openai',
+    'openai': 'langchain_openai',
+    'bedrock': 'langchain_aws',
+    'bedrock_chat': 'langchain_aws',
+    'watsonx': 'langchain_ibm',
+    'stub': 'stub_llm',
+}
+
+# Model key (as sent by the form or a CSV row) -> provider, model id and options.
+MODELS = {}
+
+# Keys that aren't registered are evaluated with the provider's default OpenAI completion model.
+DEFAULT_MODEL = {'provider': 'openai', 'model_id': None, 'options': {}}
+
+
+def register_provider(name, factory):
+    PROVIDERS[name] = factory
+
+
+def register_model(key, provider, model_id=None, **options):
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown provider {provider} for model {key}")
+    MODELS[key] = {'provider': provider, 'model_id': model_id, 'options': options}
+
+
+for key, provider, model_id in [
+    ('gpt_3.5', 'openai_chat', 'gpt-3.5-turbo-0125'),
+    ('gpt_4', 'openai_chat', 'gpt-4-turbo'),
+    ('gpt_4o', 'openai_chat', 'gpt-4o'),
+    ('llama_2_13b', 'bedrock', 'meta.llama2-13b-chat-v1'),
+    ('llama_3_8b', 'bedrock', 'meta.llama3-8b-instruct-v1:0'),
+    ('llama_3_70b', 'bedrock_chat', 'meta.llama3-70b-instruct-v1:0'),
+    ('codellama_34b_instruct', 'watsonx', 'codellama/codellama-34b-instruct-hf'),
+    ('claude_3_sonnet', 'bedrock_chat', 'anthropic.claude-3-sonnet-20240229-v1:0'),
+    ('claude_3_haiku', 'bedrock_chat', 'anthropic.claude-3-haiku-20240307-v1:0'),
+    ('claude_v2', 'bedrock_chat', 'anthropic.claude-v2'),
+    ('claude_v2.1_200k', 'bedrock_chat', 'anthropic.claude-v2:1'),
+    ('amazon_titan_text_g1', 'bedrock', 'amazon.titan-text-express-v1'),
+    ('mixtral_8x7b_instruct', 'bedrock', 'mistral.mixtral-8x7b-instruct-v0:1'),
+    ('mistral_7b_instruct', 'bedrock', 'mistral.mistral-7b-instruct-v0:2'),
+    ('granite_13b_chat', 'watsonx', 'ibm/granite-13b-chat-v2'),
+    ('granite_13b_instruct', 'watsonx', 'ibm/granite-13b-instruct-v2'),
+    ('granite_20b_multilingual', 'watsonx', 'ibm/granite-20b-multilingual'),
+]:
+    register_model(key, provider, model_id)
+
+# The offline provider for tests and benchmarks, after every real model.
+register_model('stub', 'stub', 'stub')
+
+
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    for name, factory in config.get('providers', {}).items():
+        register_provider(name, factory)
+    for key, model in config.get('models', {}).items():
+        if 'provider' not in model:
+            raise ValueError(f"Model {key} in {path} has no provider")
+        register_model(key, model['provider'], model.get('model_id'), **model.get('options', {}))
+
+
+def get_provider(name):
+    factory = PROVIDERS[name]
+    if isinstance(factory, str):
+        module, _, attribute = factory.partition(':')
+        factory = PROVIDERS[name] = getattr(importlib.import_module(module), attribute)
+    return factory
+
+
+def build(provider, model_id, temperature=None, max_new_tokens=None, **options):
+    return get_provider(provider)(model_id, temperature, max_new_tokens, **options)
+
+
+def build_model(key, temperature, max_new_tokens):
+    model = MODELS.get(key, DEFAULT_MODEL)
+    return build(model['provider'], model['model_id'], temperature, max_new_tokens, **model['options'])
+
+
+def preload():
+    # Imports every provider up front, as the app did before providers were loaded lazily.
+    for name in list(PROVIDERS):
+        if name in PROVIDER_MODULES:
+            importlib.import_module(PROVIDER_MODULES[name])
+        else:
+            get_provider(name)
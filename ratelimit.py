@@ -0,0 +1,211 @@
+"""Per-provider rate limiting with adaptive (AIMD) backoff and throttle-aware retry.
+
+Every call to a model provider goes through the limiter of its provider family. Each limiter is a
+token bucket whose refill rate grows additively while calls succeed and is cut multiplicatively
+when the provider throttles, so throughput settles near the highest rate the account sustains.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import THROTTLES
+
+
+THROTTLE_MARKERS = (
+    'throttlingexception',
+    'toomanyrequestsexception',
+    'too many requests',
+    'rate limit',
+    'ratelimit',
+    'status code 429',
+    'error code: 429',
+)
+
+
+def is_throttle_error(error):
+    if type(error).__name__ in ('RateLimitError', 'ThrottlingException', 'TooManyRequestsException'):
+        return True
+    if getattr(error, 'status_code', None) == 429:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in ('ThrottlingException',
+                                                                                'TooManyRequestsException'):
+        return True
+    message = str(error).lower()
+    return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class ThrottledError(ValueError):
+    """A call the provider still throttled after every retry.
+
+    A ValueError whatever the provider raised, so it fails only its iteration or CSV row.
+    """
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose rate (requests per second) is adjusted with AIMD."""
+
+    def __init__(self, name, rate, max_rate, min_rate=0.1, increase=0.5, decrease=0.5, cooldown=1.0,
+                 max_retries=5, base_delay=0.5, max_delay=30.0, clock=time.monotonic, sleep=time.sleep,
+                 asleep=asyncio.sleep):
+        self.name = name
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.asleep = asleep
+        self.tokens = max(1.0, rate)
+        self.updated = clock()
+        self.last_decrease = None
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        # Takes a token and returns how long the caller has to wait for it.
+        with self.lock:
+            now = self.clock()
+            capacity = max(1.0, self.rate)
+            self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / max(1.0, self.rate))
+
+    def on_throttle(self):
+        with self.lock:
+            self.throttled += 1
+            THROTTLES.inc(provider=self.name)
+            now = self.clock()
+            # Concurrent calls tend to be throttled together; count that as a single congestion signal.
+            if self.last_decrease is None or now - self.last_decrease >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.last_decrease = now
+                logging.warning(f"{self.name} is throttling, lowering rate to {self.rate:.2f} req/s")
+
+    def backoff(self, attempt):
+        # Exponential backoff with full jitter.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttle_error(e):
+                    raise
+                self.on_throttle()
+                if attempt >= self.max_retries:
+                    logging.error(f"{self.name} still throttling after {attempt} retries: {e}")
+                    raise ThrottledError(f"{self.name} still throttling after {attempt} retries: {e}") from e
+                self.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+    async def acall(self, fn, *args, **kwargs):
+        # Same as call for a coroutine function, waiting without blocking the event loop.
+        attempt = 0
+        while True:
+            wait = self._reserve()
+            if wait > 0:
+                await self.asleep(wait)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_throttle_error(e):
+                    raise
+                self.on_throttle()
+                if attempt >= self.max_retries:
+                    logging.error(f"{self.name} still throttling after {attempt} retries: {e}")
+                    raise ThrottledError(f"{self.name} still throttling after {attempt} retries: {e}") from e
+                await self.asleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            self.on_success()
+            return result
+
+
+PROVIDER_DEFAULTS = {
+    # provider: (starting rate, max rate) in requests per second
+    'openai': (5.0, 50.0),
+    'bedrock': (2.0, 20.0),
+    'watsonx': (2.0, 10.0),
+    'stub': (200.0, 1000.0),
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def provider_family(llm):
+    family = getattr(llm, 'provider_family', None)
+    if family:
+        return family
+    module = type(llm).__module__
+    if module.startswith('langchain_openai'):
+        return 'openai'
+    if module.startswith('langchain_aws'):
+        return 'bedrock'
+    if module.startswith('langchain_ibm'):
+        return 'watsonx'
+    return None
+
+
+def get_limiter(provider):
+    with _limiters_lock:
+        if provider not in _limiters:
+            rate, max_rate = PROVIDER_DEFAULTS.get(provider, PROVIDER_DEFAULTS['openai'])
+            prefix = f"RATE_LIMIT_{provider.upper()}"
+            _limiters[provider] = AdaptiveRateLimiter(
+                provider,
+                rate=float(os.environ.get(prefix, rate)),
+                max_rate=float(os.environ.get(f"{prefix}_MAX", max_rate)),
+            )
+        return _limiters[provider]
+
+
+def rate_limited(llm, fn, *args, **kwargs):
+    # Clients of an unknown provider family are called directly.
+    provider = provider_family(llm)
+    if provider is None:
+        return fn(*args, **kwargs)
+    return get_limiter(provider).call(fn, *args, **kwargs)
+
+
+def throttled_mid_stream(llm, error):
+    # The error to raise for a stream that failed after its first token. A throttle there can't be
+    # retried without sending the tokens again, so the limiter slows down and it becomes a
+    # ThrottledError, which fails only its iteration. Any other error is returned as it is.
+    provider = provider_family(llm)
+    if provider is None or not is_throttle_error(error):
+        return error
+    get_limiter(provider).on_throttle()
+    return ThrottledError(f"{provider} throttled the stream after its first token: {error}")
+
+
+async def arate_limited(llm, fn, *args, **kwargs):
+    provider = provider_family(llm)
+    if provider is None:
+        return await fn(*args, **kwargs)
+    return await get_limiter(provider).acall(fn, *args, **kwargs)
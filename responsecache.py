@@ -0,0 +1,133 @@
+"""Content-addressed on-disk cache for model generations and judge results.
+
+Entries live in a local SQLite database in WAL mode, so several gunicorn workers can share one file.
+Keys are SHA-256 hashes of everything that determines a response; values are stored as JSON.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from sqlitestore import SQLiteStore
+
+
+READ_THROUGH = 'read-through'
+WRITE_ONLY = 'write-only'
+BYPASS = 'bypass'
+POLICIES = (READ_THROUGH, WRITE_ONLY, BYPASS)
+
+
+def make_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def check_policy(policy):
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown cache policy: {policy}. Use one of: {', '.join(POLICIES)}")
+    return policy
+
+
+class ResponseCache(SQLiteStore):
+    """SQLite-backed key/value cache with TTL and a cap on the number of entries."""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+    '''
+
+    def __init__(self, path, ttl=None, max_entries=None, prune_every=500):
+        super().__init__(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+            with self.lock:
+                self.misses += 1
+            return None
+        connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        with self.lock:
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value), now, now)
+        )
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        connection = self._connection()
+        if self.ttl is not None:
+            connection.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            connection.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def fetch(self, policy, key, compute):
+        # Returns (value, cached). Read-through serves hits and stores misses, write-only always
+        # computes but stores the result, and bypass leaves the cache alone.
+        if policy == READ_THROUGH:
+            try:
+                value = self.get(key)
+            except sqlite3.Error as e:
+                logging.error(f"Could not read from response cache: {e}")
+                value = None
+            if value is not None:
+                return value, True
+        value = compute()
+        if policy != BYPASS:
+            try:
+                self.set(key, value)
+            except sqlite3.Error as e:
+                logging.error(f"Could not write to response cache: {e}")
+        return value, False
+
+    async def afetch(self, policy, key, compute):
+        # Same as fetch for a coroutine function. The SQLite calls run in a worker thread so the
+        # event loop isn't blocked on disk.
+        if policy == READ_THROUGH:
+            try:
+                value = await asyncio.to_thread(self.get, key)
+            except sqlite3.Error as e:
+                logging.error(f"Could not read from response cache: {e}")
+                value = None
+            if value is not None:
+                return value, True
+        value = await compute()
+        if policy != BYPASS:
+            try:
+                await asyncio.to_thread(self.set, key, value)
+            except sqlite3.Error as e:
+                logging.error(f"Could not write to response cache: {e}")
+        return value, False
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes}
@@ -0,0 +1,257 @@
+"""Persistent store of every evaluation run and iteration, for historical comparisons.
+
+Runs and iterations live in a local SQLite database in WAL mode. Per-model and per-(prompt, model)
+aggregates are updated in the same transaction as each run is recorded, so reading them never scans
+the history. Iterations can be exported in bulk as Parquet, written in row groups straight from the
+database cursor so memory stays flat however many rows are exported.
+"""
+import hashlib
+import math
+import time
+
+from sqlitestore import SQLiteStore
+
+
+STATS_COLUMNS = {
+    'runs': 'INTEGER', 'iterations': 'INTEGER', 'scored': 'INTEGER', 'score_sum': 'REAL', 'score_sq_sum': 'REAL',
+    'min_score': 'INTEGER', 'max_score': 'INTEGER', 'generation_sum': 'REAL', 'generation_count': 'INTEGER',
+    'judge_sum': 'REAL', 'judge_count': 'INTEGER', 'first_seen': 'REAL', 'last_seen': 'REAL',
+}
+# The columns above as they appear in CREATE TABLE.
+STATS_SCHEMA = ', '.join(f'{column} {type_name}' for column, type_name in STATS_COLUMNS.items())
+SUMMED_COLUMNS = ('runs', 'iterations', 'scored', 'score_sum', 'score_sq_sum', 'generation_sum', 'generation_count',
+                  'judge_sum', 'judge_count')
+
+EXPORT_COLUMNS = [
+    # (name, SQL expression, pyarrow type name)
+    ('run_id', 'i.run_id', 'int64'),
+    ('created', 'r.created', 'float64'),
+    ('source', 'r.source', 'string'),
+    ('model', 'r.model', 'string'),
+    ('judge_model', 'r.judge_model', 'string'),
+    ('temperature', 'r.temperature', 'float64'),
+    ('max_new_tokens', 'r.max_new_tokens', 'int64'),
+    ('prompt_hash', 'r.prompt_hash', 'string'),
+    ('iteration', 'i.iteration', 'int64'),
+    ('score', 'i.score', 'int64'),
+    ('scoring_path', 'i.scoring_path', 'string'),
+    ('generation_seconds', 'i.generation_seconds', 'float64'),
+    ('judge_seconds', 'i.judge_seconds', 'float64'),
+    ('prediction', 'i.prediction', 'string'),
+    ('reason', 'i.reason', 'string'),
+]
+TEXT_COLUMNS = ('prediction', 'reason')
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def stats_upsert(table, keys):
+    # Adds one run's totals to its row of an aggregate table, creating the row on first use.
+    columns = keys + tuple(STATS_COLUMNS)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+        + ', '.join(f'{column} = {column} + excluded.{column}' for column in SUMMED_COLUMNS)
+        + ', min_score = MIN(COALESCE(min_score, excluded.min_score), COALESCE(excluded.min_score, min_score))'
+        + ', max_score = MAX(COALESCE(max_score, excluded.max_score), COALESCE(excluded.max_score, max_score))'
+        + ', last_seen = excluded.last_seen'
+    )
+
+
+def summarize(row):
+    # Turns an aggregate row into means and a standard deviation.
+    stats = dict(row)
+    scored = stats.pop('scored')
+    score_sum = stats.pop('score_sum')
+    score_sq_sum = stats.pop('score_sq_sum')
+    generation_sum, generation_count = stats.pop('generation_sum'), stats.pop('generation_count')
+    judge_sum, judge_count = stats.pop('judge_sum'), stats.pop('judge_count')
+    stats['scored_iterations'] = scored
+    stats['mean_score'] = score_sum / scored if scored else None
+    stats['score_stddev'] = (math.sqrt(max(0.0, (score_sq_sum - score_sum ** 2 / scored) / (scored - 1)))
+                             if scored > 1 else None)
+    stats['mean_generation_seconds'] = generation_sum / generation_count if generation_count else None
+    stats['mean_judge_seconds'] = judge_sum / judge_count if judge_count else None
+    return stats
+
+
+class ResultStore(SQLiteStore):
+    """SQLite store of evaluation runs, their iterations and running aggregates."""
+
+    SCHEMA = f'''
+        CREATE TABLE IF NOT EXISTS prompts (
+            prompt_hash TEXT PRIMARY KEY,
+            prompt TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL,
+            source TEXT NOT NULL,
+            model TEXT NOT NULL,
+            judge_model TEXT,
+            temperature REAL,
+            max_new_tokens INTEGER,
+            prompt_hash TEXT NOT NULL,
+            criteria TEXT,
+            expected_result TEXT,
+            iterations INTEGER,
+            iterations_run INTEGER NOT NULL,
+            avg_score REAL,
+            final_verdict TEXT,
+            elapsed REAL
+        );
+        CREATE INDEX IF NOT EXISTS runs_model ON runs (model, id);
+        CREATE INDEX IF NOT EXISTS runs_prompt ON runs (prompt_hash, id);
+        CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+        CREATE TABLE IF NOT EXISTS iterations (
+            run_id INTEGER NOT NULL,
+            iteration INTEGER NOT NULL,
+            score INTEGER,
+            scoring_path TEXT,
+            generation_seconds REAL,
+            judge_seconds REAL,
+            prediction TEXT,
+            reason TEXT,
+            PRIMARY KEY (run_id, iteration)
+        );
+        CREATE TABLE IF NOT EXISTS model_stats (
+            model TEXT PRIMARY KEY,
+            {STATS_SCHEMA}
+        );
+        CREATE TABLE IF NOT EXISTS prompt_stats (
+            prompt_hash TEXT NOT NULL,
+            model TEXT NOT NULL,
+            {STATS_SCHEMA},
+            PRIMARY KEY (prompt_hash, model)
+        );
+    '''
+
+    def record(self, source, run, eval_results):
+        # run holds model, judge_model, temperature, max_new_tokens, prompt, criteria, expected_result,
+        # iterations, avg_score, final_verdict and elapsed. Returns the id of the new run.
+        now = time.time()
+        digest = prompt_hash(run['prompt'])
+        iterations = []
+        for result in eval_results:
+            timings = result.get('timings', {})
+            iterations.append((result['iteration'], result.get('score'), result.get('scoring_path'),
+                               timings.get('generation'), timings.get('judge'),
+                               result.get('prediction'), result.get('reason')))
+        scores = [iteration[1] for iteration in iterations if iteration[1] is not None]
+        generations = [iteration[3] for iteration in iterations if iteration[3] is not None]
+        judgments = [iteration[4] for iteration in iterations if iteration[4] is not None]
+        totals = (1, len(iterations), len(scores), sum(scores), sum(score * score for score in scores),
+                  min(scores, default=None), max(scores, default=None), sum(generations), len(generations),
+                  sum(judgments), len(judgments), now, now)
+
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR IGNORE INTO prompts (prompt_hash, prompt) VALUES (?, ?)',
+                               (digest, run['prompt']))
+            run_id = connection.execute(
+                'INSERT INTO runs (created, source, model, judge_model, temperature, max_new_tokens, prompt_hash, '
+                'criteria, expected_result, iterations, iterations_run, avg_score, final_verdict, elapsed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (now, source, run['model'], run.get('judge_model'), run.get('temperature'),
+                 run.get('max_new_tokens'), digest, run.get('criteria'), run.get('expected_result'),
+                 run.get('iterations'), len(iterations), run.get('avg_score'), run.get('final_verdict'),
+                 run.get('elapsed'))
+            ).lastrowid
+            connection.executemany(
+                'INSERT INTO iterations (run_id, iteration, score, scoring_path, generation_seconds, judge_seconds, '
+                'prediction, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(run_id,) + iteration for iteration in iterations]
+            )
+            connection.execute(stats_upsert('model_stats', ('model',)), (run['model'],) + totals)
+            connection.execute(stats_upsert('prompt_stats', ('prompt_hash', 'model')),
+                               (digest, run['model']) + totals)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return run_id
+
+    def model_stats(self, model=None):
+        query = 'SELECT * FROM model_stats'
+        params = []
+        if model is not None:
+            query += ' WHERE model = ?'
+            params.append(model)
+        rows = self._connection().execute(query + ' ORDER BY model', params).fetchall()
+        return [summarize(row) for row in rows]
+
+    def prompt_stats(self, prompt_hash=None, model=None, limit=100):
+        query = 'SELECT s.*, p.prompt FROM prompt_stats s JOIN prompts p ON p.prompt_hash = s.prompt_hash'
+        conditions, params = [], []
+        if prompt_hash is not None:
+            conditions.append('s.prompt_hash = ?')
+            params.append(prompt_hash)
+        if model is not None:
+            conditions.append('s.model = ?')
+            params.append(model)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY s.last_seen DESC LIMIT ?'
+        rows = self._connection().execute(query, params + [limit]).fetchall()
+        return [summarize(row) for row in rows]
+
+    def runs(self, model=None, prompt_hash=None, source=None, since=None, until=None, before=None, limit=100):
+        # Newest first. Pass the smallest id of a page as before to get the next one.
+        conditions, params = [], []
+        for column, operator, value in (('model', '=', model), ('prompt_hash', '=', prompt_hash),
+                                        ('source', '=', source), ('created', '>=', since),
+                                        ('created', '<', until), ('id', '<', before)):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                params.append(value)
+        query = 'SELECT * FROM runs'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        rows = self._connection().execute(query + ' ORDER BY id DESC LIMIT ?', params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def run(self, run_id):
+        connection = self._connection()
+        row = connection.execute('SELECT r.*, p.prompt FROM runs r JOIN prompts p ON p.prompt_hash = r.prompt_hash '
+                                 'WHERE r.id = ?', (run_id,)).fetchone()
+        if row is None:
+            return None
+        run = dict(row)
+        run['eval_results'] = [dict(iteration) for iteration in connection.execute(
+            'SELECT iteration, score, scoring_path, generation_seconds, judge_seconds, prediction, reason '
+            'FROM iterations WHERE run_id = ? ORDER BY iteration', (run_id,))]
+        return run
+
+    def export_parquet(self, sink, model=None, since=None, until=None, include_text=True, batch_size=50000):
+        # Writes every iteration matching the filters, with its run's columns, to sink as Parquet.
+        # Returns the number of rows written.
+        import pyarrow as pa  # imported on first export, to keep it out of worker start-up
+        import pyarrow.parquet as pq
+
+        columns = [column for column in EXPORT_COLUMNS if include_text or column[0] not in TEXT_COLUMNS]
+        schema = pa.schema([(name, getattr(pa, type_name)()) for name, _, type_name in columns])
+        conditions, params = [], []
+        for column, operator, value in (('r.model', '=', model), ('r.created', '>=', since),
+                                        ('r.created', '<', until)):
+            if value is not None:
+                conditions.append(f'{column} {operator} ?')
+                params.append(value)
+        query = (f"SELECT {', '.join(expression for _, expression, _ in columns)} "
+                 'FROM iterations i JOIN runs r ON r.id = i.run_id')
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        cursor = self._connection().execute(query + ' ORDER BY i.run_id, i.iteration', params)
+
+        written = 0
+        with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                written += len(rows)
+        return written
@@ -0,0 +1,29 @@
+"""Base for the app's local SQLite stores: the response cache, the job store and the results store."""
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """A SQLite file in WAL mode, so several gunicorn workers can share it.
+
+    sqlite3 connections can't be shared between threads, so each thread opens its own, which sets
+    up the SCHEMA script of the subclass the first time.
+    """
+
+    SCHEMA = ''
+    SYNCHRONOUS = 'NORMAL'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f'PRAGMA synchronous={self.SYNCHRONOUS}')
+            connection.executescript(self.SCHEMA)
+            self.local.connection = connection
+        return connection
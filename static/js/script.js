@@ -40,7 +40,7 @@ document.getElementById('evaluation-form').addEventListener('submit', function(e
     const formData = new FormData(this);
     const resultTableDiv = document.getElementById('result-table');
     resultTableDiv.innerHTML = `
-        <p id="loading-indicator"><span class="spinner"></span> Processing iteration 1 of ${formData.get('iterations')}...</p>
+        <p id="loading-indicator"><span class="spinner"></span> Completed 0 of ${formData.get('iterations')} iterations...</p>
         <table>
             <thead>
                 <tr>
@@ -64,11 +64,75 @@ document.getElementById('evaluation-form').addEventListener('submit', function(e
     .then(response => {
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
-        let result = '';
+        let buffer = '';
+        let lastData = null;
         let processedIterations = new Set(); // Track processed iterations
         const totalIterations = parseInt(formData.get('iterations'), 10); // Total iterations
 
+        // With token streaming, a row is added on the first token of an iteration and filled in as text arrives
+        function iterationRow(iteration) {
+            let row = document.getElementById(`iteration-row-${iteration}`);
+            if (!row) {
+                document.getElementById('result-table-body').insertAdjacentHTML('beforeend', `
+                    <tr id="iteration-row-${iteration}">
+                        <td>${new Date().toLocaleDateString()}</td>
+                        <td>${formData.get('temperature')}</td>
+                        <td>${iteration}</td>
+                        <td class="prediction"></td>
+                        <td class="score"></td>
+                        <td class="reason"></td>
+                    </tr>
+                `);
+                row = document.getElementById(`iteration-row-${iteration}`);
+            }
+            return row;
+        }
+
+        function handleEvent(data) {
+            if (data.type === 'delta') {
+                iterationRow(data.iteration).querySelector('.prediction').textContent += data.delta;
+                return;
+            }
+            if (!data.iteration || processedIterations.has(data.iteration)) {
+                return;
+            }
+            processedIterations.add(data.iteration); // Mark this iteration as processed
+            const row = iterationRow(data.iteration);
+            row.querySelector('.prediction').innerHTML = data.prediction;
+            row.querySelector('.score').innerHTML = data.score;
+            row.querySelector('.reason').innerHTML = data.reason;
+
+            // Iterations run in parallel, so they may finish out of order
+            const completed = processedIterations.size;
+            const loadingIndicator = document.getElementById('loading-indicator');
+            if (loadingIndicator) {
+                if (completed < totalIterations) {
+                    loadingIndicator.innerHTML = `<span class="spinner"></span> Completed ${completed} of ${totalIterations} iterations...`;
+                } else {
+                    loadingIndicator.innerHTML = `<span class="spinner"></span> Completed ${completed} of ${totalIterations} iterations... Now processing the final evaluation...`;
+                }
+            }
+        }
+
         reader.read().then(function processText({ done, value }) {
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+
+            // Events are separated by a blank line; the last chunk may hold an incomplete one
+            const events = buffer.split('\n\n');
+            buffer = done ? '' : events.pop();
+            events.forEach(event => {
+                const line = event.split('\n').find(line => line.trim().startsWith('data:'));
+                if (!line) {
+                    return; // keep-alive comment
+                }
+                try {
+                    lastData = JSON.parse(line.trim().substring(5));
+                    handleEvent(lastData);
+                } catch (e) {
+                    console.error('Error parsing streamed data:', e);
+                }
+            });
+
             if (done) {
                 // Remove the loading indicator
                 const loadingIndicator = document.getElementById('loading-indicator');
@@ -76,60 +140,20 @@ document.getElementById('evaluation-form').addEventListener('submit', function(e
                     loadingIndicator.remove();
                 }
 
-                try {
-                    const data = JSON.parse(result.split("\n").filter(line => line.trim().startsWith("data:")).pop().substring(5));
+                if (lastData && lastData.eval_results) {
                     let finalResults = `
-                        <p>Average Score: ${data.avg_score}</p>
-                        <p>Final Verdict: ${data.final_verdict}</p>
+                        <p>Average Score: ${lastData.avg_score}</p>
+                        <p>Final Verdict: ${lastData.final_verdict}</p>
                     `;
                     resultTableDiv.insertAdjacentHTML('beforeend', finalResults);
                     document.getElementById('export-csv').classList.remove('hidden');
-                } catch (e) {
-                    console.error('Error parsing final response:', e);
+                } else {
+                    console.error('Error parsing final response:', lastData);
                     resultTableDiv.innerHTML = '<p>Error processing results. Please try again.</p>';
                 }
                 return;
             }
 
-            result += decoder.decode(value, { stream: true });
-
-            // Split the streamed results and update the table with new rows
-            const newResults = result.split("\n").filter(line => line.trim().startsWith("data:"));
-            let tableRows = '';
-
-            newResults.forEach(line => {
-                try {
-                    const data = JSON.parse(line.substring(5));
-                    if (data.iteration && !processedIterations.has(data.iteration)) {
-                        processedIterations.add(data.iteration); // Mark this iteration as processed
-                        tableRows += `
-                            <tr>
-                                <td>${new Date().toLocaleDateString()}</td>
-                                <td>${formData.get('temperature')}</td>
-                                <td>${data.iteration}</td>
-                                <td>${data.prediction}</td>
-                                <td>${data.score}</td>
-                                <td>${data.reason}</td>
-                            </tr>
-                        `;
-                        const loadingIndicator = document.getElementById('loading-indicator');
-                        if (loadingIndicator) {
-                            if (data.iteration < totalIterations) {
-                                loadingIndicator.innerHTML = `<span class="spinner"></span> Processing iteration ${data.iteration + 1} of ${totalIterations}...`;
-                            } else {
-                                loadingIndicator.innerHTML = `<span class="spinner"></span> Processing iteration ${data.iteration} of ${totalIterations}... Now processing the final evaluation...`;
-                            }
-                        }
-                    }
-                } catch (e) {
-                    console.error('Error parsing streamed data:', e);
-                }
-            });
-
-            if (tableRows) {
-                document.getElementById('result-table-body').insertAdjacentHTML('beforeend', tableRows);
-            }
-
             reader.read().then(processText);
         });
     })
@@ -147,16 +171,54 @@ document.getElementById('evaluation-form').addEventListener('submit', function(e
 document.getElementById('csv-upload-form').onsubmit = function(event) {
     event.preventDefault();
     var formData = new FormData(this);
+    var resultsDiv = document.getElementById('csv-results');
+    var rows = [];
 
     document.getElementById('spinner-csv').style.display = 'block';
+    resultsDiv.innerHTML = `
+        <table>
+            <thead>
+                <tr>
+                    <th>Row</th>
+                    <th>Model</th>
+                    <th>Temperature</th>
+                    <th>Average Score</th>
+                    <th>Final Verdict</th>
+                </tr>
+            </thead>
+            <tbody id="csv-results-body">
+            </tbody>
+        </table>
+    `;
 
-    fetch('/upload_csv', {
-        method: 'POST',
-        body: formData
-    })
-    .then(response => response.blob())
-    .then(blob => {
-        document.getElementById('spinner-csv').style.display = 'none';
+    // Each line of the response is the result of one row, sent as soon as the row is done
+    function renderRow(data) {
+        rows.push(data);
+        var body = document.getElementById('csv-results-body');
+        var verdict = data.error ? `Error: ${data.error}` : data.final_verdict;
+        body.insertAdjacentHTML('beforeend', `
+            <tr>
+                <td>${data.row || ''}</td>
+                <td>${data.model || ''}</td>
+                <td>${data.temperature !== undefined ? data.temperature : ''}</td>
+                <td>${data.avg_score !== undefined && data.avg_score !== null ? data.avg_score : ''}</td>
+                <td>${verdict}</td>
+            </tr>
+        `);
+    }
+
+    function downloadResults() {
+        var header = ['row', 'model', 'temperature', 'iteration', 'prediction', 'score', 'reason', 'avg_score', 'final_verdict', 'error'];
+        var lines = [header.join(',')];
+        var quote = value => `"${String(value === undefined || value === null ? '' : value).replace(/"/g, '""')}"`;
+        rows.forEach(data => {
+            var iterations = data.eval_results && data.eval_results.length ? data.eval_results : [{}];
+            iterations.forEach(result => {
+                lines.push([data.row, data.model, data.temperature, result.iteration, result.prediction, result.score,
+                            result.reason, data.avg_score, data.final_verdict, data.error].map(quote).join(','));
+            });
+        });
+        var blob = new Blob([lines.join('\n')], { type: 'text/csv;charset=utf-8;' });
         var url = window.URL.createObjectURL(blob);
         var a = document.createElement('a');
         a.style.display = 'none';
@@ -164,10 +226,45 @@ document.getElementById('csv-upload-form').onsubmit = function(event) {
         a.download = 'evaluation_results.csv';
         document.body.appendChild(a);
         a.click();
+        document.body.removeChild(a);
         window.URL.revokeObjectURL(url);
+    }
+
+    fetch('/upload_csv_stream', {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => {
+        if (!response.ok) {
+            return response.json().then(data => { throw new Error(data.error); });
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        return reader.read().then(function processLines({ done, value }) {
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = done ? '' : lines.pop();
+            lines.filter(line => line.trim()).forEach(line => {
+                try {
+                    renderRow(JSON.parse(line));
+                } catch (e) {
+                    console.error('Error parsing streamed row:', e);
+                }
+            });
+
+            if (done) {
+                document.getElementById('spinner-csv').style.display = 'none';
+                downloadResults();
+                return;
+            }
+            return reader.read().then(processLines);
+        });
     })
     .catch(error => {
-        document.getElementById('spinner').style.display = 'none';
+        document.getElementById('spinner-csv').style.display = 'none';
+        resultsDiv.innerHTML = `<p>Error occurred: ${error.message}</p>`;
         console.error('Error:', error);
     });
 };
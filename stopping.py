@@ -0,0 +1,74 @@
+"""Sequential stopping of evaluation iterations once the scores have converged."""
+import math
+import threading
+
+
+# Two-sided 95% critical values of Student's t distribution by degrees of freedom.
+T_95 = {
+    1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228,
+    11: 2.201, 12: 2.179, 13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101, 19: 2.093,
+    20: 2.086, 21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064, 25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048,
+    29: 2.045, 30: 2.042, 40: 2.021, 60: 2.000, 120: 1.980,
+}
+
+
+def t_critical(df):
+    if df in T_95:
+        return T_95[df]
+    larger = [key for key in T_95 if key > df]
+    # Between table entries use the next smaller df (a wider interval); past the table use the normal value.
+    return T_95[max(key for key in T_95 if key < df)] if larger else 1.960
+
+
+def confidence_interval(scores):
+    # 95% confidence interval of the mean score, or None with fewer than two scores.
+    n = len(scores)
+    if n < 2:
+        return None
+    mean = sum(scores) / n
+    variance = sum((score - mean) ** 2 for score in scores) / (n - 1)
+    half_width = t_critical(n - 1) * math.sqrt(variance / n)
+    return [mean - half_width, mean + half_width]
+
+
+class EarlyStopping:
+    """Tracks the scores of a run and reports when their confidence interval is narrower than tolerance."""
+
+    def __init__(self, tolerance, min_iterations=3):
+        # float() accepts 'nan' and 'inf', with which the interval would never or always be narrow enough.
+        if not math.isfinite(tolerance):
+            raise ValueError('tolerance must be a finite number')
+        if tolerance <= 0:
+            raise ValueError('tolerance must be greater than 0')
+        if min_iterations < 2:
+            raise ValueError('min_iterations must be at least 2')
+        self.tolerance = tolerance
+        self.min_iterations = min_iterations
+        self.scores = []
+        self.converged = False
+        self.lock = threading.Lock()
+
+    def add(self, score):
+        # Returns True the first time the run converges.
+        if score is None:
+            return False
+        with self.lock:
+            self.scores.append(score)
+            if self.converged or len(self.scores) < self.min_iterations:
+                return False
+            low, high = confidence_interval(self.scores)
+            self.converged = high - low < self.tolerance
+            return self.converged
+
+    def interval(self):
+        with self.lock:
+            return confidence_interval(self.scores)
+
+
+def parse_early_stopping(tolerance, min_iterations=None):
+    # Builds an EarlyStopping from form or CSV values; an empty tolerance disables it.
+    if tolerance in (None, ''):
+        return None
+    if min_iterations in (None, ''):
+        return EarlyStopping(float(tolerance))
+    return EarlyStopping(float(tolerance), int(min_iterations))
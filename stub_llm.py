@@ -0,0 +1,128 @@
+"""Offline stand-in for the model providers, for tests and benchmarks.
+
+StubLLM answers without any network access after a configurable delay, can inject errors and
+provider throttling, and as a judge returns canned reasoning with a ``[[score]]`` rating, so the
+real ``labeled_score_string`` evaluator runs on top of it.
+
+Latency specs:
+    fixed:SECONDS
+    uniform:LOW:HIGH
+    normal:MEAN:STDDEV
+    lognormal:MEDIAN:SIGMA
+"""
+import asyncio
+import math
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+def sample_latency(spec):
+    kind, *args = spec.split(':')
+    args = [float(arg) for arg in args]
+    if kind == 'fixed':
+        return args[0]
+    if kind == 'uniform':
+        return random.uniform(args[0], args[1])
+    if kind == 'normal':
+        return max(0.0, random.gauss(args[0], args[1]))
+    if kind == 'lognormal':
+        return random.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class StubLLM(LLM):
+    role: str = 'model'
+    model_id: str = 'stub'
+    provider_family: str = 'stub'
+    latency: str = 'fixed:0'
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    score: Optional[int] = None
+    tokens: int = 20
+
+    @property
+    def _llm_type(self):
+        return 'stub'
+
+    def _maybe_fail(self):
+        roll = random.random()
+        if roll < self.throttle_rate:
+            # Same shape as the error langchain_aws raises when Bedrock throttles.
+            raise ValueError('Error raised by bedrock service: An error occurred (ThrottlingException) when '
+                             'calling the InvokeModel operation: Too many requests, please wait before trying again.')
+        if roll < self.throttle_rate + self.error_rate:
+            raise ValueError('Error raised by stub service: injected failure')
+
+    def _response(self, prompt):
+        if self.role == 'judge':
+            score = self.score if self.score is not None else random.randint(1, 10)
+            return (f"The response addresses the question and follows the reference in most respects. "
+                    f"Rating: [[{score}]]")
+        words = ' '.join(f'token{i}' for i in range(max(0, self.tokens - 5)))
+        return f"Stub answer to: {prompt[:40]} {words}".strip()
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        time.sleep(sample_latency(self.latency))
+        self._maybe_fail()
+        return self._response(prompt)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None,
+                **kwargs: Any) -> Iterator[GenerationChunk]:
+        # The latency is spread over the tokens, with the first token taking a fifth of it.
+        latency = sample_latency(self.latency)
+        words = self._response(prompt).split(' ')
+        time.sleep(latency / 5)
+        self._maybe_fail()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(latency * 4 / 5 / len(words))
+            chunk = GenerationChunk(text=word if i == len(words) - 1 else word + ' ')
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    # The async API sleeps on the event loop, like a client waiting on the network would.
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        await asyncio.sleep(sample_latency(self.latency))
+        self._maybe_fail()
+        return self._response(prompt)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        latency = sample_latency(self.latency)
+        words = self._response(prompt).split(' ')
+        await asyncio.sleep(latency / 5)
+        self._maybe_fail()
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(latency * 4 / 5 / len(words))
+            chunk = GenerationChunk(text=word if i == len(words) - 1 else word + ' ')
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def stub_settings(role):
+    # Reads the stub behaviour from STUB_* (model under test) and STUB_JUDGE_* (judge) variables.
+    prefix = 'STUB_JUDGE_' if role == 'judge' else 'STUB_'
+    settings = {
+        'role': role,
+        'model_id': 'stub-judge' if role == 'judge' else 'stub',
+        'latency': os.environ.get(f'{prefix}LATENCY', 'fixed:0'),
+        'error_rate': float(os.environ.get(f'{prefix}ERROR_RATE', 0)),
+        'throttle_rate': float(os.environ.get(f'{prefix}THROTTLE_RATE', 0)),
+        'tokens': int(os.environ.get(f'{prefix}TOKENS', 20)),
+    }
+    if os.environ.get(f'{prefix}SCORE'):
+        settings['score'] = int(os.environ[f'{prefix}SCORE'])
+    return settings
+
+
+def build_stub_llm(role='model'):
+    return StubLLM(**stub_settings(role))
@@ -1,4 +1,12 @@
+import io
 import json
+import threading
+import time
+
+import pytest
+
+import app as app_module
+from responsecache import ResponseCache
 
 def test_index(client):
     response = client.get('/')
@@ -66,3 +74,530 @@ def test_evaluate_stream(client):
         stream_data += line
 
     assert b'iterations completed' in stream_data or b'Error occurred' in stream_data
+
+
+class FakeLLM:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, prompt):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return f"Answer to: {prompt}"
+
+
+class FakeEvaluator:
+    def evaluate_strings(self, prediction, input, reference):
+        return {'reasoning': 'Looks fine. Rating: [[7]]'}
+
+
+def patch_models(monkeypatch, llm, evaluator=None, judge=None):
+    monkeypatch.setattr(app_module, 'get_llm', lambda model, temperature, max_new_tokens: llm)
+    monkeypatch.setattr(app_module, 'get_llm_evaluator', lambda model: judge or FakeLLM())
+    monkeypatch.setattr(app_module, 'get_evaluator', lambda llm_evaluator, criteria: evaluator or FakeEvaluator())
+
+
+def offline_form(**overrides):
+    data = {
+        'model': 'fake',
+        'temperature': '0',
+        'max_new_tokens': '100',
+        'prompt': 'Write a poem about the sea.',
+        'criteria': 'Score 10: Perfect. Score 1: Bad.',
+        'iterations': '6',
+        'expected_result': 'A beautiful poem about the sea.'
+    }
+    data.update(overrides)
+    return data
+
+def test_evaluate_runs_iterations_concurrently(client, monkeypatch):
+    llm = FakeLLM(delay=0.05)
+    patch_models(monkeypatch, llm)
+    response = client.post('/evaluate', data=offline_form(max_concurrency='3'))
+    assert response.status_code == 200
+    response_data = response.get_json()
+    assert [r['iteration'] for r in response_data['eval_results']] == [1, 2, 3, 4, 5, 6]
+    assert response_data['avg_score'] == 7
+    assert llm.peak == 3
+
+def test_evaluate_concurrency_capped_by_server(client, monkeypatch):
+    llm = FakeLLM(delay=0.05)
+    patch_models(monkeypatch, llm)
+    monkeypatch.setitem(app_module.app.config, 'MAX_CONCURRENCY', 2)
+    response = client.post('/evaluate', data=offline_form(max_concurrency='10'))
+    assert response.status_code == 200
+    assert llm.peak == 2
+
+def test_evaluate_invalid_concurrency(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response = client.post('/evaluate', data=offline_form(max_concurrency='0'))
+    assert response.status_code == 400
+
+def test_evaluate_stream_tags_iterations(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.01))
+    response = client.post('/evaluate_stream', data=offline_form(iterations='4'))
+    events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+    assert sorted(event['iteration'] for event in events[:-1]) == [1, 2, 3, 4]
+    assert events[-1]['avg_score'] == 7
+    assert [r['iteration'] for r in events[-1]['eval_results']] == [1, 2, 3, 4]
+
+def test_evaluate_stream_reports_invalid_fields(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    for data, error in [({}, 'Missing required field: model'),
+                        (offline_form(max_concurrency='0'), 'max_concurrency must be at least 1')]:
+        response = client.post('/evaluate_stream', data=data)
+        assert response.status_code == 200
+        events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+        assert events == [{'error': error}]
+
+def offline_csv(rows):
+    header = 'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+    return io.BytesIO((header + '\n'.join(rows)).encode())
+
+def test_upload_csv_batch_keeps_row_order(client, monkeypatch):
+    llm = FakeLLM(delay=0.02)
+    patch_models(monkeypatch, llm)
+    rows = [f'fake_{i},0,100,Prompt {i},Score 10: Perfect.,3,Answer {i}' for i in range(5)]
+    response = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv')})
+    assert response.status_code == 200
+    response_data = response.get_json()
+    assert [r['model'] for r in response_data] == [f'fake_{i}' for i in range(5)]
+    assert all([e['iteration'] for e in r['eval_results']] == [1, 2, 3] for r in response_data)
+    assert response_data[2]['eval_results'][0]['prediction'] == 'Answer to: Prompt 2'
+    assert llm.peak > 1
+
+class ModelEvaluator(FakeEvaluator):
+    # Judges through a model, so its calls count towards that model's peak.
+    def __init__(self, llm):
+        self.llm = llm
+
+    def evaluate_strings(self, prediction, input, reference):
+        self.llm(prediction)
+        return super().evaluate_strings(prediction, input, reference)
+
+def test_upload_csv_batch_calls_capped_by_max_concurrency(client, monkeypatch):
+    # Generations, judgments and final verdicts all count towards the same max_concurrency.
+    llm = FakeLLM(delay=0.02)
+    patch_models(monkeypatch, llm, ModelEvaluator(llm), judge=llm)
+    rows = [f'fake,0,100,Prompt {i},Score 10: Perfect.,3,Answer {i}' for i in range(4)]
+    for max_concurrency in (1, 2):
+        llm.peak = 0
+        response = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv'),
+                                                     'max_concurrency': str(max_concurrency)})
+        assert all(r['avg_score'] == 7 for r in response.get_json())
+        assert llm.peak == max_concurrency
+
+def test_upload_csv_batch_row_error(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    rows = [
+        'fake,0,100,Prompt,Score 10: Perfect.,2,Answer',
+        'broken,hot,100,Prompt,Score 10: Perfect.,2,Answer',
+        'fake,0,100,Prompt,Score 10: Perfect.,2,Answer',
+    ]
+    response = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv')})
+    response_data = response.get_json()
+    assert response_data[1] == {'model': 'broken', 'error': "could not convert string to float: 'hot'"}
+    assert response_data[0]['avg_score'] == 7
+    assert response_data[2]['avg_score'] == 7
+
+def test_clients_are_reused_across_requests(client, monkeypatch):
+    built = []
+    monkeypatch.setattr(app_module, 'build_llm', lambda *args: built.append(args) or FakeLLM())
+    monkeypatch.setattr(app_module, 'get_llm_evaluator', lambda model: FakeLLM())
+    monkeypatch.setattr(app_module, 'get_evaluator', lambda llm_evaluator, criteria: FakeEvaluator())
+    app_module.llm_clients.clear()
+    for _ in range(3):
+        assert client.post('/evaluate', data=offline_form(iterations='1')).status_code == 200
+    assert len(built) == 1
+    stats = client.get('/stats').get_json()
+    assert stats['llm_clients']['hits'] == 2
+    assert stats['llm_clients']['misses'] == 1
+
+def test_evaluate_read_through_cache(client, monkeypatch, tmp_path):
+    llm = FakeLLM()
+    calls = []
+    patch_models(monkeypatch, lambda prompt: calls.append(prompt) or llm(prompt))
+    monkeypatch.setattr(app_module, 'response_cache', ResponseCache(str(tmp_path / 'cache.sqlite3')))
+    first = client.post('/evaluate', data=offline_form(iterations='1', cache='read-through')).get_json()
+    second = client.post('/evaluate', data=offline_form(iterations='2', cache='read-through')).get_json()
+    # At temperature 0 both iterations share a single cached generation.
+    assert len(calls) == 1
+    assert [r['cached'] for r in second['eval_results']] == [{'prediction': True, 'judgment': True}] * 2
+    assert first['avg_score'] == second['avg_score']
+
+def test_upload_csv_stream_emits_ndjson(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.01))
+    rows = [f'fake_{i},0,100,Prompt {i},Score 10: Perfect.,2,Answer {i}' for i in range(4)]
+    rows.append('broken,hot,100,Prompt,Score 10: Perfect.,2,Answer')
+    response = client.post('/upload_csv_stream', data={'file': (offline_csv(rows), 'test.csv')})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line['row'] for line in lines] == [1, 2, 3, 4, 5]
+    assert lines[0]['avg_score'] == 7
+    assert 'error' in lines[4]
+
+def test_run_batch_reads_rows_lazily(monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    pulled = []
+
+    def experiments():
+        for i in range(50):
+            pulled.append(i)
+            yield {'model': 'fake', 'temperature': '0', 'max_new_tokens': '10', 'prompt': f'Prompt {i}',
+                   'criteria': 'c', 'iterations': '1', 'expected_result': 'e'}
+
+    batch = app_module.run_batch(experiments(), max_concurrency=2, max_pending_rows=4)
+    assert next(batch)[0] == 0
+    assert len(pulled) <= 5
+    assert [index for index, _ in batch] == list(range(1, 50))
+
+def test_evaluate_stream_disconnect_cancels_pending_iterations(client, monkeypatch):
+    llm = FakeLLM(delay=0.05)
+    verdicts = []
+    patch_models(monkeypatch, llm)
+    monkeypatch.setattr(app_module, 'get_final_verdict', lambda *args: verdicts.append(args) or 'Verdict')
+    before = client.get('/stats').get_json()['cancellations']
+    response = client.post('/evaluate_stream', data=offline_form(iterations='20', max_concurrency='2'),
+                           buffered=False)
+    first = next(iter(response.response))
+    assert first.startswith(b'data:')
+    response.close()
+    stats = client.get('/stats').get_json()['cancellations']
+    assert stats['disconnects'] == before['disconnects'] + 1
+    assert stats['cancelled_calls'] >= before['cancelled_calls'] + 15
+    assert verdicts == []
+
+def test_evaluate_stream_sends_keep_alive(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.1))
+    monkeypatch.setitem(app_module.app.config, 'STREAM_HEARTBEAT', 0.02)
+    response = client.post('/evaluate_stream', data=offline_form(iterations='1'))
+    assert b': keep-alive' in response.get_data()
+
+class FakeStreamingLLM(FakeLLM):
+    def stream(self, prompt):
+        for word in self(prompt).split(' '):
+            yield word + ' '
+
+def test_evaluate_stream_tokens(client, monkeypatch):
+    patch_models(monkeypatch, FakeStreamingLLM())
+    response = client.post('/evaluate_stream', data=offline_form(iterations='2', stream_tokens='true'))
+    events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+    deltas = [event for event in events if event.get('type') == 'delta']
+    results = [event for event in events if 'score' in event]
+    assert ''.join(d['delta'] for d in deltas if d['iteration'] == 1) == 'Answer to: Write a poem about the sea. '
+    # Every delta of an iteration arrives before its score.
+    for result in results:
+        last_delta = max(i for i, event in enumerate(events) if event.get('iteration') == result['iteration']
+                         and event.get('type') == 'delta')
+        assert last_delta < events.index(result)
+        assert result['ttft'] is not None
+    assert events[-1]['avg_score'] == 7
+
+class ThrottledStreamingLLM:
+    # Streams 'a b c', throttled at the token index given for each attempt.
+    provider_family = 'throttled_stream'
+
+    def __init__(self, *throttle_at):
+        self.throttle_at = list(throttle_at)
+        self.attempts = 0
+
+    def stream(self, prompt):
+        self.attempts += 1
+        throttle_at = self.throttle_at.pop(0) if self.throttle_at else None
+        for i, word in enumerate(['a ', 'b ', 'c']):
+            if i == throttle_at:
+                raise self.throttle()
+            yield word
+
+    def throttle(self):
+        return ValueError('Error raised by bedrock service: ThrottlingException: Rate exceeded')
+
+class RateLimitError(Exception):
+    # Shaped like openai's throttle error, which isn't a ValueError.
+    status_code = 429
+
+class RateLimitedStreamingLLM(ThrottledStreamingLLM):
+    def throttle(self):
+        return RateLimitError('Rate limit reached for requests')
+
+def test_stream_retries_only_before_the_first_token():
+    from ratelimit import get_limiter
+    get_limiter('throttled_stream').base_delay = 0.001
+    tokens = []
+    llm = ThrottledStreamingLLM(0)
+    assert app_module.stream_llm(llm, 'Prompt', tokens.append)[0] == 'a b c'
+    assert llm.attempts == 2
+    assert tokens == ['a ', 'b ', 'c']
+
+    # Throttled once tokens were sent: the iteration fails rather than sending them twice.
+    tokens = []
+    llm = ThrottledStreamingLLM(2)
+    with pytest.raises(ValueError):
+        app_module.stream_llm(llm, 'Prompt', tokens.append)
+    assert llm.attempts == 1
+    assert tokens == ['a ', 'b ']
+
+def test_evaluate_stream_fails_only_the_iteration_throttled_mid_stream(client, monkeypatch):
+    from ratelimit import get_limiter
+    get_limiter('throttled_stream').base_delay = 0.001
+    patch_models(monkeypatch, RateLimitedStreamingLLM(2, None))
+    response = client.post('/evaluate_stream', data=offline_form(iterations='2', stream_tokens='true',
+                                                                 max_concurrency='1'))
+    events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+    results = [event for event in events if 'score' in event]
+    assert [(r['iteration'], r['prediction']) for r in results] == [(1, None), (2, 'a b c')]
+    assert 'throttled the stream after its first token' in results[0]['reason']
+    assert events[-1]['iterations_run'] == 2
+    assert events[-1]['avg_score'] == 7
+
+class AlwaysThrottledLLM:
+    provider_family = 'always_throttled'
+
+    def __call__(self, prompt):
+        raise RateLimitError('Error code: 429 - Rate limit reached')
+
+def test_upload_csv_throttled_row_fails_alone(client, monkeypatch):
+    from ratelimit import get_limiter
+    limiter = get_limiter('always_throttled')
+    # Backs off briefly and never slows down, so the retries run out quickly.
+    limiter.rate, limiter.base_delay, limiter.decrease = 1000.0, 0.001, 1.0
+    llms = {'fake': FakeLLM(), 'throttled': AlwaysThrottledLLM()}
+    patch_models(monkeypatch, None)
+    monkeypatch.setattr(app_module, 'get_llm', lambda model, temperature, max_new_tokens: llms[model])
+    rows = [f'{model},0,100,Prompt {i},Score 10: Perfect.,2,Answer' for i, model in
+            enumerate(['fake', 'throttled', 'fake'])]
+    response = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv')})
+    assert response.status_code == 200
+    response_data = response.get_json()
+    assert [r['avg_score'] for r in (response_data[0], response_data[2])] == [7, 7]
+    assert 'still throttling' in response_data[1]['error']
+
+def test_metrics_endpoint(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response_data = client.post('/evaluate', data=offline_form(iterations='2')).get_json()
+    timings = response_data['eval_results'][0]['timings']
+    assert set(timings) == {'generation', 'judge', 'score_parse'}
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert '# TYPE llmeval_stage_seconds histogram' in body
+    assert 'llmeval_stage_seconds_count{stage="generation",model="fake",provider="other"}' in body
+    assert 'llmeval_in_flight{stage="judge"} 0' in body
+    assert '# TYPE llmeval_registry_lookups_total counter' in body
+    assert '# TYPE llmeval_response_cache_operations_total counter' in body
+
+def stage_count(client, stage, model):
+    prefix = f'llmeval_stage_seconds_count{{stage="{stage}",model="{model}",provider="other"}} '
+    lines = client.get('/metrics').get_data(as_text=True).splitlines()
+    return next((int(line[len(prefix):]) for line in lines if line.startswith(prefix)), 0)
+
+def test_stage_metrics_time_only_provider_calls(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    rows = ['metered,0.5,100,Prompt,Score 10: Perfect.,2,Answer'] * 2
+    response_data = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv')}).get_json()
+    # Both iterations generate the same prediction, so the second one shares the first one's judgment.
+    assert [r['calls_saved'] for r in response_data] == [1, 4]
+    # The shared generations of the second row aren't counted as provider calls.
+    assert stage_count(client, 'generation', 'metered') == 2
+    assert all('generation' in r['timings'] for r in response_data[1]['eval_results'])
+
+def test_evaluate_with_stub_provider(client, monkeypatch):
+    monkeypatch.setenv('STUB_JUDGE_SCORE', '6')
+    app_module.llm_clients.clear()
+    app_module.evaluators.clear()
+    response = client.post('/evaluate', data=offline_form(model='stub', iterations='3'))
+    assert response.status_code == 200
+    response_data = response.get_json()
+    assert [r['score'] for r in response_data['eval_results']] == [6, 6, 6]
+    assert response_data['avg_score'] == 6
+    assert 'Rating: [[6]]' in response_data['final_verdict']
+
+def test_evaluate_stops_early_when_scores_converge(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.01))
+    response = client.post('/evaluate', data=offline_form(iterations='10', max_concurrency='1', tolerance='0.5'))
+    assert response.status_code == 200
+    response_data = response.get_json()
+    # The worker may already have started the fourth iteration when the third one converges.
+    assert response_data['iterations_run'] in (3, 4)
+    assert len(response_data['eval_results']) == response_data['iterations_run']
+    assert response_data['stopped_early'] is True
+    assert response_data['confidence_interval'] == [7, 7]
+
+def test_evaluate_invalid_tolerance(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response = client.post('/evaluate', data=offline_form(tolerance='-1'))
+    assert response.status_code == 400
+    response = client.post('/evaluate', data=offline_form(tolerance='nan'))
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'tolerance must be a finite number'}
+
+def test_evaluate_stream_invalid_early_stopping(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    for fields, error in [({'tolerance': '-1'}, 'tolerance must be greater than 0'),
+                          ({'tolerance': 'nan'}, 'tolerance must be a finite number'),
+                          ({'tolerance': '0.5', 'min_iterations': '1'}, 'min_iterations must be at least 2'),
+                          ({'tolerance': '0.5', 'min_iterations': 'few'}, "invalid literal for int() with base 10: 'few'")]:
+        response = client.post('/evaluate_stream', data=offline_form(**fields))
+        events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+        assert events == [{'error': error}]
+
+def test_upload_csv_row_stops_early(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.01))
+    csv_file = io.BytesIO(b'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result,tolerance\n'
+                          b'fake,0.5,100,Prompt,Score 10: Perfect.,12,Answer,0.5\n'
+                          b'fake,0,100,Prompt,Score 10: Perfect.,4,Answer,\n')
+    response = client.post('/upload_csv', data={'file': (csv_file, 'test.csv'), 'max_concurrency': '1'})
+    first, second = response.get_json()
+    assert first['iterations_run'] < 12
+    assert first['stopped_early'] is True
+    assert [r['iteration'] for r in first['eval_results']] == list(range(1, first['iterations_run'] + 1))
+    assert second['iterations_run'] == 4
+    assert 'confidence_interval' not in second
+
+def test_upload_csv_shares_identical_calls(client, monkeypatch):
+    llm = FakeLLM(delay=0.01)
+    generations = []
+    judgments = []
+
+    class CountingEvaluator(FakeEvaluator):
+        def evaluate_strings(self, prediction, input, reference):
+            judgments.append((prediction, reference))
+            return super().evaluate_strings(prediction, input, reference)
+
+    monkeypatch.setattr(app_module, 'get_llm', lambda model, temperature, max_new_tokens:
+                        lambda prompt: generations.append(prompt) or llm(prompt))
+    monkeypatch.setattr(app_module, 'get_llm_evaluator', lambda model: FakeLLM())
+    monkeypatch.setattr(app_module, 'get_evaluator', lambda llm_evaluator, criteria: CountingEvaluator())
+    before = client.get('/stats').get_json()['deduplicated']
+    rows = [
+        'fake,0,100,Same prompt,Score 10: Perfect.,3,Answer A',
+        'fake,0,100,Same prompt,Score 10: Strict.,3,Answer B',
+        'fake,0,100,Other prompt,Score 10: Perfect.,2,Answer A',
+    ]
+    response = client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv'), 'max_concurrency': '1'})
+    response_data = response.get_json()
+    # Every iteration of a row is generated, as in /evaluate, and rows share the generation of the same
+    # iteration. Identical predictions are judged once per (criteria, reference), whatever their iteration.
+    assert sorted(generations) == ['Other prompt'] * 2 + ['Same prompt'] * 3
+    assert len(judgments) == 3
+    assert [r['calls_saved'] for r in response_data] == [2, 5, 1]
+    assert all(r['avg_score'] == 7 for r in response_data)
+    stats = client.get('/stats').get_json()['deduplicated']
+    assert stats['generation'] == before['generation'] + 3
+    assert stats['judgment'] == before['judgment'] + 5
+
+def test_evaluate_prescore_skips_the_judge(client, monkeypatch):
+    judged = []
+
+    class CountingEvaluator(FakeEvaluator):
+        def evaluate_strings(self, prediction, input, reference):
+            judged.append(prediction)
+            return super().evaluate_strings(prediction, input, reference)
+
+    patch_models(monkeypatch, FakeLLM())
+    monkeypatch.setattr(app_module, 'get_evaluator', lambda llm_evaluator, criteria: CountingEvaluator())
+    form = offline_form(iterations='2', prescore='default', expected_result='answer to: write a poem about the sea')
+    response_data = client.post('/evaluate', data=form).get_json()
+    assert judged == []
+    assert [r['scoring_path'] for r in response_data['eval_results']] == ['local:normalized_match'] * 2
+    assert response_data['avg_score'] == 10
+
+    response_data = client.post('/evaluate', data=offline_form(iterations='2', prescore='default')).get_json()
+    assert len(judged) == 2
+    assert [r['scoring_path'] for r in response_data['eval_results']] == ['judge'] * 2
+
+def test_evaluate_invalid_prescore(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response = client.post('/evaluate', data=offline_form(prescore='[{"scorer": "bleu", "score": 1}]'))
+    assert response.status_code == 400
+    response = client.post('/evaluate', data=offline_form(prescore='[{"scorer": "token_f1", "min": "0.5", "score": 5}]'))
+    assert response.status_code == 400
+    for pattern in ('5', 'null'):
+        rules = f'[{{"scorer": "regex", "pattern": {pattern}, "score": 1}}]'
+        response = client.post('/evaluate', data=offline_form(prescore=rules))
+        assert response.status_code == 400
+        assert 'string pattern' in response.get_json()['error']
+        response = client.post('/jobs', data={'file': (offline_csv([]), 'test.csv'), 'prescore': rules})
+        assert response.status_code == 400
+
+def compare_form(**overrides):
+    data = offline_form(iterations='2')
+    del data['model']
+    data.update(overrides)
+    return data
+
+def test_compare_streams_models_as_they_finish(client, monkeypatch):
+    llms = {'slow': FakeLLM(delay=0.2), 'fast': FakeLLM(delay=0.01)}
+    judges = []
+    patch_models(monkeypatch, None)
+    monkeypatch.setattr(app_module, 'get_llm', lambda model, temperature, max_new_tokens: llms[model])
+    monkeypatch.setattr(app_module, 'get_llm_evaluator', lambda model: judges.append(model) or FakeLLM())
+    response = client.post('/compare', data=compare_form(models='slow,fast', max_concurrency='4'))
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/event-stream'
+    events = [json.loads(line[5:]) for line in response.get_data(as_text=True).split('\n') if line.startswith('data:')]
+    assert [event['model'] for event in events[:-1]] == ['fast', 'slow']
+    assert all(event['avg_score'] == 7 for event in events[:-1])
+    # One judge is built for the whole comparison.
+    assert len(judges) == 1
+    ranking = events[-1]['ranking']
+    assert [entry['rank'] for entry in ranking] == [1, 2]
+    # Equal scores are ranked by generation latency.
+    assert [entry['model'] for entry in ranking] == ['fast', 'slow']
+    assert ranking[0]['mean_generation_seconds'] < ranking[1]['mean_generation_seconds']
+
+def test_compare_validation_and_ranking(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response = client.post('/compare', data=compare_form(models=['fake', 'other'], iterations='x'))
+    assert response.status_code == 400
+    response = client.post('/compare', data=compare_form(models='fake,other,fake', tolerance='0.5',
+                                                         min_iterations='1'))
+    assert response.status_code == 400
+    ranking = app_module.rank_models([
+        {'model': 'broken', 'error': 'boom'},
+        {'model': 'good', 'avg_score': 8, 'eval_results': []},
+    ])
+    assert [entry['model'] for entry in ranking] == ['good', 'broken']
+    assert ranking[1]['error'] == 'boom'
+
+def test_compare_limits_models(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    monkeypatch.setitem(app_module.app.config, 'MAX_COMPARE_MODELS', 2)
+    response = client.post('/compare', data=compare_form(models='a,b,c'))
+    assert response.status_code == 400
+
+def test_runs_are_recorded_and_queryable(client, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    first = client.post('/evaluate', data=offline_form(iterations='2')).get_json()
+    rows = ['fake,0,100,Write a poem about the sea.,Score 10: Perfect.,3,Answer']
+    client.post('/upload_csv', data={'file': (offline_csv(rows), 'test.csv')})
+    run = client.get(f"/results/runs/{first['run_id']}").get_json()
+    assert run['source'] == 'evaluate'
+    assert [r['score'] for r in run['eval_results']] == [7, 7]
+    runs = client.get('/results/runs?model=fake').get_json()
+    assert [r['source'] for r in runs] == ['upload_csv', 'evaluate']
+    models = client.get('/results/models').get_json()
+    assert models == [dict(models[0], model='fake', runs=2, iterations=5, mean_score=7)]
+    prompts = client.get(f"/results/prompts?prompt_hash={run['prompt_hash']}").get_json()
+    assert prompts[0]['runs'] == 2
+    assert client.get('/results/runs?limit=0').status_code == 400
+    assert client.get('/results/runs/999').status_code == 404
+
+def test_results_export(client, monkeypatch):
+    import pyarrow.parquet as pq
+
+    patch_models(monkeypatch, FakeLLM())
+    client.post('/evaluate', data=offline_form(iterations='3'))
+    response = client.get('/results/export?text=0')
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.num_rows == 3
+    assert 'reason' not in table.column_names
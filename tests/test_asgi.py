@@ -0,0 +1,329 @@
+import asyncio
+import io
+import json
+import threading
+import time
+
+import pytest
+from starlette.testclient import TestClient
+
+import app as app_module
+import asgi
+from test_app import offline_form, patch_models
+
+
+class FakeAsyncLLM:
+    # Counts how many async calls wait on it at once. The sync call is there for the Flask views.
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+
+    def __call__(self, prompt):
+        return f"Answer to: {prompt}"
+
+    async def ainvoke(self, prompt):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return f"Answer to: {prompt}"
+
+    async def astream(self, prompt):
+        for word in (await self.ainvoke(prompt)).split(' '):
+            yield word + ' '
+
+
+class FakeAsyncEvaluator:
+    def __init__(self, score=7):
+        self.score = score
+
+    def evaluate_strings(self, prediction, input, reference):
+        return {'reasoning': f'Looks fine. Rating: [[{self.score}]]'}
+
+    async def aevaluate_strings(self, prediction, input, reference):
+        return {'reasoning': f'Looks fine. Rating: [[{self.score}]]'}
+
+
+def patch_async_models(monkeypatch, llm, evaluator=None):
+    patch_models(monkeypatch, llm, evaluator or FakeAsyncEvaluator(), judge=FakeAsyncLLM())
+
+
+def events(response):
+    return [json.loads(line[5:]) for line in response.text.split('\n') if line.startswith('data:')]
+
+
+@pytest.fixture
+def client():
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def test_evaluate_matches_the_flask_response(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    response = client.post('/evaluate', data=offline_form(iterations='3'))
+    assert response.status_code == 200
+    async_data = response.json()
+    flask_data = app_module.app.test_client().post('/evaluate', data=offline_form(iterations='3')).get_json()
+    assert set(async_data) == set(flask_data)
+    assert [r['iteration'] for r in async_data['eval_results']] == [1, 2, 3]
+    assert set(async_data['eval_results'][0]) == set(flask_data['eval_results'][0])
+    assert async_data['avg_score'] == flask_data['avg_score'] == 7
+    assert async_data['final_verdict'] == 'Answer to: Final verdict for the evaluation of fake based on the ' \
+                                          'given criteria and 3 iterations:'
+
+
+def test_evaluate_missing_and_invalid_fields(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM())
+    response = client.post('/evaluate', data={})
+    assert response.status_code == 400
+    assert response.json() == {'error': 'Missing required field: model'}
+    assert client.post('/evaluate', data=offline_form(max_concurrency='0')).status_code == 400
+    assert client.post('/evaluate', data=offline_form(tolerance='-1')).status_code == 400
+
+
+def test_evaluate_uses_sync_clients_in_threads(client, monkeypatch):
+    class SyncLLM:
+        def __call__(self, prompt):
+            return f"Sync answer to: {prompt}"
+
+    class SyncEvaluator:
+        def evaluate_strings(self, prediction, input, reference):
+            return {'reasoning': 'Fine. Rating: [[4]]'}
+
+    patch_async_models(monkeypatch, SyncLLM(), SyncEvaluator())
+    response_data = client.post('/evaluate', data=offline_form(iterations='2')).json()
+    assert [r['score'] for r in response_data['eval_results']] == [4, 4]
+    assert response_data['eval_results'][0]['prediction'] == 'Sync answer to: Write a poem about the sea.'
+
+
+def test_evaluate_stops_early_when_scores_converge(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    response_data = client.post('/evaluate', data=offline_form(iterations='10', max_concurrency='1',
+                                                               tolerance='0.5')).json()
+    # The fourth iteration takes the free slot before the third one's result is read.
+    assert response_data['iterations_run'] in (3, 4)
+    assert response_data['stopped_early'] is True
+
+
+def test_evaluate_stream_sends_iterations_and_final_result(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    response = client.post('/evaluate_stream', data=offline_form(iterations='3', stream_tokens='true'))
+    assert response.headers['content-type'] == 'text/event-stream'
+    sent = events(response)
+    deltas = [event for event in sent if event.get('type') == 'delta']
+    results = [event for event in sent if 'score' in event]
+    assert ''.join(d['delta'] for d in deltas if d['iteration'] == 1) == 'Answer to: Write a poem about the sea. '
+    assert sorted(r['iteration'] for r in results) == [1, 2, 3]
+    assert all(r['ttft'] is not None for r in results)
+    assert sent[-1]['avg_score'] == 7
+    assert [r['iteration'] for r in sent[-1]['eval_results']] == [1, 2, 3]
+
+
+def test_evaluate_stream_reports_invalid_fields(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM())
+    response = client.post('/evaluate_stream', data=offline_form(temperature='hot'))
+    assert events(response) == [{'error': "could not convert string to float: 'hot'"}]
+
+
+def test_evaluate_stream_sends_keep_alive(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.1))
+    monkeypatch.setitem(app_module.app.config, 'STREAM_HEARTBEAT', 0.02)
+    response = client.post('/evaluate_stream', data=offline_form(iterations='1'))
+    assert ': keep-alive' in response.text
+
+
+def test_closing_the_iterations_cancels_the_running_ones(monkeypatch):
+    llm = FakeAsyncLLM(delay=10)
+    patch_async_models(monkeypatch, llm)
+
+    async def main():
+        run = app_module.EvaluationRun('fake', 0.5, 100, 'Prompt', 'Criteria', 20, 'Answer')
+        iterations = asyncio.ensure_future(asgi.arun_iterations(run, 4).__anext__())
+        await asyncio.sleep(0.05)
+        assert llm.active == 4
+        iterations.cancel()
+        await asyncio.sleep(0.01)
+        return llm.active
+
+    assert asyncio.run(main()) == 0
+
+
+def test_upload_csv_keeps_row_order_and_fails_bad_rows(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    rows = [f'fake_{i},0,100,Prompt {i},Score 10: Perfect.,3,Answer {i}' for i in range(5)] + \
+           ['fake,0,100,Prompt,Score 10: Perfect.,many,Answer']
+    csv_file = io.BytesIO(('model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+                           + '\n'.join(rows)).encode())
+    response = client.post('/upload_csv', files={'file': ('test.csv', csv_file)}, data={'max_concurrency': '2'})
+    assert response.status_code == 200
+    results = response.json()
+    assert [r['model'] for r in results] == [f'fake_{i}' for i in range(5)] + ['fake']
+    assert all(r['avg_score'] == 7 for r in results[:5])
+    assert 'error' in results[5]
+
+
+def test_upload_csv_shares_identical_calls(client, monkeypatch):
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    csv_file = io.BytesIO(b'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+                          b'fake,0,100,Prompt,Score 10: Perfect.,2,Answer\n'
+                          b'fake,0,100,Prompt,Score 10: Perfect.,2,Answer\n')
+    results = client.post('/upload_csv', files={'file': ('test.csv', csv_file)}).json()
+    # The second iteration of each row shares the judgment of the first; the second row shares every call.
+    assert [r['calls_saved'] for r in results] == [1, 4]
+
+
+def test_upload_csv_calls_capped_by_max_concurrency(client, monkeypatch):
+    # Generations, judgments and final verdicts all count towards the same max_concurrency.
+    llm = FakeAsyncLLM(delay=0.02)
+
+    class ModelEvaluator(FakeAsyncEvaluator):
+        async def aevaluate_strings(self, prediction, input, reference):
+            await llm.ainvoke(prediction)
+            return await super().aevaluate_strings(prediction, input, reference)
+
+    patch_models(monkeypatch, llm, ModelEvaluator(), judge=llm)
+    rows = ''.join(f'fake,0,100,Prompt {i},Score 10: Perfect.,3,Answer {i}\n' for i in range(4))
+    csv_file = io.BytesIO(('model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+                           + rows).encode())
+    results = client.post('/upload_csv', files={'file': ('test.csv', csv_file)},
+                          data={'max_concurrency': '2'}).json()
+    assert all(r['avg_score'] == 7 for r in results)
+    assert llm.peak == 2
+
+
+def test_upload_csv_row_stops_early(client, monkeypatch):
+    # Judge calls get a free slot before the generations still waiting, so the row converges early.
+    patch_async_models(monkeypatch, FakeAsyncLLM(delay=0.01))
+    csv_file = io.BytesIO(b'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result,tolerance\n'
+                          b'fake,0.5,100,Prompt,Score 10: Perfect.,12,Answer,0.5\n')
+    result, = client.post('/upload_csv', files={'file': ('test.csv', csv_file)}, data={'max_concurrency': '1'}).json()
+    assert result['stopped_early'] is True
+    assert result['iterations_run'] < 12
+
+
+def test_upload_csv_rejects_missing_and_invalid_files(client):
+    assert client.post('/upload_csv').json() == {'error': 'No file part in the request'}
+    response = client.post('/upload_csv', files={'file': ('test.txt', io.BytesIO(b'x'))})
+    assert response.status_code == 400
+    assert response.json() == {'error': 'Invalid file format. Please upload a CSV file.'}
+
+
+def test_other_routes_are_served_by_flask(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b'LLM Evaluator' in response.content
+    assert 'cancellations' in client.get('/stats').json()
+
+
+def test_hundreds_of_evaluations_share_one_thread(monkeypatch):
+    # 300 evaluations waiting on a slow provider at the same time, without a thread for any of them.
+    llm = FakeAsyncLLM(delay=0.2)
+    patch_async_models(monkeypatch, llm)
+    threads = threading.active_count()
+
+    async def evaluate():
+        run = app_module.EvaluationRun('fake', 0.5, 100, 'Prompt', 'Criteria', 2, 'Answer')
+        return [result async for result in asgi.arun_iterations(run, 2)]
+
+    async def main():
+        return await asyncio.gather(*(evaluate() for _ in range(300)))
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    assert time.perf_counter() - started < 5
+    assert all(len(result) == 2 for result in results)
+    assert llm.peak == 600
+    assert threading.active_count() <= threads + 1
+
+
+def test_langchain_judge_runs_without_threads(monkeypatch):
+    # The stub judge behind the real labeled_score_string evaluator: 20 judgments at once take as long as one.
+    monkeypatch.setenv('STUB_JUDGE_LATENCY', 'fixed:0.2')
+    monkeypatch.setenv('STUB_JUDGE_SCORE', '6')
+    app_module.llm_clients.clear()
+    app_module.evaluators.clear()
+    run = app_module.EvaluationRun('stub', 0.5, 100, 'Prompt', 'Criteria', 1, 'Answer')
+    assert run.evaluator.evaluate_strings(prediction='x', input='Prompt', reference='Answer')['score'] == 6
+
+    async def main():
+        return await asyncio.gather(*(run.aevaluate(f'Prediction {i}') for i in range(20)))
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    assert time.perf_counter() - started < 1
+    assert all(result['score'] == 6 and 'Rating: [[6]]' in result['reasoning'] for result in results)
+    app_module.llm_clients.clear()
+    app_module.evaluators.clear()
+
+
+def test_failing_row_does_not_cancel_calls_shared_with_another_row(monkeypatch):
+    # Row 1's judge fails while row 2 waits on a generation row 1 started: row 2 still gets every iteration.
+    class SlowAfterFirstLLM(FakeAsyncLLM):
+        calls = 0
+
+        async def ainvoke(self, prompt):
+            self.calls += 1
+            self.delay = 0.01 if self.calls == 1 else 0.2
+            return await super().ainvoke(prompt)
+
+    class FailingEvaluator(FakeAsyncEvaluator):
+        async def aevaluate_strings(self, prediction, input, reference):
+            raise ValueError('Judge failed')
+
+    patch_async_models(monkeypatch, SlowAfterFirstLLM())
+    monkeypatch.setattr(app_module, 'get_evaluator', lambda llm_evaluator, criteria:
+                        FailingEvaluator() if criteria == 'Fail' else FakeAsyncEvaluator())
+    experiments = [{'model': 'fake', 'temperature': '0.5', 'max_new_tokens': '100', 'prompt': 'Prompt',
+                    'criteria': criteria, 'iterations': '2', 'expected_result': 'Answer'}
+                   for criteria in ('Fail', 'Score 10: Perfect.')]
+
+    async def main():
+        return [result async for _, result in asgi.arun_batch(experiments, max_concurrency=4)]
+
+    failed, passed = asyncio.run(main())
+    assert failed == {'model': 'fake', 'error': 'Judge failed'}
+    assert [r['iteration'] for r in passed['eval_results']] == [1, 2]
+    assert passed['iterations_run'] == 2
+
+
+def test_async_stream_retries_only_before_the_first_token():
+    from ratelimit import ThrottledError, get_limiter
+    get_limiter('throttled_stream').base_delay = 0.001
+
+    class ThrottledAsyncStreamingLLM:
+        provider_family = 'throttled_stream'
+
+        def __init__(self, *throttle_at, error=ValueError):
+            self.throttle_at = list(throttle_at)
+            self.error = error
+            self.attempts = 0
+
+        async def astream(self, prompt):
+            self.attempts += 1
+            throttle_at = self.throttle_at.pop(0) if self.throttle_at else None
+            for i, word in enumerate(['a ', 'b ', 'c']):
+                if i == throttle_at:
+                    raise self.error('Error raised by bedrock service: ThrottlingException: Rate exceeded')
+                yield word
+
+    class RateLimitError(Exception):
+        pass
+
+    tokens = []
+    llm = ThrottledAsyncStreamingLLM(0)
+    assert asyncio.run(app_module.astream_llm(llm, 'Prompt', tokens.append))[0] == 'a b c'
+    assert (llm.attempts, tokens) == (2, ['a ', 'b ', 'c'])
+
+    tokens = []
+    llm = ThrottledAsyncStreamingLLM(2)
+    with pytest.raises(ValueError):
+        asyncio.run(app_module.astream_llm(llm, 'Prompt', tokens.append))
+    assert (llm.attempts, tokens) == (1, ['a ', 'b '])
+
+    # A throttle error that isn't a ValueError fails only the iteration as well.
+    llm = ThrottledAsyncStreamingLLM(1, error=RateLimitError)
+    with pytest.raises(ThrottledError):
+        asyncio.run(app_module.astream_llm(llm, 'Prompt', lambda text: None))
@@ -0,0 +1,24 @@
+from clientpool import LRURegistry
+
+
+def test_registry_reuses_entries():
+    registry = LRURegistry('test', maxsize=2)
+    built = []
+
+    def factory(key):
+        return lambda: built.append(key) or key
+
+    assert registry.get('a', factory('a')) == 'a'
+    assert registry.get('a', factory('a')) == 'a'
+    assert built == ['a']
+    assert registry.stats()['hits'] == 1
+    assert registry.stats()['misses'] == 1
+
+def test_registry_evicts_least_recently_used():
+    registry = LRURegistry('test', maxsize=2)
+    registry.get('a', lambda: 'a')
+    registry.get('b', lambda: 'b')
+    registry.get('a', lambda: 'a')
+    registry.get('c', lambda: 'c')
+    assert list(registry.entries) == ['a', 'c']
+    assert registry.stats()['evictions'] == 1
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from dedupe import AsyncSharedCalls, SharedCalls
+
+
+def test_identical_calls_run_once():
+    shared = SharedCalls()
+    calls = []
+    assert shared.fetch('generation', 'a', lambda: calls.append(1) or 'x') == ('x', False)
+    assert shared.fetch('generation', 'a', lambda: calls.append(1) or 'y') == ('x', True)
+    assert shared.fetch('generation', 'b', lambda: calls.append(1) or 'z') == ('z', False)
+    assert len(calls) == 2
+    assert shared.stats() == {'generation': 1}
+
+def test_concurrent_calls_wait_for_the_one_in_flight():
+    shared = SharedCalls()
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return 'x'
+
+    threads = [threading.Thread(target=lambda: results.append(shared.fetch('judgment', 'k', compute)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+
+def test_failed_call_is_retried():
+    shared = SharedCalls()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        shared.fetch('generation', 'a', fail)
+    assert shared.fetch('generation', 'a', lambda: 'x') == ('x', False)
+
+def test_finished_calls_are_evicted_oldest_first():
+    shared = SharedCalls(maxsize=2)
+    for key in 'abc':
+        shared.fetch('generation', key, lambda: key)
+    assert shared.fetch('generation', 'a', lambda: 'again') == ('again', False)
+    assert shared.fetch('generation', 'c', lambda: 'again') == ('c', True)
+
+def test_async_calls_wait_for_the_one_in_flight():
+    shared = AsyncSharedCalls()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'x'
+
+    async def main():
+        return await asyncio.gather(*(shared.fetch('judgment', 'k', compute) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert sorted(results) == [('x', False)] + [('x', True)] * 4
+    assert shared.stats() == {'judgment': 4}
+
+def test_async_failed_call_is_retried():
+    shared = AsyncSharedCalls()
+
+    async def fail():
+        raise ValueError('boom')
+
+    async def succeed():
+        return 'x'
+
+    async def main():
+        with pytest.raises(ValueError):
+            await shared.fetch('generation', 'k', fail)
+        return await shared.fetch('generation', 'k', succeed)
+
+    assert asyncio.run(main()) == ('x', False)
+
+def test_async_waiters_make_the_call_again_when_its_owner_is_cancelled():
+    shared = AsyncSharedCalls()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'x'
+
+    async def main():
+        owner = asyncio.create_task(shared.fetch('generation', 'k', compute))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(shared.fetch('generation', 'k', compute))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(main()) == ('x', False)
+    assert len(calls) == 2
+    assert shared.stats() == {}
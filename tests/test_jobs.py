@@ -0,0 +1,148 @@
+import io
+import os
+import time
+
+import pytest
+
+import app as app_module
+from jobs import JobManager, JobStore
+from test_app import FakeLLM, patch_models
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    manager = JobManager(JobStore(str(tmp_path / 'jobs.sqlite3')), app_module.run_job, workers=1)
+    monkeypatch.setattr(app_module, 'job_manager', manager)
+    return manager
+
+
+def job_csv(rows, iterations=2):
+    header = 'model,temperature,max_new_tokens,prompt,criteria,iterations,expected_result\n'
+    lines = [f'fake,0,100,Prompt {i},Score 10: Perfect.,{iterations},Answer {i}' for i in range(rows)]
+    return io.BytesIO((header + '\n'.join(lines)).encode())
+
+
+def wait_for(client, job_id, statuses=('completed', 'failed', 'cancelled')):
+    for _ in range(200):
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'job still {job["status"]}')
+
+def test_job_runs_in_background(client, manager, monkeypatch):
+    patch_models(monkeypatch, FakeLLM())
+    response = client.post('/jobs', data={'file': (job_csv(3), 'test.csv')})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    job = wait_for(client, job_id)
+    assert job['status'] == 'completed'
+    assert job['completed_rows'] == 3
+    assert job['completed_iterations'] == 6
+    results = client.get(f'/jobs/{job_id}/results').get_json()['results']
+    assert [r['eval_results'][0]['prediction'] for r in results] == [f'Answer to: Prompt {i}' for i in range(3)]
+
+def test_job_resumes_from_checkpoints(client, manager, monkeypatch):
+    calls = []
+    llm = FakeLLM()
+    patch_models(monkeypatch, lambda prompt: calls.append(prompt) or llm(prompt))
+    job_id = manager.store.create(app_module.csv.DictReader(io.TextIOWrapper(job_csv(2))), {})
+    # The first row and one iteration of the second were finished before the worker went away.
+    for iteration in (1, 2):
+        manager.store.save_checkpoint(job_id, 0, iteration, {'iteration': iteration, 'prediction': 'saved',
+                                                             'score': 9, 'reason': '[[9]]'})
+    manager.store.save_checkpoint(job_id, 0, 0, 'Saved verdict')
+    manager.store.save_checkpoint(job_id, 1, 1, {'iteration': 1, 'prediction': 'saved', 'score': 9,
+                                                 'reason': '[[9]]'})
+    manager.store.set_status(job_id, 'failed', error='worker restarted')
+
+    assert client.post(f'/jobs/{job_id}/resume').status_code == 202
+    assert wait_for(client, job_id)['status'] == 'completed'
+    assert calls == ['Prompt 1']
+    results = client.get(f'/jobs/{job_id}/results').get_json()['results']
+    assert results[0]['final_verdict'] == 'Saved verdict'
+    assert [r['score'] for r in results[1]['eval_results']] == [9, 7]
+
+def test_job_stream_sends_keep_alives_while_idle(client, manager, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'STREAM_HEARTBEAT', 0)
+    # Never picked up by a worker, so its progress doesn't change.
+    job_id = manager.store.create(app_module.csv.DictReader(io.TextIOWrapper(job_csv(1))), {})
+    response = client.get(f'/jobs/{job_id}/stream')
+    chunks = response.iter_encoded()
+    assert next(chunks).startswith(b'data: ')
+    assert next(chunks) == b': keep-alive\n\n'
+    response.close()
+
+def test_cancel_job(client, manager, monkeypatch):
+    patch_models(monkeypatch, FakeLLM(delay=0.05))
+    job_id = client.post('/jobs', data={'file': (job_csv(20), 'test.csv')}).get_json()['job_id']
+    assert client.post(f'/jobs/{job_id}/cancel').status_code == 200
+    job = wait_for(client, job_id)
+    assert job['status'] == 'cancelled'
+    assert job['completed_rows'] < 20
+
+def test_cancel_from_another_worker_process(client, manager, monkeypatch):
+    # The cancel is handled by a second manager on the same store, as another gunicorn worker would.
+    patch_models(monkeypatch, FakeLLM(delay=0.05))
+    manager.poll_interval = 0.05
+    job_id = client.post('/jobs', data={'file': (job_csv(20), 'test.csv')}).get_json()['job_id']
+    wait_for(client, job_id, statuses=('running',))
+    other = JobManager(JobStore(manager.store.path), app_module.run_job, workers=1)
+    assert other.cancel(job_id)
+    for _ in range(200):
+        if not manager.stop_events:
+            break
+        time.sleep(0.02)
+    job = client.get(f'/jobs/{job_id}').get_json()
+    assert not manager.stop_events
+    assert job['status'] == 'cancelled'
+    assert job['completed_rows'] < 20
+    assert manager.store.owner(job_id) == ('cancelled', None)
+
+def test_resume_refused_while_another_process_holds_the_job(client, manager):
+    job_id = manager.store.create([{'iterations': '1'}], {})
+    # Cancelled, but the process that ran it (here our parent, which is alive) hasn't stopped yet.
+    manager.store._connection().execute("UPDATE jobs SET status = 'cancelled', worker_pid = ? WHERE id = ?",
+                                        (os.getppid(), job_id))
+    response = client.post(f'/jobs/{job_id}/resume')
+    assert response.status_code == 409
+    assert response.get_json() == {'error': 'Job is still held by another worker process'}
+    assert not manager.resume(job_id)
+    assert manager.store.owner(job_id) == ('cancelled', os.getppid())
+
+def test_unknown_job(client, manager):
+    assert client.get('/jobs/missing').status_code == 404
+
+def test_interrupted_jobs_are_resumable(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.sqlite3'))
+    job_id = store.create([{'iterations': '1'}], {})
+    # A running job whose worker process is gone can be picked up again.
+    store._connection().execute("UPDATE jobs SET status = 'running', worker_pid = 999999999 WHERE id = ?",
+                                (job_id,))
+    assert store.resumable() == [job_id]
+
+def test_job_left_by_a_worker_with_our_pid_is_resumed(client, manager, monkeypatch):
+    # A restarted container often gets the pid of the worker that died; its boot token tells them apart.
+    patch_models(monkeypatch, FakeLLM())
+    job_id = manager.store.create(app_module.csv.DictReader(io.TextIOWrapper(job_csv(1))), {})
+    manager.store._connection().execute(
+        "UPDATE jobs SET status = 'running', worker_pid = ?, worker_token = 'dead' WHERE id = ?", (os.getpid(), job_id))
+    assert manager.store.resumable() == [job_id]
+    assert client.post(f'/jobs/{job_id}/resume').status_code == 202
+    assert wait_for(client, job_id)['status'] == 'completed'
+    assert manager.store.owner(job_id) == ('completed', None)
+    # A job this process runs isn't claimed by it a second time.
+    assert manager.store.claim(job_id, ('completed',))
+    assert not manager.store.claim(job_id, ('running',))
+    assert manager.store.resumable() == []
+
+def test_job_manager_resumes_interrupted_jobs_when_created(client, monkeypatch, tmp_path):
+    patch_models(monkeypatch, FakeLLM())
+    path = str(tmp_path / 'jobs.sqlite3')
+    store = JobStore(path)
+    job_id = store.create(app_module.csv.DictReader(io.TextIOWrapper(job_csv(1))), {})
+    store._connection().execute("UPDATE jobs SET status = 'running', worker_pid = 999999999 WHERE id = ?", (job_id,))
+    monkeypatch.setitem(app_module.app.config, 'JOB_STORE_PATH', path)
+    monkeypatch.setattr(app_module, 'job_manager', None)
+    app_module.get_job_manager()
+    assert wait_for(client, job_id)['status'] == 'completed'
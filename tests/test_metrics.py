@@ -0,0 +1,31 @@
+import pytest
+
+import metrics
+from metrics import Counter, Histogram, render, timed, STAGE_ERRORS
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'Test histogram.', ('stage',), buckets=(0.1, 1), registry=[])
+    histogram.observe(0.05, stage='a')
+    histogram.observe(0.5, stage='a')
+    histogram.observe(5, stage='a')
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+def test_counter_escapes_labels():
+    registry = []
+    counter = Counter('test_total', 'Test counter.', ('model',), registry=registry)
+    counter.inc(model='a "quoted" name')
+    assert 'test_total{model="a \\"quoted\\" name"} 1' in render(registry)
+    # Metrics made for a test stay out of the process-wide registry that /metrics renders.
+    assert counter not in metrics.REGISTRY
+    assert 'test_total' not in render()
+
+def test_timed_counts_errors():
+    with pytest.raises(ValueError):
+        with timed('generation', 'broken_model', 'bedrock'):
+            raise ValueError('boom')
+    assert STAGE_ERRORS.get(stage='generation', model='broken_model', provider='bedrock') == 1
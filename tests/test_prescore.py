@@ -0,0 +1,61 @@
+import pytest
+
+from prescore import PreScorer, check_rules, normalize
+
+
+def test_normalize_drops_case_and_punctuation():
+    assert normalize('  Hello,   World! ') == 'hello world'
+
+def test_default_preset_decides_matches_and_empty_predictions():
+    scorer = PreScorer(check_rules('default'), 'Paris is the capital.')
+    exact, empty, other = (scorer.decide(prediction) for prediction in ['paris is the capital', '   ', 'It is Lyon.'])
+    assert (exact.score, exact.path) == (10, 'local:normalized_match')
+    assert (empty.score, empty.path) == (1, 'local:empty')
+    assert other is None
+
+def test_token_f1_and_scaled_score():
+    rules = check_rules([{'scorer': 'token_f1', 'min': 0.5, 'score': 'scaled'}])
+    scorer = PreScorer(rules, 'the cat sat on the mat')
+    decision = scorer.decide('the cat sat')
+    # precision 1, recall 0.5
+    assert decision.value == pytest.approx(2 / 3)
+    assert decision.score == 7
+    assert scorer.decide('a dog barked') is None
+
+def test_char_ngram_similarity():
+    rules = check_rules([{'scorer': 'char_ngram', 'n': 3, 'min': 0.8, 'score': 9}])
+    scorer = PreScorer(rules, 'photosynthesis')
+    assert scorer.decide('Photosynthesis!').score == 9
+    assert scorer.decide('respiration') is None
+
+def test_judge_rule_escalates_before_later_rules():
+    rules = check_rules([
+        {'scorer': 'regex', 'pattern': r'(?i)i cannot', 'score': 'judge'},
+        {'scorer': 'token_f1', 'max': 1, 'score': 5},
+    ])
+    scorer = PreScorer(rules, 'anything')
+    assert scorer.decide('I cannot answer that') is None
+    assert scorer.decide('Something else').score == 5
+
+@pytest.mark.parametrize('rules', [
+    '[{"scorer": "bleu", "score": 3}]',
+    '[{"scorer": "exact_match", "score": 11}]',
+    '[{"scorer": "regex", "pattern": "(", "score": 1}]',
+    '[{"scorer": "regex", "pattern": 5, "score": 1}]',
+    '[{"scorer": "regex", "score": 1}]',
+    '{"scorer": "exact_match"}',
+    '[{"scorer": "exact_match", "score": true}]',
+    '[{"scorer": "token_f1", "min": "0.5", "score": 5}]',
+    '[{"scorer": "token_f1", "max": 1.5, "score": 5}]',
+    '[{"scorer": "token_f1", "min": 0.8, "max": 0.2, "score": 5}]',
+    '[{"scorer": "char_ngram", "n": 0, "score": 5}]',
+    '[{"scorer": "char_ngram", "n": "3", "score": 5}]',
+    'not json',
+])
+def test_invalid_rules(rules):
+    with pytest.raises(ValueError):
+        check_rules(rules)
+
+def test_unknown_preset_names_the_accepted_values():
+    with pytest.raises(ValueError, match="one of 'off', 'default' or a JSON list of rules"):
+        check_rules('defualt')
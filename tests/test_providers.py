@@ -0,0 +1,49 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import providers
+from stub_llm import StubLLM
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(providers, 'PROVIDERS', dict(providers.PROVIDERS))
+    monkeypatch.setattr(providers, 'MODELS', dict(providers.MODELS))
+
+
+def test_builtin_models_are_registered():
+    assert providers.MODELS['claude_3_haiku'] == {
+        'provider': 'bedrock_chat', 'model_id': 'anthropic.claude-3-haiku-20240307-v1:0', 'options': {}}
+    assert isinstance(providers.build_model('stub', 0.5, 100), StubLLM)
+    assert list(providers.MODELS)[-2:] == ['granite_20b_multilingual', 'stub']
+
+def test_load_config_registers_models_and_plugin_providers(tmp_path, monkeypatch):
+    (tmp_path / 'my_plugin.py').write_text(
+        'def build(model_id, temperature, max_new_tokens, **options):\n'
+        '    return {"model_id": model_id, "temperature": temperature, **options}\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    config = tmp_path / 'models.json'
+    config.write_text(json.dumps({
+        'providers': {'mine': 'my_plugin:build'},
+        'models': {
+            'my_model': {'provider': 'mine', 'model_id': 'm-1', 'options': {'region': 'eu'}},
+            'judge_stub': {'provider': 'stub', 'options': {'role': 'judge'}},
+        }
+    }))
+    providers.load_config(str(config))
+    assert providers.build_model('my_model', 0.2, 10) == {'model_id': 'm-1', 'temperature': 0.2, 'region': 'eu'}
+    assert providers.build_model('judge_stub', 0, 10).role == 'judge'
+
+def test_register_model_with_unknown_provider():
+    with pytest.raises(ValueError):
+        providers.register_model('x', 'nowhere', 'x-1')
+
+def test_app_import_does_not_load_provider_sdks():
+    code = ('import sys, app; '
+            'print([m for m in ("langchain_openai", "langchain_aws", "langchain_ibm", "langchain.evaluation") '
+            'if m in sys.modules])')
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True)
+    assert output.stdout.strip().splitlines()[-1] == '[]'
@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from ratelimit import AdaptiveRateLimiter, ThrottledError, is_throttle_error, provider_family
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_limiter(clock, **kwargs):
+    return AdaptiveRateLimiter('test', clock=clock, sleep=clock.sleep, **kwargs)
+
+def test_token_bucket_spaces_calls():
+    clock = FakeClock()
+    limiter = make_limiter(clock, rate=2.0, max_rate=2.0)
+    for _ in range(6):
+        limiter.acquire()
+    # The first two calls use the burst, the remaining four wait half a second each.
+    assert clock.now == pytest.approx(2.0)
+
+def test_throttle_decreases_and_success_increases_rate():
+    clock = FakeClock()
+    limiter = make_limiter(clock, rate=8.0, max_rate=10.0, cooldown=1.0)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 4.0
+    clock.now += 1.0
+    limiter.on_throttle()
+    assert limiter.rate == 2.0
+    for _ in range(100):
+        limiter.on_success()
+    assert 2.0 < limiter.rate <= 10.0
+
+def test_call_retries_throttled_requests():
+    clock = FakeClock()
+    limiter = make_limiter(clock, rate=5.0, max_rate=5.0)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError('Error raised by bedrock service: ThrottlingException: Rate exceeded')
+        return 'ok'
+
+    assert limiter.call(flaky) == 'ok'
+    assert len(attempts) == 3
+    assert limiter.throttled == 2
+
+def test_acall_retries_throttled_requests_without_blocking():
+    clock = FakeClock()
+    waits = []
+
+    async def asleep(seconds):
+        waits.append(seconds)
+        clock.sleep(seconds)
+
+    limiter = AdaptiveRateLimiter('test', rate=5.0, max_rate=5.0, clock=clock, asleep=asleep)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ValueError('Error raised by bedrock service: ThrottlingException: Rate exceeded')
+        return 'ok'
+
+    assert asyncio.run(limiter.acall(flaky)) == 'ok'
+    assert len(attempts) == 3
+    assert limiter.throttled == 2
+    assert len(waits) >= 2
+
+def test_call_gives_up_after_max_retries():
+    clock = FakeClock()
+    limiter = make_limiter(clock, rate=5.0, max_rate=5.0, max_retries=2)
+
+    def throttled():
+        raise ValueError('Too Many Requests')
+
+    with pytest.raises(ValueError):
+        limiter.call(throttled)
+    assert limiter.throttled == 3
+
+class RateLimitError(Exception):
+    # Shaped like openai's, which isn't a ValueError.
+    status_code = 429
+
+
+def test_exhausted_retries_raise_a_value_error():
+    limiter = make_limiter(FakeClock(), rate=5.0, max_rate=5.0, max_retries=1)
+
+    def throttled():
+        raise RateLimitError('Error code: 429')
+
+    async def athrottled():
+        throttled()
+
+    with pytest.raises(ThrottledError) as excinfo:
+        limiter.call(throttled)
+    assert isinstance(excinfo.value.__cause__, RateLimitError)
+    limiter.asleep = lambda seconds: asyncio.sleep(0)
+    with pytest.raises(ThrottledError):
+        asyncio.run(limiter.acall(athrottled))
+    assert limiter.throttled == 4
+
+def test_other_errors_are_not_retried():
+    limiter = make_limiter(FakeClock(), rate=5.0, max_rate=5.0)
+    with pytest.raises(ValueError):
+        limiter.call(lambda: int('x'))
+    assert limiter.throttled == 0
+    assert not is_throttle_error(ValueError('Invalid prompt'))
+
+def test_provider_family():
+    class Stub:
+        provider_family = 'stub'
+
+    assert provider_family(Stub()) == 'stub'
+    assert provider_family(object()) is None
@@ -0,0 +1,51 @@
+import asyncio
+import time
+
+import pytest
+
+from responsecache import ResponseCache, check_policy, make_key
+
+
+def test_read_through_serves_hits(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    calls = []
+    key = make_key('generation', 'model', 0.0, 100, 'prompt', None)
+    assert cache.fetch('read-through', key, lambda: calls.append(1) or 'answer') == ('answer', False)
+    assert cache.fetch('read-through', key, lambda: calls.append(1) or 'answer') == ('answer', True)
+    assert len(calls) == 1
+
+def test_afetch_serves_hits(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    calls = []
+    key = make_key('generation', 'model', 0.0, 100, 'prompt', None)
+
+    async def compute():
+        calls.append(1)
+        return 'answer'
+
+    assert asyncio.run(cache.afetch('read-through', key, compute)) == ('answer', False)
+    assert asyncio.run(cache.afetch('read-through', key, compute)) == ('answer', True)
+    assert len(calls) == 1
+
+def test_write_only_and_bypass(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'))
+    assert cache.fetch('bypass', 'k', lambda: 'a') == ('a', False)
+    assert cache.get('k') is None
+    assert cache.fetch('write-only', 'k', lambda: 'b') == ('b', False)
+    assert cache.fetch('write-only', 'k', lambda: 'c') == ('c', False)
+    assert cache.get('k') == 'c'
+
+def test_ttl_and_size_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite3'), ttl=60, max_entries=2)
+    cache.set('old', 'value')
+    cache._connection().execute("UPDATE responses SET created = ? WHERE key = 'old'", (time.time() - 120,))
+    assert cache.get('old') is None
+    for key in ('a', 'b', 'c'):
+        cache.set(key, key)
+    cache.prune()
+    count = cache._connection().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    assert count == 2
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        check_policy('sometimes')
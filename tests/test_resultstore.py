@@ -0,0 +1,64 @@
+import pyarrow.parquet as pq
+import pytest
+
+from resultstore import ResultStore, prompt_hash
+
+
+def iteration(number, score, generation=0.1, judge=0.2):
+    return {'iteration': number, 'prediction': f'Prediction {number}', 'score': score, 'reason': 'Fine.',
+            'scoring_path': 'judge', 'timings': {'generation': generation, 'judge': judge}}
+
+
+def record(store, model='m1', prompt='Prompt', scores=(7, 9)):
+    run = {'model': model, 'judge_model': 'judge', 'temperature': 0.5, 'max_new_tokens': 100, 'prompt': prompt,
+           'criteria': 'c', 'expected_result': 'e', 'iterations': len(scores), 'avg_score': None,
+           'final_verdict': 'Good', 'elapsed': 1.5}
+    return store.record('evaluate', run, [iteration(i + 1, score) for i, score in enumerate(scores)])
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultStore(str(tmp_path / 'results.sqlite3'))
+
+
+def test_record_and_read_back_a_run(store):
+    run_id = record(store)
+    run = store.run(run_id)
+    assert run['model'] == 'm1'
+    assert run['prompt'] == 'Prompt'
+    assert run['prompt_hash'] == prompt_hash('Prompt')
+    assert run['iterations_run'] == 2
+    assert [r['score'] for r in run['eval_results']] == [7, 9]
+    assert store.run(run_id + 1) is None
+
+def test_aggregates_are_updated_incrementally(store):
+    record(store, scores=(7, 9))
+    record(store, scores=(5, None))
+    record(store, model='m2', scores=(10,))
+    m1, m2 = store.model_stats()
+    assert (m1['model'], m1['runs'], m1['iterations'], m1['scored_iterations']) == ('m1', 2, 4, 3)
+    assert m1['mean_score'] == pytest.approx(7)
+    assert m1['score_stddev'] == pytest.approx(2)
+    assert (m1['min_score'], m1['max_score']) == (5, 9)
+    assert m1['mean_generation_seconds'] == pytest.approx(0.1)
+    assert m2['score_stddev'] is None
+    by_prompt = store.prompt_stats(prompt_hash=prompt_hash('Prompt'))
+    assert sorted(stats['model'] for stats in by_prompt) == ['m1', 'm2']
+    assert by_prompt[0]['prompt'] == 'Prompt'
+
+def test_runs_are_filtered_and_paged(store):
+    ids = [record(store, model=model) for model in ('m1', 'm2', 'm1', 'm1')]
+    page = store.runs(model='m1', limit=2)
+    assert [run['id'] for run in page] == [ids[3], ids[2]]
+    assert [run['id'] for run in store.runs(model='m1', before=ids[2])] == [ids[0]]
+
+def test_export_parquet(store, tmp_path):
+    for scores in ((7, 9), (5,)):
+        record(store, scores=scores)
+    path = tmp_path / 'export.parquet'
+    assert store.export_parquet(str(path), batch_size=2) == 3
+    table = pq.read_table(str(path))
+    assert table.column('score').to_pylist() == [7, 9, 5]
+    assert table.column('model').to_pylist() == ['m1'] * 3
+    assert store.export_parquet(str(path), include_text=False, model='none') == 0
+    assert 'prediction' not in pq.read_table(str(path)).column_names
@@ -0,0 +1,22 @@
+import threading
+
+from sqlitestore import SQLiteStore
+
+
+class NotesStore(SQLiteStore):
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS notes (text TEXT NOT NULL);'
+
+
+def test_each_thread_gets_its_own_connection(tmp_path):
+    store = NotesStore(str(tmp_path / 'notes.sqlite3'))
+    connection = store._connection()
+    assert store._connection() is connection
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    connection.execute("INSERT INTO notes VALUES ('main')")
+
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(
+        (store._connection() is connection, store._connection().execute('SELECT text FROM notes').fetchone()['text'])))
+    thread.start()
+    thread.join()
+    assert seen == [(False, 'main')]
@@ -0,0 +1,46 @@
+import pytest
+
+from stopping import EarlyStopping, confidence_interval, parse_early_stopping, t_critical
+
+
+def test_confidence_interval_needs_two_scores():
+    assert confidence_interval([]) is None
+    assert confidence_interval([7]) is None
+
+def test_confidence_interval_of_known_scores():
+    low, high = confidence_interval([6, 8])
+    # mean 7, standard error 1, t(1) = 12.706
+    assert low == pytest.approx(7 - 12.706)
+    assert high == pytest.approx(7 + 12.706)
+
+def test_t_critical_between_and_past_table():
+    assert t_critical(35) == t_critical(30)
+    assert t_critical(1000) == 1.960
+
+def test_early_stopping_waits_for_min_iterations():
+    stopping = EarlyStopping(tolerance=1, min_iterations=3)
+    assert not stopping.add(7)
+    assert not stopping.add(7)
+    assert not stopping.add(None)
+    assert stopping.add(7)
+    # Only the first convergence is reported.
+    assert not stopping.add(7)
+    assert stopping.interval() == [7, 7]
+
+def test_early_stopping_keeps_going_while_scores_spread():
+    stopping = EarlyStopping(tolerance=1)
+    for score in (2, 9, 5, 8):
+        assert not stopping.add(score)
+    assert not stopping.converged
+
+def test_parse_early_stopping():
+    assert parse_early_stopping('') is None
+    assert parse_early_stopping(None) is None
+    assert parse_early_stopping('0.5', '4').min_iterations == 4
+    with pytest.raises(ValueError):
+        parse_early_stopping('0')
+    for tolerance in ('nan', 'inf'):
+        with pytest.raises(ValueError, match='finite'):
+            parse_early_stopping(tolerance)
+    with pytest.raises(ValueError):
+        parse_early_stopping('1', '1')
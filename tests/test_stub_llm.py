@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from ratelimit import is_throttle_error
+from stub_llm import StubLLM, sample_latency
+
+
+def test_judge_returns_score():
+    judge = StubLLM(role='judge', score=8)
+    assert '[[8]]' in judge.invoke('Rate this answer')
+
+def test_stream_yields_the_full_answer():
+    llm = StubLLM(tokens=6)
+    assert ''.join(llm.stream('Hello')) == llm.invoke('Hello')
+
+def test_async_api_matches_the_sync_one():
+    llm = StubLLM(tokens=6, latency='fixed:0.01')
+
+    async def main():
+        return await llm.ainvoke('Hello'), ''.join([chunk async for chunk in llm.astream('Hello')])
+
+    assert asyncio.run(main()) == (llm.invoke('Hello'),) * 2
+
+def test_injected_throttling_looks_like_bedrock():
+    llm = StubLLM(throttle_rate=1.0)
+    with pytest.raises(ValueError) as error:
+        llm.invoke('Hello')
+    assert is_throttle_error(error.value)
+
+def test_injected_errors():
+    with pytest.raises(ValueError):
+        StubLLM(error_rate=1.0).invoke('Hello')
+
+def test_latency_specs():
+    assert sample_latency('fixed:0.5') == 0.5
+    assert 0.1 <= sample_latency('uniform:0.1:0.2') <= 0.2
+    assert sample_latency('lognormal:0.1:0.5') > 0
+    with pytest.raises(ValueError):
+        sample_latency('zipf:1')